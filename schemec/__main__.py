@@ -0,0 +1,50 @@
+"""Compile a Scheme program to C++.
+
+    python -m schemec program.scm -o program.cpp --stats stats.json
+
+With --stats, what each phase of the compiler cost (see schemec.stats) is
+written as JSON to the file given, or to stderr.
+"""
+from argparse import ArgumentParser
+import json
+import sys
+
+from schemec.stats import compile_stats
+
+def main(argv=None):
+    parser = ArgumentParser(prog='python -m schemec', description='Compile a Scheme program to C++.')
+    parser.add_argument('source', help='the program, or - for stdin')
+    parser.add_argument('-o', '--output', default='-', help='where to write the C++ (default: stdout)')
+    parser.add_argument('--options', default='{}',
+                        help='the keyword arguments to optimize, as a JSON object')
+    parser.add_argument('--stats', nargs='?', const='-', default=None, metavar='FILE',
+                        help='write the time, peak memory and IR size of each phase as JSON '
+                             'to FILE (default: stderr)')
+    parser.add_argument('--no-memory', action='store_true',
+                        help='do not trace memory, which slows every phase down')
+    args = parser.parse_args(argv)
+
+    if args.source == '-':
+        source = sys.stdin.read()
+    else:
+        with open(args.source) as f:
+            source = f.read()
+    code, stats = compile_stats(source, json.loads(args.options),
+                                memory=args.stats is not None and not args.no_memory)
+
+    if args.output == '-':
+        sys.stdout.write(code + '\n')
+    else:
+        with open(args.output, 'w') as f:
+            f.write(code + '\n')
+    if args.stats == '-':
+        json.dump(stats.as_dict(), sys.stderr, indent=2)
+        sys.stderr.write('\n')
+    elif args.stats is not None:
+        with open(args.stats, 'w') as f:
+            json.dump(stats.as_dict(), f, indent=2)
+            f.write('\n')
+    return 0
+
+if __name__ == '__main__':
+    sys.exit(main())
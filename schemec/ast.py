@@ -9,7 +9,9 @@ from schemec.grammar import (
 from schemec.sexp import SExp, parse
 from schemec.typs import (
     VarExp,
+    LamExp,
     AppExp,
+    IfExp,
     )
 
 
@@ -93,11 +95,18 @@ def to_exp(expr):
                     narg, init = next((narg, f) for n, narg, f in kwd_specs if n == name)
                     if len(expr[1:]) != narg:
                         wrong_nargs(narg, expr)
-                    return init(*rest) if all(rest) else None
                 except StopIteration:
                     return unimplemented(expr)
+                if not all(rest):
+                    return None
+                exp = init(*rest)
+                if isinstance(exp, (LamExp, IfExp)):
+                    # so what the compiler makes of it can be traced back
+                    # to the source
+                    exp.pos = expr.pos
+                return exp
             else:
-                return AppExp(VarExp(name), *rest) if all(rest) else None
+                return AppExp(VarExp(name), *rest, pos=expr.pos) if all(rest) else None
     else:
         try:
             init = next(f for t, f in val_specs if t(expr))
@@ -0,0 +1,269 @@
+import hashlib
+import os
+import shlex
+import shutil
+import subprocess
+import tempfile
+from textwrap import dedent
+
+from schemec.ast import ast
+from schemec.cache import Cache, cache_dir
+from schemec.cps import T_c
+from schemec.gencpp import RUNTIME_DIR, gen_cpp, gen_cpp_units, halt
+from schemec.opt import optimize
+
+__all__ = [
+    'CXX',
+    'CXXFLAGS',
+    'CC',
+    'CFLAGS',
+    'cache_dir',
+    'build_runtime',
+    'compile_cpp',
+    'compile_c',
+    'compile_units',
+    'compile_scheme'
+    ]
+
+CXX = 'g++'
+AR = 'ar'
+MAKE = 'make'
+NINJA = 'ninja'
+# the SCHEME_* macros (see scheme.h) belong here too, as the runtime must be
+# built with the same ones as the programs using it
+CXXFLAGS = ['-std=c++11', '-O2']
+# for the C backend, which also builds with tcc
+CC = 'cc'
+CFLAGS = ['-std=c99', '-O2']
+
+RUNTIME_FILES = ['scheme.h', 'scheme.cpp']
+
+
+def run(cmd, cwd=None):
+    try:
+        subprocess.check_output(cmd, stderr=subprocess.STDOUT, cwd=cwd)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError('command failed: {0}\n{1}'.format(
+            ' '.join(cmd), e.output.decode('utf-8', 'replace')))
+
+def build_runtime(cxx=CXX, flags=CXXFLAGS, pch=True, cache=None):
+    """Build the runtime library, libscheme.a, unless it has already been
+    built with the same compiler and flags.
+
+    @type cxx: String
+    @param cxx: The C++ compiler
+    @type flags: A list of Strings
+    @param flags: The flags to compile with
+    @type pch: Bool
+    @param pch: Whether to precompile scheme.h as well (as scheme.h.gch,
+        which g++ picks up in place of scheme.h)
+    @type cache: String
+    @param cache: The directory to build in, cache_dir() by default
+    @rtype: String
+    @return: The directory holding scheme.h and libscheme.a
+    """
+    key = hashlib.sha1()
+    for part in [cxx] + list(flags) + [str(pch)]:
+        key.update(part.encode('utf-8') + b'\0')
+    for name in RUNTIME_FILES:
+        with open(os.path.join(RUNTIME_DIR, name), 'rb') as f:
+            key.update(f.read())
+    parent = cache or cache_dir()
+    out = os.path.join(parent, 'runtime-' + key.hexdigest()[:16])
+    if os.path.exists(os.path.join(out, 'libscheme.a')):
+        return out
+    if not os.path.isdir(parent):
+        os.makedirs(parent)
+    # build somewhere private, so nobody sees a half built runtime
+    tmp = tempfile.mkdtemp(dir=parent)
+    try:
+        for name in RUNTIME_FILES:
+            shutil.copy(os.path.join(RUNTIME_DIR, name), tmp)
+        run([cxx] + list(flags) + ['-c', 'scheme.cpp', '-o', 'scheme.o'], cwd=tmp)
+        run([AR, 'rcs', 'libscheme.a', 'scheme.o'], cwd=tmp)
+        if pch:
+            run([cxx] + list(flags) + ['-x', 'c++-header', 'scheme.h', '-o', 'scheme.h.gch'], cwd=tmp)
+        try:
+            os.rename(tmp, out)
+        except OSError:
+            # someone else built it first
+            if not os.path.exists(os.path.join(out, 'libscheme.a')):
+                raise
+            shutil.rmtree(tmp)
+    except:
+        shutil.rmtree(tmp, ignore_errors=True)
+        raise
+    return out
+
+def compile_cpp(code, output, cxx=CXX, flags=CXXFLAGS, pch=True, cache=None):
+    """Compile code, as generated by gen_cpp(exp, standalone=False), to the
+    executable output, linking it with the runtime library.
+
+    The code is written next to the executable, to output + '.cpp'. The rest
+    of the parameters are those of build_runtime.
+    """
+    runtime = build_runtime(cxx, flags, pch, cache)
+    source = output + '.cpp'
+    with open(source, 'w') as f:
+        f.write(code)
+    run([cxx] + list(flags) + [
+        '-I', runtime,
+        source,
+        os.path.join(runtime, 'libscheme.a'),
+        '-o', output
+        ])
+    return output
+
+def compile_c(code, output, cc=CC, flags=CFLAGS):
+    """Compile code, as generated by gen_c(exp, standalone=False), to the
+    executable output, along with the C runtime.
+
+    The C runtime is small enough to compile with every program, so unlike
+    the C++ one it is not built into a library first. The code is written
+    next to the executable, to output + '.c'.
+
+    @type cc: String
+    @param cc: The C compiler, e.g. 'tcc' for the quickest builds
+    @type flags: A list of Strings
+    @param flags: The flags to compile with
+    """
+    source = output + '.c'
+    with open(source, 'w') as f:
+        f.write(code)
+    run([cc] + list(flags) + [
+        '-I', RUNTIME_DIR,
+        source,
+        os.path.join(RUNTIME_DIR, 'scheme_c.c'),
+        '-o', output
+        ])
+    return output
+
+def write_if_changed(path, text):
+    """Write text to the file path unless it holds text already, so that its
+    modification time only changes with its contents."""
+    try:
+        with open(path) as f:
+            if f.read() == text:
+                return
+    except (IOError, OSError):
+        pass
+    with open(path, 'w') as f:
+        f.write(text)
+
+def compile_units(files, output, jobs=None, tool='make', cxx=CXX, flags=CXXFLAGS, pch=True, cache=None):
+    """Compile files, as generated by gen_cpp_units, to the executable
+    output, building the translation units in parallel.
+
+    The files go in the directory output + '.d', along with the Makefile (or
+    build.ninja) building them. Files whose contents have not changed are
+    left alone, so building again only compiles the units that changed. The
+    rest of the parameters are those of build_runtime.
+
+    @type jobs: Int
+    @param jobs: How many units to compile at once, one per CPU by default
+    @type tool: String
+    @param tool: What runs the build, 'make' or 'ninja'
+    """
+    runtime = build_runtime(cxx, flags, pch, cache)
+    build = output + '.d'
+    if not os.path.isdir(build):
+        os.makedirs(build)
+    for name, text in files.items():
+        write_if_changed(os.path.join(build, name), text)
+    headers = [name for name in files if name.endswith('.h')]
+    objs = [name[:-len('.cpp')] + '.o' for name in files if name.endswith('.cpp')]
+    target = os.path.relpath(output, build)
+    cxx = ' '.join(shlex.quote(arg) for arg in [cxx] + list(flags))
+    lib = shlex.quote(os.path.join(runtime, 'libscheme.a'))
+    include = '-I ' + shlex.quote(runtime)
+    if tool == 'make':
+        # the objects depend on the Makefile too, so they are rebuilt when
+        # the flags change
+        write_if_changed(os.path.join(build, 'Makefile'), dedent('''\
+            {target}: {objs}
+            \t{cxx} {objs} {lib} -o $@
+            %.o: %.cpp {headers} Makefile
+            \t{cxx} {include} -c $< -o $@
+            ''').format(
+                target=target,
+                objs=' '.join(objs),
+                headers=' '.join(headers),
+                cxx=cxx,
+                lib=lib,
+                include=include
+                ))
+        cmd = [MAKE, '-j', str(jobs or os.cpu_count() or 1)]
+    elif tool == 'ninja':
+        write_if_changed(os.path.join(build, 'build.ninja'), dedent('''\
+            rule cxx
+              command = {cxx} {include} -c $in -o $out
+            rule link
+              command = {cxx} $in {lib} -o $out
+            {builds}
+            build {target}: link {objs}
+            ''').format(
+                target=target,
+                objs=' '.join(objs),
+                cxx=cxx,
+                lib=lib,
+                include=include,
+                builds='\n'.join(
+                    'build {0}: cxx {1} | {2}'.format(obj, obj[:-len('.o')] + '.cpp', ' '.join(headers))
+                    for obj in objs)
+                ))
+        cmd = [NINJA] + (['-j', str(jobs)] if jobs else [])
+    else:
+        raise RuntimeError('unknown build tool: {0}'.format(tool))
+    run(cmd, cwd=build)
+    return output
+
+def compile_scheme(source, output, options=None, units=None, cxx=CXX, flags=CXXFLAGS, pch=True, cache=None):
+    """Compile the Scheme program source to the executable output.
+
+    Whatever each stage produces (the AST, the optimized CPS, the C++ and the
+    executable) is kept in a Cache, keyed by a hash of the source, the
+    compiler and the options, so compiling the same program again starts
+    from the furthest stage already done. The parameters not described here
+    are those of build_runtime.
+
+    @type source: String
+    @param source: The text of the program
+    @type options: A dict
+    @param options: The keyword arguments to optimize
+    @type units: Int
+    @param units: How many translation units to split the lambdas over (see
+        compile_units), or None to compile a single file
+    @type cache: String
+    @param cache: The directory of the cache, cache_dir() by default
+    @rtype: String
+    @return: output
+    """
+    options = options or {}
+    store = Cache(cache)
+    ast_key = store.key(source)
+    cps_key = store.key(ast_key, sorted(options.items()))
+    cpp_key = store.key(cps_key, units)
+    bin_key = store.key(cpp_key, cxx, list(flags), pch)
+    binary = store.path('bin', bin_key)
+    if os.path.exists(binary):
+        shutil.copy(binary, output)
+        return output
+    code = store.load('cpp', cpp_key)
+    if code is None:
+        exp = store.load('cps', cps_key)
+        if exp is None:
+            tree = store.load('ast', ast_key)
+            if tree is None:
+                tree = store.store('ast', ast_key, ast(source))
+            exp = store.store('cps', cps_key, optimize(T_c(tree, halt), **options))
+        if units:
+            code = gen_cpp_units(exp, units)
+        else:
+            code = gen_cpp(exp, standalone=False)
+        store.store('cpp', cpp_key, code)
+    if units:
+        compile_units(code, output, cxx=cxx, flags=flags, pch=pch, cache=cache)
+    else:
+        compile_cpp(code, output, cxx, flags, pch, cache)
+    store.store_file('bin', bin_key, output)
+    return output
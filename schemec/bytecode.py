@@ -0,0 +1,325 @@
+from array import array
+import struct
+import sys
+
+from schemec.gencpp import Halt, inline_cont, sanitize
+from schemec.interp import halt_value, num_value, str_value
+from schemec.typs import (
+    VarExp,
+    NumExp,
+    BoolExp,
+    StrExp,
+    LamExp,
+    AppExp,
+    IfExp,
+    LetRecExp,
+    )
+
+__all__ = [
+    'Program',
+    'lower',
+    'execute',
+    'run'
+    ]
+
+# The instructions, each an opcode followed by its operands. Registers are
+# numbered within the frame of the running function: register 0 holds the
+# frame the function was created in, the next ones its arguments and the
+# rest its variables and temporaries.
+LOADK = 0     # dst, const: load a constant from the pool
+GETUP = 1     # dst, depth, reg: load a register of an enclosing frame
+CLOSURE = 2   # dst, func: create a closure of func in the current frame
+HALTK = 3     # dst: load the continuation the program finishes with
+MOVE = 4      # dst, src
+JZ = 5        # src, target: jump to target if src is zero
+CALL = 6      # func, nargs, arg...: tail call func
+ADD = 7       # dst, lhs, rhs
+SUB = 8       # dst, lhs, rhs
+MUL = 9       # dst, lhs, rhs
+EQ = 10       # dst, lhs, rhs
+ZERO = 11     # dst, src
+SAPPEND = 12  # dst, lhs, rhs
+SEQ = 13      # dst, lhs, rhs
+
+PRIMOPS = {
+    '+': ADD,
+    '-': SUB,
+    '*': MUL,
+    '=': EQ,
+    'zero?': ZERO,
+    'string-append': SAPPEND,
+    'string=?': SEQ
+    }
+
+MAGIC = b'SCMB\x01'
+
+class Program:
+    """A CPS program lowered to bytecode.
+
+    @type code: array('i')
+    @param code: The instructions of every function
+    @type consts: A list of ints and strs
+    @param consts: The constant pool
+    @type funcs: array('i')
+    @param funcs: The entry point, number of parameters and number of
+        registers of each function, one after the other. Function 0 is the
+        program itself.
+    """
+    def __init__(self, code, consts, funcs):
+        self.code = code
+        self.consts = consts
+        self.funcs = funcs
+
+    def dumps(self):
+        """The program as bytes, for loads."""
+        out = [MAGIC, struct.pack('<III', len(self.consts), len(self.funcs), len(self.code))]
+        for const in self.consts:
+            if isinstance(const, str):
+                data = const.encode('utf-8')
+                out.append(b's' + struct.pack('<I', len(data)) + data)
+            else:
+                out.append(b'i' + struct.pack('<q', const))
+        for ints in (self.funcs, self.code):
+            ints = array('i', ints)
+            if sys.byteorder != 'little':
+                ints.byteswap()
+            out.append(ints.tobytes())
+        return b''.join(out)
+
+    @classmethod
+    def loads(cls, data):
+        """The program data, as made by dumps, holds."""
+        if data[:len(MAGIC)] != MAGIC:
+            raise RuntimeError('not a compiled Scheme program')
+        pos = len(MAGIC)
+        nconsts, nfuncs, ncode = struct.unpack_from('<III', data, pos)
+        pos += 12
+        consts = []
+        for _ in range(nconsts):
+            tag = data[pos:pos + 1]
+            if tag == b's':
+                size, = struct.unpack_from('<I', data, pos + 1)
+                consts.append(data[pos + 5:pos + 5 + size].decode('utf-8'))
+                pos += 5 + size
+            else:
+                consts.append(struct.unpack_from('<q', data, pos + 1)[0])
+                pos += 9
+        ints = []
+        for size in (nfuncs, ncode):
+            part = array('i')
+            part.frombytes(data[pos:pos + size * part.itemsize])
+            if sys.byteorder != 'little':
+                part.byteswap()
+            ints.append(part)
+            pos += size * part.itemsize
+        funcs, code = ints
+        return cls(code, consts, funcs)
+
+def lower(exp):
+    """Lower the CPS program exp, as compiled by T_c(..., halt) and perhaps
+    optimized, to a Program."""
+    # give each binding a name of its own, so that each can have a register
+    # of its own: continuations compiled in place bind their variables in
+    # the frame around them, whose dict of registers the lambdas it creates
+    # keep in their scope
+    exp = sanitize(exp)
+    code = array('i')
+    consts = []
+    const_ids = {}
+    funcs = []
+    # the lambdas still to lower, with their function number and scope
+    todo = [(None, 0, ())]
+    funcs.append(None)
+
+    def const(val):
+        key = (type(val), val)
+        if key not in const_ids:
+            const_ids[key] = len(consts)
+            consts.append(val)
+        return const_ids[key]
+
+    def lower_func(lam, scope):
+        """Lower the body of lam (or the whole program if lam is None),
+        which sees the variables of scope, a tuple of the dicts from
+        variable name to register of the enclosing frames. Return the number
+        of registers it uses."""
+        regs = {}
+        if lam is not None:
+            for arg in lam.argExps:
+                regs[arg.name] = len(regs) + 1
+        scope = scope + (regs,)
+        nregs = [len(regs) + 1]
+
+        def new_reg(name=None):
+            reg = nregs[0]
+            nregs[0] += 1
+            if name is not None:
+                regs[name] = reg
+            return reg
+
+        def atom(exp):
+            """A register holding the value of the atomic expression exp."""
+            if isinstance(exp, Halt):
+                reg = new_reg()
+                code.extend([HALTK, reg])
+            elif isinstance(exp, LamExp):
+                reg = new_reg()
+                code.extend([CLOSURE, reg, len(funcs)])
+                todo.append((exp, len(funcs), scope))
+                funcs.append(None)
+            elif isinstance(exp, VarExp):
+                for depth, names in enumerate(reversed(scope)):
+                    if exp.name in names:
+                        if depth == 0:
+                            return names[exp.name]
+                        reg = new_reg()
+                        code.extend([GETUP, reg, depth, names[exp.name]])
+                        break
+                else:
+                    raise RuntimeError('unbound variable: {0}'.format(exp.name))
+            elif isinstance(exp, (NumExp, BoolExp, StrExp)):
+                if isinstance(exp, NumExp):
+                    val = num_value(exp)
+                elif isinstance(exp, BoolExp):
+                    val = 1 if exp.val else 0
+                else:
+                    val = str_value(exp)
+                reg = new_reg()
+                code.extend([LOADK, reg, const(val)])
+            else:
+                raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
+            return reg
+
+        def body(exp):
+            while True:
+                if isinstance(exp, AppExp):
+                    func = exp.funcExp
+                    name = func.name if isinstance(func, VarExp) else None
+                    if name in PRIMOPS:
+                        operands = [atom(arg) for arg in exp.argExps[:-1]]
+                        cont = exp.argExps[-1]
+                        if inline_cont(exp):
+                            # bind the result to the continuation's
+                            # parameter and carry on with its body right here
+                            dst = new_reg(cont.argExps[0].name)
+                            exp = cont.bodyExp
+                        else:
+                            # no variable has a space in its name
+                            var = VarExp('prim {0}'.format(nregs[0]))
+                            dst = new_reg(var.name)
+                            exp = AppExp(cont, var)
+                        code.extend([PRIMOPS[name], dst] + operands)
+                        continue
+                    func = atom(func)
+                    args = [atom(arg) for arg in exp.argExps]
+                    code.extend([CALL, func, len(args)] + args)
+                    return
+                elif isinstance(exp, IfExp):
+                    cond = atom(exp.condExp)
+                    code.extend([JZ, cond, 0])
+                    jump = len(code) - 1
+                    body(exp.thenExp)
+                    code[jump] = len(code)
+                    exp = exp.elseExp
+                elif isinstance(exp, LetRecExp):
+                    # the closures hold the frame, not the values of its
+                    # registers, so they see the ones bound after them
+                    for var, _ in exp.bindings:
+                        new_reg(var.name)
+                    for var, val in exp.bindings:
+                        code.extend([MOVE, regs[var.name], atom(val)])
+                    exp = exp.bodyExp
+                else:
+                    raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
+
+        body(exp if lam is None else lam.bodyExp)
+        return nregs[0]
+
+    while todo:
+        lam, func, scope = todo.pop()
+        entry = len(code)
+        nregs = lower_func(lam, scope)
+        funcs[func] = (entry, 0 if lam is None else len(lam.argExps), nregs)
+    return Program(code, consts, array('i', [n for func in funcs for n in func]))
+
+class Closure:
+    """A function of a Program together with the frame it was created in."""
+    __slots__ = ('func', 'env')
+    def __init__(self, func, env):
+        self.func = func
+        self.env = env
+    def __repr__(self):
+        return '<closure>'
+
+def execute(program):
+    """Run program and return the value it halts with: an int (for numbers
+    and Booleans alike), a str or a Closure."""
+    # a list is quicker to index than an array, which makes a new int each
+    # time
+    code = list(program.code)
+    consts = program.consts
+    funcs = list(program.funcs)
+    halt = object()
+    pc = funcs[0]
+    regs = [None] * funcs[2]
+    while True:
+        op = code[pc]
+        if op == CALL:
+            func = regs[code[pc + 1]]
+            nargs = code[pc + 2]
+            args = [regs[reg] for reg in code[pc + 3:pc + 3 + nargs]]
+            if func is halt:
+                return args[0]
+            elif not isinstance(func, Closure):
+                raise RuntimeError('error: calling a non-lambda: {0!r}'.format(func))
+            i = func.func * 3
+            if nargs != funcs[i + 1]:
+                raise RuntimeError('error: lambda called with an improper number of arguments')
+            regs = [func.env] + args
+            regs.extend([None] * (funcs[i + 2] - nargs - 1))
+            pc = funcs[i]
+        elif op == LOADK:
+            regs[code[pc + 1]] = consts[code[pc + 2]]
+            pc += 3
+        elif op == GETUP:
+            env = regs
+            for _ in range(code[pc + 2]):
+                env = env[0]
+            regs[code[pc + 1]] = env[code[pc + 3]]
+            pc += 4
+        elif op == JZ:
+            pc = code[pc + 2] if regs[code[pc + 1]] == 0 else pc + 3
+        elif op == ZERO:
+            regs[code[pc + 1]] = 1 if regs[code[pc + 2]] == 0 else 0
+            pc += 3
+        elif op == ADD:
+            regs[code[pc + 1]] = regs[code[pc + 2]] + regs[code[pc + 3]]
+            pc += 4
+        elif op == SUB:
+            regs[code[pc + 1]] = regs[code[pc + 2]] - regs[code[pc + 3]]
+            pc += 4
+        elif op == MUL:
+            regs[code[pc + 1]] = regs[code[pc + 2]] * regs[code[pc + 3]]
+            pc += 4
+        elif op == EQ or op == SEQ:
+            regs[code[pc + 1]] = 1 if regs[code[pc + 2]] == regs[code[pc + 3]] else 0
+            pc += 4
+        elif op == CLOSURE:
+            regs[code[pc + 1]] = Closure(code[pc + 2], regs)
+            pc += 3
+        elif op == MOVE:
+            regs[code[pc + 1]] = regs[code[pc + 2]]
+            pc += 3
+        elif op == SAPPEND:
+            regs[code[pc + 1]] = regs[code[pc + 2]] + regs[code[pc + 3]]
+            pc += 4
+        elif op == HALTK:
+            regs[code[pc + 1]] = halt
+            pc += 2
+        else:
+            raise RuntimeError('invalid instruction: {0}'.format(op))
+
+def run(program, out=None):
+    """Run program as its C++ would: print the value it halts with to out
+    (stdout by default) and return the exit status."""
+    return halt_value(execute(program), out)
@@ -0,0 +1,105 @@
+import hashlib
+import os
+import pickle
+import shutil
+import tempfile
+
+__all__ = [
+    'Cache',
+    'cache_dir',
+    'compiler_version'
+    ]
+
+PACKAGE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+_version = None
+
+def cache_dir():
+    """The directory the cache and built runtimes are kept in:
+    $SCHEMEC_CACHE, or else schemec under $XDG_CACHE_HOME or ~/.cache."""
+    if os.environ.get('SCHEMEC_CACHE'):
+        return os.environ['SCHEMEC_CACHE']
+    root = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(root, 'schemec')
+
+def compiler_version():
+    """A hash of the compiler's own code (including the runtimes), which
+    changes whenever anything it generates might."""
+    global _version
+    if _version is None:
+        key = hashlib.sha1()
+        for root, dirs, files in os.walk(PACKAGE_DIR):
+            dirs[:] = sorted(d for d in dirs if d != '__pycache__')
+            for name in sorted(files):
+                if name.endswith(('.py', '.h', '.c', '.cpp')):
+                    path = os.path.join(root, name)
+                    key.update(os.path.relpath(path, PACKAGE_DIR).encode('utf-8') + b'\0')
+                    with open(path, 'rb') as f:
+                        key.update(f.read())
+        _version = key.hexdigest()
+    return _version
+
+class Cache:
+    """A content-addressed store of what the stages of the compiler produce.
+
+    Each entry belongs to a stage (e.g. 'ast' or 'cpp') and is found by a key,
+    a hash of everything the stage's output depends on. Entries are never
+    changed once written, so they can be shared by concurrent compilers.
+
+    @type root: String
+    @param root: The directory the entries are kept in, cache_dir() by
+        default
+    """
+    def __init__(self, root=None):
+        self.root = root or cache_dir()
+
+    @staticmethod
+    def key(*parts):
+        """The key of an output depending on parts, which are strings or
+        anything with a deterministic repr, and on the compiler itself."""
+        key = hashlib.sha1(compiler_version().encode('utf-8'))
+        for part in parts:
+            if not isinstance(part, str):
+                part = repr(part)
+            key.update(part.encode('utf-8') + b'\0')
+        return key.hexdigest()
+
+    def path(self, stage, key):
+        """Where the entry of stage under key is, whether or not it exists."""
+        return os.path.join(self.root, stage, key[:2], key[2:])
+
+    def load(self, stage, key):
+        """The object stored under key, or None if there is none."""
+        try:
+            with open(self.path(stage, key), 'rb') as f:
+                return pickle.load(f)
+        except (IOError, OSError):
+            return None
+
+    def store(self, stage, key, obj):
+        """Store the object obj, which must be picklable, under key."""
+        self._write(stage, key, lambda f: pickle.dump(obj, f, pickle.HIGHEST_PROTOCOL))
+        return obj
+
+    def store_file(self, stage, key, path):
+        """Store a copy of the file at path, keeping its mode, under key."""
+        def copy(f):
+            with open(path, 'rb') as src:
+                shutil.copyfileobj(src, f)
+            shutil.copymode(path, f.name)
+        self._write(stage, key, copy)
+
+    def _write(self, stage, key, write):
+        out = self.path(stage, key)
+        parent = os.path.dirname(out)
+        if not os.path.isdir(parent):
+            os.makedirs(parent, exist_ok=True)
+        # write somewhere private, so nobody sees a half written entry
+        fd, tmp = tempfile.mkstemp(dir=parent)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                write(f)
+            os.replace(tmp, out)
+        except:
+            os.unlink(tmp)
+            raise
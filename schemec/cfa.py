@@ -0,0 +1,222 @@
+from collections import OrderedDict
+
+from schemec.typs import (
+    AtomicExp,
+    VarExp,
+    LamExp,
+    AppExp,
+    IfExp,
+    LetRecExp,
+    BeginExp,
+    SetExp,
+    SetThenExp
+    )
+
+__all__ = ['CFA', 'unknown']
+
+
+# stands for any value we cannot see being created, e.g. a free variable
+unknown = None
+# collects everything handed to code we cannot see
+_escape_sink = VarExp('')
+
+
+################################################################################
+## 0-CFA
+################################################################################
+
+class CFA:
+    """A whole-program 0-CFA over CPS expressions.
+
+    Every variable is given the set of lambdas it may be bound to, no matter
+    which activation binds it. The sets grow monotonically; a worklist of the
+    variables whose sets changed drives propagation along subset edges and
+    into the call sites that use them. Each variable keeps the values it
+    gained since it was last taken off the worklist, and only those are
+    pushed along its edges, so every value crosses every edge once.
+
+    Lambdas are tracked by identity, so copies that share a name (and thus a
+    generated class) stay distinct. A variable bound nowhere in the program
+    holds `unknown`, and any lambda passed to an unknown callee escapes: its
+    parameters become `unknown` too.
+
+    @type rootExp: A CPS expression
+    @param rootExp: The whole program
+    @type ignore: A function from String -> Bool
+    @param ignore: Names of primitive operations, which never call a lambda
+        other than their continuation
+    @type opaque: A tuple of types
+    @param opaque: Lambda types whose bodies should not be analysed
+    """
+    def __init__(self, rootExp, ignore=None, opaque=()):
+        self.ignore = ignore if ignore is not None else lambda name: False
+        self.opaque = opaque
+        self.flow = {}
+        self.sites = []
+        self._bound = set()
+        self._used = set()
+        self._edges = {}
+        self._pending = {}
+        self._calls = {}
+        self._linked = {}
+        self._callers = {}
+        self._escaped = set()
+        self._worklist = []
+        self._walk(rootExp)
+        for var in self._used - self._bound:
+            self._add(var, unknown)
+        for site in self.sites:
+            self._link(site)
+        self._solve()
+
+    def values(self, exp):
+        """The lambdas an atomic expression may evaluate to.
+
+        @rtype: A tuple of LamExps, which contains `unknown` if exp may be
+            something not created in the program
+        """
+        if isinstance(exp, VarExp):
+            return tuple(self.flow.get(exp, {}).values())
+        elif isinstance(exp, LamExp):
+            return (exp,)
+        elif isinstance(exp, AtomicExp):
+            return ()
+        else:
+            return (unknown,)
+
+    def targets(self, app):
+        """The lambdas that may be called at the call site app."""
+        if self.is_primop(app):
+            return ()
+        return self.values(app.funcExp)
+
+    def target(self, app):
+        """The only lambda called at app, or None if that is not known."""
+        targets = self.targets(app)
+        if (len(targets) == 1 and
+            targets[0] is not unknown and
+            len(targets[0].argExps) == len(app.argExps)):
+            return targets[0]
+        else:
+            return None
+
+    def callers(self, lam):
+        """The call sites that may call lam."""
+        return list(self._callers.get(id(lam), []))
+
+    def escapes(self, lam):
+        """Whether lam may be called from code we cannot see."""
+        return id(lam) in self._escaped
+
+    def is_primop(self, app):
+        return isinstance(app.funcExp, VarExp) and self.ignore(app.funcExp.name)
+
+    def _walk(self, exp):
+        if isinstance(exp, VarExp):
+            if not self.ignore(exp.name):
+                self._used.add(exp)
+        elif isinstance(exp, LamExp):
+            self._bound.update(exp.argExps)
+            if not isinstance(exp, self.opaque):
+                self._walk(exp.bodyExp)
+        elif isinstance(exp, AtomicExp):
+            pass
+        elif isinstance(exp, AppExp):
+            self.sites.append(exp)
+            self._walk(exp.funcExp)
+            for arg in exp.argExps:
+                self._walk(arg)
+        elif isinstance(exp, IfExp):
+            self._walk(exp.condExp)
+            self._walk(exp.thenExp)
+            self._walk(exp.elseExp)
+        elif isinstance(exp, LetRecExp):
+            for var, val in exp.bindings:
+                self._bound.add(var)
+                self._walk(val)
+                self._flows(val, var)
+            self._walk(exp.bodyExp)
+        elif isinstance(exp, BeginExp):
+            for e in exp.exps:
+                self._walk(e)
+        elif isinstance(exp, (SetExp, SetThenExp)):
+            self._walk(exp.exp)
+            self._flows(exp.exp, exp.varExp)
+            if isinstance(exp, SetThenExp):
+                self._walk(exp.thenExp)
+        else:
+            raise TypeError(exp)
+
+    def _flows(self, exp, var):
+        """Record that the values of exp flow into var."""
+        if not isinstance(var, VarExp):
+            return
+        if isinstance(exp, VarExp):
+            if self.ignore(exp.name):
+                return
+            # a dict keeps the order the edges were found in, and each edge
+            # once however many call sites make it
+            self._edges.setdefault(exp, OrderedDict())[var] = None
+            for lam in self.values(exp):
+                self._add(var, lam)
+        else:
+            for lam in self.values(exp):
+                self._add(var, lam)
+
+    def _add(self, var, lam):
+        key = id(lam) if lam is not unknown else None
+        values = self.flow.setdefault(var, OrderedDict())
+        if key not in values:
+            values[key] = lam
+            if var not in self._pending:
+                self._pending[var] = []
+                self._worklist.append(var)
+            self._pending[var].append(lam)
+
+    def _link(self, site):
+        if self.is_primop(site):
+            return
+        func = site.funcExp
+        if isinstance(func, VarExp):
+            self._calls.setdefault(func, []).append(site)
+        for lam in self.values(func):
+            self._call(site, lam)
+
+    def _call(self, site, lam):
+        key = id(lam) if lam is not unknown else None
+        linked = self._linked.setdefault(id(site), set())
+        if key in linked:
+            return
+        linked.add(key)
+        if lam is unknown:
+            for arg in site.argExps:
+                self._flows(arg, _escape_sink)
+            return
+        self._callers.setdefault(key, []).append(site)
+        if len(lam.argExps) != len(site.argExps):
+            return
+        for param, arg in zip(lam.argExps, site.argExps):
+            self._flows(arg, param)
+
+    def _escape(self, lam):
+        if lam is unknown or id(lam) in self._escaped:
+            return
+        self._escaped.add(id(lam))
+        for param in lam.argExps:
+            if isinstance(param, VarExp):
+                self._add(param, unknown)
+
+    def _solve(self):
+        while self._worklist:
+            var = self._worklist.pop()
+            # what var gained since it was queued; the rest went out before
+            values = self._pending.pop(var)
+            for dst in self._edges.get(var, ()):
+                for lam in values:
+                    self._add(dst, lam)
+            for site in self._calls.get(var, []):
+                for lam in values:
+                    self._call(site, lam)
+            if var is _escape_sink:
+                for lam in values:
+                    self._escape(lam)
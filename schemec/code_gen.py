@@ -52,7 +52,7 @@ class CodeGenerator():
             self.sprimitives.keys()
             )
         self.retExp = LamExp([self.rv], self.rv)
-        self.declareCode = ''
+        self.declareCode = []
         self.argVars = [VarExp('_args[{0}]'.format(i)) for i in range(10)]
         self.ivars.update(self.argVars)
         self.lam_holes = {}
@@ -92,7 +92,7 @@ class CodeGenerator():
                         ', '.join('std::unique_ptr<schemetype_t*>' for _ in range(i)),
                         i) for i in range(maxvars)
                     ),
-                declarations=self.declareCode,
+                declarations=''.join(self.declareCode),
                 body=body
                 )
 
@@ -397,7 +397,8 @@ class CodeGenerator():
     """
     def declareVar(self, var, val=None):
         if val is None:
-            self.declareCode += '  schemetype_t {0};\n'.format(var.name) if var not in self.ivars | self.svars else ''
+            if var not in self.ivars | self.svars:
+                self.declareCode.append('  schemetype_t {0};\n'.format(var.name))
             self.ivars.add(var)
         else:
             if isinstance(val, VarExp):
@@ -414,11 +415,11 @@ class CodeGenerator():
                 val = val.val
             else:
                 raise RuntimeError('unhandled AtomicExp in declareVar()')
-            self.declareCode += '  schemetype_t {0}{1} = {2};\n'.format(
+            self.declareCode.append('  schemetype_t {0}{1} = {2};\n'.format(
                 var.name,
                 suffix,
                 val
-                )
+                ))
 
     """
     Translates the given if expression into C such that the result of the
@@ -20,13 +20,13 @@ def T_k(exp, k):
         return k(M(exp))
     elif isinstance(exp, AppExp):
         _rv = gensym('$rv')
-        cont = LamExp([_rv], k(_rv))
+        cont = LamExp([_rv], k(_rv), exp.pos)
         return T_c(exp, cont)
     elif isinstance(exp, IfExp):
         ce = exp.condExp
         te = exp.thenExp
         ee = exp.elseExp
-        return T_k(ce, lambda _ce: IfExp(_ce, T_k(te, k), T_k(ee, k)))
+        return T_k(ce, lambda _ce: IfExp(_ce, T_k(te, k), T_k(ee, k), exp.pos))
     elif isinstance(exp, LetRecExp):
         bs = exp.bindings
         be = exp.bodyExp
@@ -59,15 +59,16 @@ def T_c(exp, c):
         es = exp.argExps
         return T_k(f, lambda _f:
                    Tx_k(es, lambda _es:
-                        AppExp(_f, *(_es + [c]))))
+                        AppExp(_f, *(_es + [c]), pos=exp.pos)))
     elif isinstance(exp, IfExp):
         ce = exp.condExp
         te = exp.thenExp
         ee = exp.elseExp
         _k = gensym('$k')
         return AppExp(LamExp([_k], T_k(ce, lambda _ce:
-                                       IfExp(_ce, T_c(te, _k), T_c(ee, _k)))),
-                             c)
+                                       IfExp(_ce, T_c(te, _k), T_c(ee, _k), exp.pos)),
+                             exp.pos),
+                      c, pos=exp.pos)
     elif isinstance(exp, LetRecExp):
         bs = exp.bindings
         be = exp.bodyExp
@@ -108,7 +109,8 @@ def M(exp):
         body = exp.bodyExp
         _k = gensym('$k')
         return LamExp(args + [_k],
-                      T_c(body, _k))
+                      T_c(body, _k),
+                      exp.pos)
     elif isinstance(exp, AtomicExp):
         return exp
     else:
@@ -0,0 +1,86 @@
+from io import StringIO
+
+__all__ = [
+    'Emitter'
+    ]
+
+
+################################################################################
+## C++ output
+################################################################################
+
+class Emitter:
+    """Write C++ to a file a line at a time, indenting each line by how deeply
+    it is nested in braces.
+
+    The indentation of the text given is ignored, so code can be written
+    without regard to where it ends up. Preprocessor directives are never
+    indented, and case and access labels are indented by half a level less
+    than the code around them. Every line is written once, as soon as it is
+    given, so emitting a program takes time linear in its size.
+
+    @type out: A file-like object
+    @param out: Where to write, a new StringIO if None
+    @type nspace: Int
+    @param nspace: The number of spaces per level of indentation
+    """
+    TERMINATORS = (' ', '\t', ':')
+
+    def __init__(self, out=None, nspace=2):
+        self.out = out if out is not None else StringIO()
+        self.nspace = nspace
+        self.depth = 0
+
+    def write(self, text):
+        """Write text, any number of lines of C++."""
+        for line in text.splitlines():
+            self.line(line)
+
+    def verbatim(self, text):
+        """Write text as it is, e.g. a file of C++ that is already formatted.
+        Its braces must balance."""
+        self.out.write(text + '\n')
+
+    def emit(self, chunk):
+        """Write chunk, a string of C++ or anything else with an emit method
+        taking an Emitter. Empty chunks write nothing."""
+        if not chunk:
+            return
+        elif isinstance(chunk, str):
+            self.write(chunk)
+        else:
+            chunk.emit(self)
+
+    def line(self, line):
+        """Write a single line of C++."""
+        line = line.strip()
+        j = 0
+        if line[:1] == '}':
+            self.depth -= 1
+            j = 1
+        if line[:1] == '#':
+            prefix = ''
+        elif self._is_label(line):
+            prefix = ' ' * (self.nspace * self.depth - self.nspace // 2)
+        else:
+            prefix = ' ' * (self.nspace * self.depth)
+        self.out.write(prefix + line + '\n' if line else '\n')
+        for char in line[j:]:
+            if char == '{':
+                self.depth += 1
+            elif char == '}':
+                self.depth -= 1
+
+    def getvalue(self):
+        """Everything written so far, if out is a StringIO."""
+        return self.out.getvalue()
+
+    @classmethod
+    def _is_label(cls, line):
+        lower = line.lower()
+        return (
+            lower[:5] == 'case ' or
+            (lower[:6] == 'public' and line[6:7] in cls.TERMINATORS) or
+            (lower[:7] == 'default' and line[7:8] in cls.TERMINATORS) or
+            (lower[:7] == 'private' and line[7:8] in cls.TERMINATORS)
+            )
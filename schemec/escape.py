@@ -0,0 +1,103 @@
+from schemec.typs import (
+    VarExp,
+    LamExp,
+    AppExp,
+    LetRecExp
+    )
+
+__all__ = ['Escape']
+
+
+################################################################################
+## Escape analysis
+################################################################################
+
+class Escape:
+    """Which closures cannot outlive the activation that creates them.
+
+    Every call in a CPS program is a tail call, so an activation ends as soon
+    as it has picked the next lambda to run. A closure survives that if it is
+    passed anywhere, captured, or called in a way that may hand it back to
+    the trampoline, which leaves two kinds of closures that do not:
+
+      - those created by the top level of the program, whose activation only
+        ends when the program does;
+      - those bound by a letrec that only ever appear as the callee of a call
+        made from the code of the activation binding them, with that letrec
+        binding as the only lambda it may call, or of a call that jumps into
+        the code of a loop instead of calling a closure at all.
+
+    A closure of the second kind runs, and finishes, before its creator does,
+    as long as such calls are always made directly, never through the
+    trampoline.
+
+    @type rootExp: A CPS expression
+    @param rootExp: The whole program
+    @type cfa: CFA
+    @param cfa: The control flow analysis of rootExp
+    @type inline: A function from AppExp -> Bool
+    @param inline: Whether the literal continuation of a call is compiled
+        into the code of the activation making it, rather than into a closure
+    @type jumps: A collection of ids of AppExps
+    @param jumps: The calls that jump to their callee's code in place
+    """
+    def __init__(self, rootExp, cfa, inline, jumps):
+        self.cfa = cfa
+        self._local = set()
+        self._direct = set()
+        uses = {}
+        bound_to = {}
+        created = []
+        frames = [(None, rootExp)]
+        while frames:
+            frame, exp = frames.pop()
+            todo = [exp]
+            while todo:
+                exp = todo.pop()
+                if isinstance(exp, VarExp):
+                    uses.setdefault(exp, []).append((frame, None))
+                elif isinstance(exp, LamExp):
+                    if not isinstance(exp, cfa.opaque):
+                        created.append((frame, exp))
+                        frames.append((exp, exp.bodyExp))
+                elif isinstance(exp, AppExp):
+                    if inline(exp):
+                        todo.extend(exp.argExps[:-1])
+                        todo.append(exp.argExps[-1].bodyExp)
+                        continue
+                    if isinstance(exp.funcExp, VarExp):
+                        uses.setdefault(exp.funcExp, []).append((frame, exp))
+                    else:
+                        todo.append(exp.funcExp)
+                    todo.extend(exp.argExps)
+                elif isinstance(exp, LetRecExp):
+                    for var, val in exp.bindings:
+                        bound_to[id(val)] = var
+                    todo.extend(exp.children())
+                else:
+                    todo.extend(exp.children())
+        for frame, lam in created:
+            if frame is None:
+                self._local.add(id(lam))
+                continue
+            var = bound_to.get(id(lam))
+            if var is None:
+                continue
+            if all(site is not None and
+                   (id(site) in jumps or
+                    use_frame is frame and cfa.target(site) is lam)
+                   for use_frame, site in uses.get(var, [])):
+                self._local.add(id(lam))
+                self._direct.add(id(lam))
+
+    def local(self, lam):
+        """Whether the closure lam is dead once its creator returns."""
+        return id(lam) in self._local
+
+    def escapes(self, lam):
+        return id(lam) not in self._local
+
+    def direct_only(self, lam):
+        """Whether lam is local to an activation other than the top level,
+        so calls to it must never go through the trampoline."""
+        return id(lam) in self._direct
@@ -6,7 +6,7 @@ from schemec.cps import T_c
 from schemec.gencpp import halt, gen_cpp, pretty_cpp
 from schemec.opt import optimize
 
-def main():
+def main(argv):
     fac5 = dedent('''\
     ;; factorial : number -> number
     ;; to calculate the product of all positive
@@ -30,7 +30,12 @@ def main():
                     #f
                     (even? (- n 1))))))
       (even? 87))''')
-    e = fac5 # evenodd
+    # the inner z shadows the outer one only within its own lambda
+    shadow = dedent('''\
+    (letrec ((twice (lambda (f x) (f (f x)))))
+      (twice (lambda (z) (twice (lambda (z) 17) z)) 11))''')
+    examples = {'fac5': fac5, 'evenodd': evenodd, 'shadow': shadow}
+    e = examples[argv[1] if len(argv) > 1 else 'fac5']
 #     print('; original')
 #     print(e)
 #     print('; parsed')
@@ -49,4 +54,4 @@ def main():
 
 if __name__ == '__main__':
     import sys
-    sys.exit(main())
+    sys.exit(main(sys.argv))
@@ -0,0 +1,99 @@
+from schemec.typs import (
+    AtomicExp,
+    VarExp,
+    LamExp,
+    AppExp,
+    IfExp,
+    LetRecExp,
+    BeginExp,
+    SetExp,
+    SetThenExp
+    )
+
+__all__ = ['FreeVars']
+
+
+################################################################################
+## Free variable analysis
+################################################################################
+
+class FreeVars:
+    """The free variables of every node in an expression tree.
+
+    The variables of a node are computed once from those of its children, so
+    analysing a whole program is linear in its size. Results are cached per
+    node and returned in order of first occurrence, which keeps anything
+    generated from them deterministic.
+
+    @type ignore: A function from String -> Bool
+    @param ignore: Names that are never free (e.g. primitive operations)
+    @type opaque: A tuple of types
+    @param opaque: Node types that are closed no matter what they contain
+    """
+    def __init__(self, ignore=None, opaque=()):
+        self.ignore = ignore if ignore is not None else lambda name: False
+        self.opaque = opaque
+        self._cache = {}
+        self._lams = []
+
+    def __call__(self, exp):
+        """The free variables of exp, as a tuple of VarExps."""
+        return tuple(self._free(exp))
+
+    def lambdas(self):
+        """Iterate over (LamExp, free variables) for every lambda seen so far."""
+        for lam in self._lams:
+            yield lam, self(lam)
+
+    def _free(self, exp):
+        try:
+            return self._cache[id(exp)][1]
+        except KeyError:
+            pass
+        if isinstance(exp, LamExp):
+            self._lams.append(exp)
+        if isinstance(exp, self.opaque):
+            fvs = {}
+        elif isinstance(exp, VarExp):
+            fvs = {} if self.ignore(exp.name) else {exp: None}
+        elif isinstance(exp, LamExp):
+            fvs = self._bind(self._free(exp.bodyExp), exp.argExps)
+        elif isinstance(exp, AtomicExp):
+            fvs = {}
+        elif isinstance(exp, AppExp):
+            fvs = self._union([exp.funcExp] + list(exp.argExps))
+        elif isinstance(exp, IfExp):
+            fvs = self._union([exp.condExp, exp.thenExp, exp.elseExp])
+        elif isinstance(exp, LetRecExp):
+            fvs = self._union([val for _, val in exp.bindings] + [exp.bodyExp])
+            fvs = self._bind(fvs, [var for var, _ in exp.bindings])
+        elif isinstance(exp, BeginExp):
+            fvs = self._union(exp.exps)
+        elif isinstance(exp, SetExp):
+            fvs = self._union([exp.varExp, exp.exp])
+        elif isinstance(exp, SetThenExp):
+            fvs = self._union([exp.varExp, exp.exp, exp.thenExp])
+        else:
+            raise TypeError(exp)
+        # keep exp alive so its id is not reused while cached
+        self._cache[id(exp)] = (exp, fvs)
+        return fvs
+
+    def _union(self, exps):
+        # cached sets are never mutated, so a lone non-empty one can be shared
+        nonempty = [fvs for fvs in map(self._free, exps) if fvs]
+        if len(nonempty) == 1:
+            return nonempty[0]
+        fvs = {}
+        for child in nonempty:
+            fvs.update(child)
+        return fvs
+
+    @staticmethod
+    def _bind(fvs, varExps):
+        bound = [var for var in varExps if var in fvs]
+        if bound:
+            fvs = dict(fvs)
+            for var in bound:
+                del fvs[var]
+        return fvs
@@ -0,0 +1,220 @@
+from collections import OrderedDict
+
+from schemec.emit import Emitter
+from schemec.gencpp import (
+    Halt,
+    MAX_ARGS,
+    compute_holes,
+    inline_cont,
+    num_literal,
+    read_runtime,
+    sanitize,
+    )
+from schemec.typs import (
+    GenSym,
+    VarExp,
+    NumExp,
+    BoolExp,
+    StrExp,
+    LamExp,
+    AppExp,
+    IfExp,
+    LetRecExp,
+    )
+
+__all__ = [
+    'gen_c'
+    ]
+
+# how each primitive operation computes its result (see scheme_c.h)
+PRIM_OPS = {
+    '+': 'num_add({0}, {1})',
+    '-': 'num_sub({0}, {1})',
+    '*': 'num_mul({0}, {1})',
+    '=': 'num_eq({0}, {1})',
+    'zero?': 'num_zero({0})',
+    'string-append': 'str_append({0}, {1})',
+    'string=?': 'str_eq({0}, {1})'
+    }
+
+def gen_c(exp, standalone=True, out=None, nspace=2):
+    """Compile the CPS program exp to C99.
+
+    Each lambda becomes a C function, its entry, taking the closure it is
+    called through; a closure is a struct holding the entry and the
+    variables the lambda captures. A call leaves its arguments in _argv and
+    returns the closure to the trampoline, which calls its entry. Every value
+    is a tagged word, and the code is compiled as it is, without the
+    analyses gen_cpp makes to keep values unboxed, so it builds quickly with
+    any C compiler.
+
+    @type standalone: Bool
+    @param standalone: Whether to copy the runtime into the program, rather
+        than include scheme_c.h and leave it to be linked with scheme_c.c
+        (see schemec.build)
+    @type out: A file-like object
+    @param out: Where to write the program, which is returned as a String if
+        None
+    @type nspace: Int
+    @param nspace: The number of spaces per level of indentation
+    """
+    exp = sanitize(exp)
+    gensym = GenSym()
+    holes = compute_holes(exp)
+    # the values that never change, created once at startup: string
+    # literals, and lambdas without holes
+    pool = OrderedDict()
+    literals = {}
+    # the lambdas still to compile, and the code of those compiled
+    todo = []
+    funcs = OrderedDict()
+
+    def literal(val):
+        """The constant holding the string literal val."""
+        if val not in literals:
+            code = literals[val] = '_const_{0}'.format(len(literals) + 1)
+            pool[code] = 'make_str({0}, sizeof({0}) - 1)'.format(val)
+        return literals[val]
+
+    def closure(exp, lines):
+        """Create the closure exp, returning the C of a closure*."""
+        if exp.name not in funcs:
+            funcs[exp.name] = None
+            todo.append(exp)
+        if not holes[exp]:
+            code = '_closed_' + exp.name
+            pool[code] = 'make_lam(new_closure({0}, 0))'.format(exp.name)
+            return 'lam_of({0})'.format(code)
+        var = gensym('_lam').name
+        lines.append('closure* {0} = new_closure({1}, {2});'.format(
+            var, exp.name, len(holes[exp])))
+        for i, hole in enumerate(holes[exp]):
+            lines.append('{0}->holes[{1}] = {2};'.format(var, i, hole.name))
+        return var
+
+    def atom(exp, lines):
+        """The C of the atomic expression exp, creating it first if it is a
+        lambda."""
+        if isinstance(exp, Halt):
+            return 'make_lam(&_halt_closure)'
+        elif isinstance(exp, LamExp):
+            return 'make_lam({0})'.format(closure(exp, lines))
+        elif isinstance(exp, VarExp):
+            if exp.name in PRIM_OPS:
+                raise RuntimeError('primitive operation used as a value: {0}'.format(exp.name))
+            return exp.name
+        elif isinstance(exp, NumExp):
+            return 'make_num({0})'.format(num_literal(exp))
+        elif isinstance(exp, BoolExp):
+            return 'make_num({0})'.format('1' if exp.val else '0')
+        elif isinstance(exp, StrExp):
+            return literal(exp.val)
+        else:
+            raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
+
+    def body(exp, lines):
+        """Append the statements running exp, each path of which returns the
+        closure to call next."""
+        while True:
+            if isinstance(exp, AppExp):
+                func = exp.funcExp
+                name = func.name if isinstance(func, VarExp) else None
+                if name in PRIM_OPS:
+                    operands = [atom(arg, lines) for arg in exp.argExps[:-1]]
+                    cont = exp.argExps[-1]
+                    if inline_cont(exp):
+                        # bind the result to the continuation's parameter
+                        # and carry on with its body right here
+                        var = cont.argExps[0].name
+                        exp = cont.bodyExp
+                    else:
+                        var = gensym('_prim').name
+                        exp = AppExp(cont, VarExp(var))
+                    lines.append('schemetype_t {0} = {1};'.format(
+                        var, PRIM_OPS[name].format(*operands)))
+                    continue
+                if len(exp.argExps) > MAX_ARGS:
+                    raise RuntimeError('call with more than {0} arguments'.format(MAX_ARGS))
+                func = atom(func, lines)
+                args = [atom(arg, lines) for arg in exp.argExps]
+                for i, arg in enumerate(args):
+                    lines.append('_argv[{0}] = {1};'.format(i, arg))
+                lines.append('_argc = {0};'.format(len(args)))
+                lines.append('return {0};'.format(func))
+                return
+            elif isinstance(exp, IfExp):
+                lines.append('if (num_true({0})) {{'.format(atom(exp.condExp, lines)))
+                # the branch returns, so the other one needs no else
+                body(exp.thenExp, lines)
+                lines.append('}')
+                exp = exp.elseExp
+            elif isinstance(exp, LetRecExp):
+                for var, _ in exp.bindings:
+                    lines.append('schemetype_t {0} = 0;'.format(var.name))
+                for var, val in exp.bindings:
+                    lines.append('{0} = {1};'.format(var.name, atom(val, lines)))
+                # the closures captured the variables of the letrec before
+                # they were bound, so fill those in now
+                letrec_vars = set(var for var, _ in exp.bindings)
+                for var, val in exp.bindings:
+                    if isinstance(val, LamExp) and not isinstance(val, Halt):
+                        lines.extend(
+                            'lam_of({0})->holes[{1}] = {2};'.format(var.name, i, hole.name)
+                            for i, hole in enumerate(holes[val]) if hole in letrec_vars
+                            )
+                exp = exp.bodyExp
+            else:
+                raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
+
+    main = []
+    body(exp, main)
+    while todo:
+        lam = todo.pop()
+        if len(lam.argExps) > MAX_ARGS:
+            raise RuntimeError('lambda takes more than {0} arguments: {1}'.format(MAX_ARGS, lam.name))
+        lines = [
+            'static schemetype_t {0}(closure* self) {{'.format(lam.name),
+            'if (_argc != {0}) {{'.format(len(lam.argExps)),
+            'arity_error();',
+            '}'
+            ]
+        for i, arg in enumerate(lam.argExps):
+            lines.append('schemetype_t {0} = _argv[{1}];'.format(arg.name, i))
+        for i, hole in enumerate(holes[lam]):
+            lines.append('schemetype_t {0} = self->holes[{1}];'.format(hole.name, i))
+        body(lam.bodyExp, lines)
+        lines.append('}')
+        funcs[lam.name] = lines
+
+    if standalone:
+        runtime = '\n'.join(
+            line for line in (read_runtime('scheme_c.h') + read_runtime('scheme_c.c')).splitlines()
+            if line != '#include "scheme_c.h"'
+            )
+    else:
+        runtime = '#include "scheme_c.h"'
+
+    e = Emitter(out, nspace)
+    e.verbatim(runtime)
+    e.write('// constant pool -----------------------------------------------------------------------------------')
+    for code in pool:
+        e.write('static schemetype_t {0};'.format(code))
+    e.write('// lambda decl -------------------------------------------------------------------------------------')
+    for name in funcs:
+        e.write('static schemetype_t {0}(closure* self);'.format(name))
+    e.write('// lambda impl -------------------------------------------------------------------------------------')
+    for lines in funcs.values():
+        e.write('\n'.join(lines))
+    e.write('// main --------------------------------------------------------------------------------------------')
+    e.write('static schemetype_t run_program(void) {')
+    e.write('\n'.join(main))
+    e.write('}')
+    e.write('int main(void) {')
+    for code, val in pool.items():
+        e.write('{0} = {1};'.format(code, val))
+        e.write('gc_root(&{0});'.format(code))
+    e.write('trampoline(run_program());')
+    e.write('return 0;\n}')
+
+    if out is None:
+        return e.getvalue()
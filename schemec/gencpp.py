@@ -1,10 +1,16 @@
 
+import os
 from collections import OrderedDict
-from random import choice
+from itertools import count
 from re import compile as re_compile
-from string import hexdigits
+from string import digits
 from textwrap import dedent
 
+from schemec.cfa import CFA, unknown
+from schemec.emit import Emitter
+from schemec.escape import Escape
+from schemec.freevars import FreeVars
+from schemec.infer import Types, NUM, STR, dynamic
 from schemec.typs import (
     AtomicExp,
     VarExp,
@@ -23,21 +29,33 @@ from schemec.typs import (
     SetExp,
     SetThenExp,
     Token,
+    GenSym,
     gensym,
+    subexps,
     unkpos,
     )
 
 __all__ = [
     'gen_cpp',
+    'gen_cpp_units',
     'halt',
     'pretty_cpp'
     ]
 
-LAM, NUM, STR = 'LAM', 'NUM', 'STR'
-TYPES = [LAM, NUM, STR]
+# where scheme.h and scheme.cpp live
+RUNTIME_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'runtime')
+# the most arguments a lambda may take (SCHEME_MAX_ARGS in the runtime)
+MAX_ARGS = 64
+# the range of a long, which number literals must be in
+LONG_MIN = -(1 << 63)
+LONG_MAX = (1 << 63) - 1
 
 class NumPrimOps:
-    binary_fmt = '{dst}->num = {lhs}->num {op} {rhs}->num;'
+    """The operations on numbers, as C++ on two longs. Sums, differences and
+    products may not fit in a long, so those are checked (see checked), and
+    on values the runtime computes each operation exactly (see boxed)."""
+    operand = NUM
+    binary_fmt = '({lhs} {op} {rhs})'
     binary_ops = {
         '+': '+',
         '-': '-',
@@ -45,27 +63,64 @@ class NumPrimOps:
         '=': '=='
         }
 
-    unary_fmt = '{dst}->num = {lhs}->num {op};'
+    unary_fmt = '({lhs} {op})'
     unary_ops = {
         'zero?': '== 0'
         }
 
+    # the operations that may overflow a long, and the name the runtime and
+    # __builtin_*_overflow know each by
+    checked_ops = {
+        '+': 'add',
+        '-': 'sub',
+        '*': 'mul'
+        }
+    checked_fmt = '__builtin_{op}_overflow({lhs}, {rhs}, &{var})'
+
+    # the runtime functions taking any mix of longs and values
+    boxed_ops = {
+        '+': (dynamic, 'num_add'),
+        '-': (dynamic, 'num_sub'),
+        '*': (dynamic, 'num_mul'),
+        '=': (NUM, 'num_eq'),
+        'zero?': (NUM, 'num_zero')
+        }
+
     @staticmethod
-    def __call__(op, dst, lhs, rhs=None):
+    def __call__(op, lhs, rhs=None):
+        """The type and C++ expression of op applied to the longs lhs (and
+        rhs), which does not notice if a checked op overflows."""
         try:
             if rhs is None:
                 op = NumPrimOps.unary_ops[op]
                 return (NUM, NumPrimOps.unary_fmt.format(
-                    dst=dst, lhs=lhs, op=op
+                    lhs=lhs, op=op
                     ))
             else:
                 op = NumPrimOps.binary_ops[op]
                 return (NUM, NumPrimOps.binary_fmt.format(
-                    dst=dst, lhs=lhs, op=op, rhs=rhs
+                    lhs=lhs, op=op, rhs=rhs
                     ))
         except KeyError:
             raise RuntimeError('unimplemented primitive number operation: {0}'.format(str(op)))
 
+    @staticmethod
+    def checked(op, var, lhs, rhs):
+        """C++ storing op applied to the longs lhs and rhs in the long var,
+        which is true if it overflowed."""
+        return NumPrimOps.checked_fmt.format(
+            op=NumPrimOps.checked_ops[op], lhs=lhs, rhs=rhs, var=var)
+
+    @staticmethod
+    def boxed(op, *args):
+        """The type and C++ expression of op applied to args, each a long or
+        a value; the numbers that do not fit a long are values."""
+        try:
+            typ, func = NumPrimOps.boxed_ops[op]
+        except KeyError:
+            raise RuntimeError('unimplemented primitive number operation: {0}'.format(str(op)))
+        return (typ, '{0}({1})'.format(func, ', '.join(args)))
+
     @staticmethod
     def __contains__(key):
         return (
@@ -85,23 +140,21 @@ class NumPrimOps:
 num_primops = NumPrimOps()
 
 class StrPrimOps:
+    operand = STR
     binary_ops = {
-        'string-append': dedent('''\
-            {dst}->str = std::shared_ptr<std::string>({lhs}->str);
-            {dst}->str.append({rhs}->str);'''
-            ),
-        'string=?': '{dst}->num = {lhs}->str.compare({rhs}->str) != 0;'
+        'string-append': (STR, '({lhs} + {rhs})'),
+        'string=?': (NUM, '({lhs} == {rhs})')
         }
 
     @staticmethod
-    def __call__(op, dst, lhs, rhs=None):
+    def __call__(op, lhs, rhs=None):
+        """The type and C++ expression of op applied to the strings lhs and rhs."""
         try:
             if rhs is None:
                 raise KeyError(op)
             else:
-                return (STR, StrPrimOps.binary_ops[op].format(
-                    dst=dst, lhs=lhs, rhs=rhs
-                    ))
+                typ, fmt = StrPrimOps.binary_ops[op]
+                return (typ, fmt.format(lhs=lhs, rhs=rhs))
         except KeyError:
             raise RuntimeError('unimplemented primitive operation: {0}'.format(str(op)))
 
@@ -124,67 +177,73 @@ def is_primop(op):
     else:
         return False
 
-def gen_primop(op, dst, *args):
+def primop_operand(op):
+    """The type of the operands of the primitive operation op."""
     if op in num_primops:
-        return num_primops(op, dst, *args)
+        return num_primops.operand
     elif op in str_primops:
-        return str_primops(op, dst, *args)
+        return str_primops.operand
     else:
         raise KeyError(op)
 
+def primop_result(op):
+    """The type of the result of the primitive operation op, taking it that
+    numbers fit a long."""
+    if op in num_primops:
+        return NUM
+    elif op in str_primops:
+        return str_primops[op][0]
+    else:
+        raise KeyError(op)
+
+def exact_result(op):
+    """The type of the result of the primitive operation op, which is no type
+    we can store natively if it may overflow a long."""
+    if op in num_primops.checked_ops:
+        return dynamic
+    return primop_result(op)
+
+def gen_primop(op, *args):
+    if op in num_primops:
+        return num_primops(op, *args)
+    elif op in str_primops:
+        return str_primops(op, *args)
+    else:
+        raise KeyError(op)
+
+def num_literal(exp):
+    """The C++ literal of the NumExp exp."""
+    try:
+        num = int(exp.val)
+    except ValueError:
+        # a decimal, which C++ truncates
+        return str(exp.val)
+    if not LONG_MIN < num <= LONG_MAX:
+        raise RuntimeError('number literal out of range: {0}'.format(exp.val))
+    return str(exp.val)
+
 def unimplemented(exp):
     raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
 
 def compute_holes(rootExp):
+    """Map each LamExp in rootExp to the list of variables it captures."""
+    free_vars = FreeVars(ignore=is_primop, opaque=(Halt,))
+    free_vars(rootExp)
     holes_dict = {}
-    lams_dict = {}
-    # so we can print the original exp if we want
-    def find_lams(exp):
-        if isinstance(exp, LamExp):
-            lams_dict[exp] = exp
-        return exp
-    rootExp.map(find_lams)
-    # all the work
-    def find_holes(exp):
-        holes = set()
-        if isinstance(exp, Halt):
-            holes_dict[lams_dict[exp]] = list()
-        elif isinstance(exp, VarExp):
-            if not is_primop(exp.name):
-                holes.add(exp)
-        elif isinstance(exp, LamExp):
-            holes |= exp.bodyExp
-            for arg in exp.argExps:
-                holes -= arg
-            holes_dict[lams_dict[exp]] = list(holes)
-        elif isinstance(exp, AtomicExp):
-            pass
-        elif isinstance(exp, AppExp):
-            holes |= exp.funcExp
-            for arg in exp.argExps:
-                holes |= arg
-        elif isinstance(exp, IfExp):
-            holes |= exp.condExp
-            holes |= exp.thenExp
-            holes |= exp.elseExp
-        elif isinstance(exp, LetRecExp):
-            holes |= exp.bodyExp
-            for var, val in exp.bindings:
-                holes |= val
-                holes -= var
-        elif isinstance(exp, BeginExp):
-            unimplemented(exp)
-        elif isinstance(exp, SetExp):
-            unimplemented(exp)
-        elif isinstance(exp, SetThenExp):
-            unimplemented(exp)
-        else:
-            unimplemented(exp)
-        return holes
-    rootExp.map(find_holes)
+    for lam, holes in free_vars.lambdas():
+        holes_dict[lam] = list(holes)
     return holes_dict
 
 class CppCode:
+    """C++ computing a value.
+
+    @type code: String
+    @param code: The C++ expression holding the value
+    @type decls: A list of (decl, op) pairs
+    @param decls: What has to run first, each decl and op being a string or
+        anything else an Emitter can emit. The decls of a block all go before
+        its ops.
+    """
     def __init__(self, typ, code, decls):
         self.typ = typ
         self.code = code
@@ -195,140 +254,536 @@ class CppCode:
         return self.code
     def map(self, f, skip=True):
         return f(self)
-    @property
-    def decls_ops(self):
-        if len(self.decls):
-            decls, ops = zip(*self.decls)
-        else:
-            decls, ops = [], []
-        return (
-            '\n'.join(d for d in decls if d),
-            '\n'.join(o for o in ops if o)
-            )
+    def children(self):
+        return []
+    def emit(self, e):
+        """Write the decls and then the ops to the Emitter e."""
+        for decl, _ in self.decls:
+            e.emit(decl)
+        for _, op in self.decls:
+            e.emit(op)
     def toSExp(self):
         return Token(unkpos, 'cpp')
 
+class IfCpp:
+    """An if statement leaving the value of the branch it takes in var.
+
+    @type then: CppCode
+    @type else_: CppCode
+    """
+    def __init__(self, cond, var, then, else_):
+        self.cond = cond
+        self.var = var
+        self.then = then
+        self.else_ = else_
+    def emit(self, e):
+        e.write('if ({0}) {{'.format(self.cond))
+        self.then.emit(e)
+        e.write('{0} = std::move({1});\n}}'.format(self.var, str(self.then)))
+        e.write('else {')
+        self.else_.emit(e)
+        e.write('{0} = std::move({1});\n}}'.format(self.var, str(self.else_)))
+
+class LoopGroup:
+    """Letrec-bound lambdas that tail call each other, passing on the
+    continuation they were given.
+
+    The members share a single class holding the code of all of them. Such a
+    call assigns the callee's parameters in place and jumps to its code, so a
+    loop neither allocates closures nor goes back to the trampoline.
+
+    @type lams: A list of LamExps
+    @param lams: The members, in the order their letrec binds them
+    """
+    def __init__(self, lams):
+        self.lams = lams
+        self.cls = lams[0].name
+
+    def index(self, lam):
+        return [member.name for member in self.lams].index(lam.name)
+
+    @staticmethod
+    def label(lam):
+        return '_loop_' + lam.name
+
+def inline_cont(exp):
+    """Whether the AppExp exp applies a primitive operation to a literal
+    continuation, whose body is then compiled in place."""
+    cont = exp.argExps[-1] if exp.argExps else None
+    return (
+        isinstance(exp.funcExp, VarExp) and
+        is_primop(exp.funcExp.name) and
+        isinstance(cont, LamExp) and
+        not isinstance(cont, Halt) and
+        len(cont.argExps) == 1
+        )
+
+def tail_calls(lam):
+    """Iterate over the calls lam's body makes without creating a frame of
+    its own, i.e. the ones its class compiles into its own code."""
+    todo = [lam.bodyExp]
+    while todo:
+        exp = todo.pop()
+        if isinstance(exp, IfExp):
+            todo.extend([exp.elseExp, exp.thenExp])
+        elif isinstance(exp, LetRecExp):
+            todo.append(exp.bodyExp)
+        elif isinstance(exp, AppExp):
+            if inline_cont(exp):
+                todo.append(exp.argExps[-1].bodyExp)
+            elif not (isinstance(exp.funcExp, VarExp) and is_primop(exp.funcExp.name)):
+                yield exp
+
+def find_loops(rootExp, cfa):
+    """Find the LoopGroups of rootExp.
+
+    @rtype: A tuple of a dict from lambda name -> LoopGroup, and a dict from
+        id(AppExp) -> LamExp holding the calls that jump to their callee
+    """
+    groups = {}
+    jumps = {}
+    for exp in subexps(rootExp):
+        if not isinstance(exp, LetRecExp):
+            continue
+        lams = OrderedDict(
+            (var, val) for var, val in exp.bindings
+            if isinstance(val, LamExp) and not isinstance(val, Halt) and val.argExps
+            )
+        edges = dict((lam.name, set()) for lam in lams.values())
+        for lam in lams.values():
+            cont = lam.argExps[-1]
+            for site in tail_calls(lam):
+                callee = lams.get(site.funcExp) if isinstance(site.funcExp, VarExp) else None
+                if (callee is not None and
+                    cfa.target(site) is callee and
+                    isinstance(site.argExps[-1], VarExp) and
+                    site.argExps[-1] == cont):
+                    jumps[id(site)] = callee
+                    edges[lam.name].add(callee.name)
+                    edges[callee.name].add(lam.name)
+        for lam in lams.values():
+            if lam.name in groups or not edges[lam.name]:
+                continue
+            members = set([lam.name])
+            todo = [lam.name]
+            while todo:
+                for name in edges[todo.pop()]:
+                    if name not in members:
+                        members.add(name)
+                        todo.append(name)
+            group = LoopGroup([val for val in lams.values() if val.name in members])
+            for member in group.lams:
+                groups[member.name] = group
+    return groups, jumps
+
+def may_overflow(body, unsafe):
+    """Whether body (the code of a lambda or of main, as its class compiles
+    it) keeps the result of an operation that may overflow a long as a long:
+    in one of the variables unsafe, or in a temporary."""
+    todo = [body]
+    while todo:
+        exp = todo.pop()
+        if isinstance(exp, IfExp):
+            todo.extend([exp.elseExp, exp.thenExp])
+        elif isinstance(exp, LetRecExp):
+            todo.append(exp.bodyExp)
+        elif (isinstance(exp, AppExp) and isinstance(exp.funcExp, VarExp) and
+              is_primop(exp.funcExp.name)):
+            checked = exp.funcExp.name in num_primops.checked_ops
+            if not inline_cont(exp):
+                if checked:
+                    return True
+            elif checked and str(exp.argExps[-1].argExps[0]) in unsafe:
+                return True
+            else:
+                todo.append(exp.argExps[-1].bodyExp)
+    return False
+
 class LamGenCpp:
-    def __init__(self, exp):
-        self.holes = compute_holes(exp)
-        self._decls = OrderedDict()
-        self.nargs = set()
-    def __getitem__(self, exp):
-        assert isinstance(exp, LamExp)
-        if exp.name not in self._decls:
-            self.nargs.add(len(exp.argExps))
-            holes = self.holes[exp]
-            decls, ops = exp.bodyExp.decls_ops
-            init_args = ', '.join('schemetype_t {0}'.format(str(hole)) for hole in holes)
-            priv = '\n  '.join('schemetype_t {0};'.format(str(var)) for var in holes + exp.argExps)
-            destroy_ops = '\n  '.join('{0}.reset();'.format(str(var)) for var in holes + exp.argExps)
-            asmts_ = (
-                ['{0}({0})'.format(str(hole)) for hole in holes] +
-                ['{0}(schemetype_t())'.format(str(arg)) for arg in exp.argExps]
-                )
-            asmts = ', '.join(asmts_)
-            self._decls[exp] = (
-                dedent('''\
-                    class {cls} : public lambda {{
-                     public:
-                      {cls}({init_args});
-                      ~{cls}();
-                      void args({args});
-                      schemetype_t operator()();
-                     private:
-                      {priv}
-                    }};''').format(
-                        cls=exp.name,
-                        init_args=init_args,
-                        args=', '.join('schemetype_t' for _ in range(len(exp.argExps))),
-                        priv=priv
-                        ),
-                dedent('''\
-                    {cls}::{cls}({init_args}) : {asmts} {{
-                      _ready = false;
-                    }}
-                    {cls}::~{cls}() {{
-                      {destroy_ops}
-                    }}
-                    void {cls}::args({args}) {{
-                    #ifdef DEBUG
-                      printf("assigning arguments to {cls}\\n");
-                    #endif
-                      {args_ops}
-                      _ready = true;
-                    }}
-                    schemetype_t {cls}::operator()() {{
-                      {decls}
-                    #ifdef DEBUG
-                      printf("executing {cls}\\n");
-                    #endif
-                      {ops}
-                      {body}
-                    }}''').format(
-                        cls=exp.name,
-                        init_args=init_args,
-                        asmts=asmts,
-                        destroy_ops=destroy_ops,
-                        args=', '.join('schemetype_t _{0}'.format(str(arg)) for arg in exp.argExps),
-                        args_ops='\n  '.join('{0} = std::move(_{0});'.format(str(arg)) for arg in exp.argExps),
-                        decls=decls,
-                        ops=ops,
-                        body='return {0};'.format(str(exp.bodyExp))
-                        )
+    """The classes of the lambdas of a program.
+
+    Numbers are stored as longs on the assumption that they fit one, and +, -
+    and * check that they do. A class that stores a number that may not fit
+    has a boxed twin, in the LamGenCpp twin, which only stores the numbers
+    that always fit a long as longs. When one of its operations overflows, or
+    the trampoline passes it a number that does not fit a long, a class makes
+    its twin from its holes and runs that with its arguments instead: a
+    lambda's code has no effects, so it can start over. Boxed code creates
+    twins in turn, so a program only leaves longs where it has to.
+
+    @type native: A set of Strings
+    @param native: The variables stored as longs
+    @type suffix: String
+    @param suffix: What to add to the name of each class
+    """
+    def __init__(self, holes, groups, native, suffix=''):
+        self.holes = holes
+        self.groups = groups
+        self.native = native
+        self.suffix = suffix
+        # the boxed twins, if any (see add_twins)
+        self.twin = None
+        self._twinned = set()
+        self._bodies = OrderedDict()
+        self._ids = {}
+    def __contains__(self, lam):
+        return lam.name in self._bodies.get(self.cls(lam), {})
+    def cls(self, lam):
+        """The class lam is compiled into."""
+        group = self.groups.get(lam.name)
+        return (group.cls if group else lam.name) + self.suffix
+    def add_twins(self, rootExp, native):
+        """Give a boxed twin to the class of every lambda of rootExp that
+        stores a number that may not fit a long, the twins storing only the
+        variables in native (which always fit one) as longs."""
+        self.twin = LamGenCpp(self.holes, self.groups, native, '_b')
+        unsafe = self.native - native
+        for exp in subexps(rootExp):
+            if (isinstance(exp, LamExp) and not isinstance(exp, Halt) and (
+                    any(str(var) in unsafe for var in exp.argExps + self.holes[exp]) or
+                    may_overflow(exp.bodyExp, unsafe))):
+                self._twinned.add(self.cls(exp))
+    def has_twin(self, lam):
+        """Whether lam's class has a boxed twin."""
+        return self.cls(lam) in self._twinned
+    def _unsafe(self, var):
+        """Whether var is stored as a long, but not by the twins."""
+        return str(var) in self.native and str(var) not in self.twin.native
+    def members(self, lam):
+        """The lambdas compiled into the same class as lam."""
+        group = self.groups.get(lam.name)
+        return group.lams if group else [lam]
+    def holes_of(self, lam):
+        """The variables captured by an instance of lam's class."""
+        holes = OrderedDict()
+        for member in self.members(lam):
+            for hole in self.holes[member]:
+                holes[hole] = None
+        return list(holes)
+    def entry(self, lam):
+        """Which member of its class lam is, or None if it is the only one."""
+        members = self.members(lam)
+        if len(members) == 1:
+            return None
+        return [member.name for member in members].index(lam.name)
+    def method(self, lam):
+        """The method of lam's class that calls lam directly."""
+        entry = self.entry(lam)
+        return 'call' if entry is None else 'call{0}'.format(entry)
+    def ctype(self, var):
+        """The C++ type var is stored as."""
+        return 'long' if str(var) in self.native else 'schemetype_t'
+    def ctor_args(self, lam):
+        """The arguments to the constructor of lam's class."""
+        args = [hole.name for hole in self.holes_of(lam)]
+        if self.entry(lam) is not None:
+            args.append(str(self.entry(lam)))
+        return ', '.join(args)
+    def instance(self, lam):
+        """C++ creating a new instance of lam."""
+        return 'new {0}({1})'.format(self.cls(lam), self.ctor_args(lam))
+    def id(self, lam):
+        """The number the trampoline's switch dispatches calls to lam on."""
+        return self._ids[self.cls(lam)] + (self.entry(lam) or 0)
+    def id_code(self, lam):
+        """C++ for the id of lam, which is only known once every class is."""
+        if self.entry(lam) is None:
+            return '{0}::ID'.format(self.cls(lam))
+        return '{0}::ID + {1}'.format(self.cls(lam), self.entry(lam))
+    def twin_args(self, lam, target=None):
+        """The arguments to the constructor of the twin of lam's class, from
+        the holes of the instance target (a pointer, or None for this one)."""
+        args = []
+        for hole in self.holes_of(lam):
+            arg = hole.name if target is None else 'static_cast<{0}*>({1})->{2}'.format(
+                self.cls(lam), target, hole.name)
+            args.append('make_num({0})'.format(arg) if self._unsafe(hole) else arg)
+        if self.entry(lam) is not None:
+            args.append(str(self.entry(lam)))
+        return ', '.join(args)
+    def failover(self, lam):
+        """C++ running the twin of lam's class with lam's arguments instead,
+        for when an operation of lam's overflows."""
+        return dedent('''\
+            {{
+              local<{twin}> _twin;
+              return _twin.make({args})->{method}({params});
+            }}''').format(
+                twin=self.twin.cls(lam),
+                args=self.twin_args(lam),
+                method=self.method(lam),
+                params=', '.join(
+                    'make_num({0})'.format(str(arg)) if self._unsafe(arg) else str(arg)
+                    for arg in lam.argExps)
                 )
-        return exp.name
-    @property
-    def decls_ops(self):
-        min_nargs = min(self.nargs)
-        max_nargs = max(self.nargs)
-        decl = dedent('''\
-            class lambda {{
+    def add(self, lam, body):
+        """Record body, a CppCode, as the code of lam."""
+        assert isinstance(lam, LamExp)
+        if len(lam.argExps) > MAX_ARGS:
+            raise RuntimeError('lambda takes more than {0} arguments: {1}'.format(MAX_ARGS, lam.name))
+        bodies = self._bodies.setdefault(self.cls(lam), OrderedDict())
+        if lam.name not in bodies:
+            bodies[lam.name] = (lam, body)
+        return self.cls(lam)
+    def _members(self, bodies):
+        """The (lam, body) pairs of a class, in the order of its entries."""
+        first, _ = next(iter(bodies.values()))
+        return [bodies[lam.name] for lam in self.members(first)]
+    def _init_args(self, lams):
+        return ', '.join(
+            ['{0} {1}'.format(self.ctype(hole), str(hole)) for hole in self.holes_of(lams[0])] +
+            (['int entry'] if len(lams) > 1 else [])
+            )
+    def _params(self, lam):
+        return ', '.join(
+            '{0} {1}'.format(self.ctype(arg), str(arg)) for arg in lam.argExps)
+    def _emit_decl(self, e, cls, bodies):
+        lams = [lam for lam, _ in self._members(bodies)]
+        e.write(dedent('''\
+            class {cls} : public lambda {{
              public:
-              {virtuals}
-              virtual schemetype_t operator()();
-              operator bool() const;
-             protected:
-              bool _ready;
-            }};
-            ''').format(
-                virtuals='\n  '.join(
-                    'virtual void args({0});'.format(
-                        ', '.join('schemetype_t' for _ in range(i))
-                        )
-                    for i in range(min_nargs, max_nargs + 1)
-                    )
-                )
-        op = ''.join(
-            dedent('''\
-                void lambda::args({0}) {{
-                  printf("error: lambda called with an improper number of arguments\\n");
-                  exit(-1);
-                }}
-                ''').format(', '.join('schemetype_t _{0}'.format(j) for j in range(i)))
-            for i in range(min_nargs, max_nargs + 1)
+              static const int ID = {id};
+              {cls}({init_args});
+              ~{cls}();''').format(
+                cls=cls,
+                id=self._ids[cls],
+                init_args=self._init_args(lams)
+                ))
+        for lam in lams:
+            e.write('schemetype_t {0}({1});'.format(self.method(lam), self._params(lam)))
+        if len(lams) > 1:
+            e.write('schemetype_t _body({0});'.format(', '.join(
+                ['int entry'] + [self._params(lam) for lam in lams if lam.argExps])))
+        e.write(dedent('''\
+            schemetype_t operator()(frame* f);
+            #ifdef SCHEME_GC
+            size_t gc_size() const {{
+              return sizeof({cls});
+            }}
+            heap_object* gc_move(void* to) {{
+              return new (to) {cls}(*this);
+            }}
+            void gc_trace();
+            #endif''').format(cls=cls))
+        for var in self.holes_of(lams[0]):
+            e.write('{0} {1};'.format(self.ctype(var), str(var)))
+        if len(lams) > 1:
+            e.write('int _entry;')
+        e.write('};')
+    def _emit_unpack(self, e, lam, target):
+        """Write the code calling lam's method of the instance target (a
+        pointer, or None for this one) with the arguments in the frame f,
+        which it frees."""
+        e.write(dedent('''\
+            if (f->argc != {0}) {{
+              arity_error();
+            }}''').format(len(lam.argExps)))
+        checks = [
+            'type_of(f->argv()[{0}]) != NUM'.format(i)
+            for i, arg in enumerate(lam.argExps)
+            if self.has_twin(lam) and self._unsafe(arg)
+            ]
+        if checks:
+            # a number that does not fit a long
+            e.write(dedent('''\
+                if ({checks}) {{
+                  local<{twin}> _twin;
+                  return dispatch(_twin.make({args}), f);
+                }}''').format(
+                    checks=' || '.join(checks),
+                    twin=self.twin.cls(lam),
+                    args=self.twin_args(lam, target)
+                    ))
+        args = []
+        for i, arg in enumerate(lam.argExps):
+            if str(arg) in self.native:
+                e.write('long _{0} = long_of(f->take({0}));'.format(i))
+                args.append('_{0}'.format(i))
+            else:
+                e.write('schemetype_t _{0} = f->take({0});'.format(i))
+                args.append('std::move(_{0})'.format(i))
+        e.write(dedent('''\
+            free_frame(f);
+            return {target}{method}({args});''').format(
+                target='' if target is None else 'static_cast<{0}*>({1})->'.format(
+                    self.cls(lam), target),
+                method=self.method(lam),
+                args=', '.join(args)
+                ))
+    def _emit_body(self, e, lam, body, label):
+        if label:
+            e.write('{0}: ;'.format(LoopGroup.label(lam)))
+        for decl, _ in body.decls:
+            e.emit(decl)
+        e.write(dedent('''\
+            #ifdef DEBUG
+              printf("executing {0}\\n");
+            #endif
+            #ifdef SCHEME_PROFILE
+              profile_enter({1});
+            #endif''').format(lam.name + self.suffix, self.id(lam) + 1))
+        for _, op in body.decls:
+            e.emit(op)
+        e.write('return {0};'.format(str(body)))
+    def _emit_impl(self, e, cls, bodies):
+        members = self._members(bodies)
+        lams = [lam for lam, _ in members]
+        group = self.groups.get(lams[0].name)
+        holes = self.holes_of(lams[0])
+        entries = len(lams) > 1
+        values = [str(var) for var in holes if str(var) not in self.native]
+        asmts = ', '.join(
+            ['{0}({0})'.format(str(hole)) for hole in holes] +
+            (['_entry(entry)'] if entries else [])
             )
-        op += dedent('''\
-            schemetype_t lambda::operator()() {{
-              printf("error: this should be impossible\\n");
-              exit(-1);
+
+        e.write(dedent('''\
+            {cls}::{cls}({init_args}){asmts} {{
+              _id = {id};
+            }}
+            {cls}::~{cls}() {{''').format(
+                cls=cls,
+                init_args=self._init_args(lams),
+                asmts=' : ' + asmts if asmts else '',
+                id='{0} + entry'.format(self._ids[cls]) if entries else self._ids[cls]
+                ))
+        for var in values:
+            e.write('{0}.reset();'.format(var))
+        e.write(dedent('''\
             }}
-            lambda::operator bool() const {{
-              return _ready;
+            #ifdef SCHEME_GC
+            void {cls}::gc_trace() {{''').format(cls=cls))
+        for var in values:
+            e.write('gc_forward({0});'.format(var))
+        e.write(dedent('''\
             }}
-            ''')
-        if len(self._decls):
-            decls, ops = zip(*self._decls.values())
+            #endif
+            schemetype_t {cls}::operator()(frame* f) {{''').format(cls=cls))
+        if entries:
+            e.write('switch (_entry) {')
+            for i, lam in enumerate(lams):
+                e.write('case {0}: {{'.format(i))
+                self._emit_unpack(e, lam, None)
+                e.write('}')
+            e.write('}')
+            e.write('return schemetype_t();')
         else:
-            decls, ops = [], []
-        return (
-            decl + '\n'.join(d for d in decls if d),
-            op + '\n'.join(o for o in ops if o)
-            )
+            self._emit_unpack(e, lams[0], None)
+        e.write('}')
+
+        if not entries:
+            # the parameters are those of the method, so each call has its
+            # own, and a loop jumps back to the start with them reassigned
+            lam, body = members[0]
+            e.write('schemetype_t {cls}::{method}({params}) {{'.format(
+                cls=cls, method=self.method(lam), params=self._params(lam)))
+            self._emit_body(e, lam, body, group is not None)
+            e.write('}')
+            return
+
+        # the members of a loop group jump to each other, so they share a
+        # method taking the parameters of all of them
+        for i, lam in enumerate(lams):
+            e.write(dedent('''\
+                schemetype_t {cls}::{method}({params}) {{
+                  return _body({args});
+                }}''').format(
+                    cls=cls,
+                    method=self.method(lam),
+                    params=self._params(lam),
+                    args=', '.join([str(i)] + [
+                        (str(arg) if str(arg) in self.native else 'std::move({0})'.format(str(arg)))
+                        if member is lam else
+                        ('0' if str(arg) in self.native else 'schemetype_t()')
+                        for member in lams for arg in member.argExps])
+                    ))
+        e.write('schemetype_t {0}::_body({1}) {{'.format(cls, ', '.join(
+            ['int entry'] + [self._params(lam) for lam in lams if lam.argExps])))
+        e.write('switch (entry) {')
+        for i, lam in enumerate(lams):
+            e.write('case {0}: goto {1};'.format(i, LoopGroup.label(lam)))
+        e.write('}')
+        for lam, body in members:
+            e.write('{')
+            self._emit_body(e, lam, body, True)
+            e.write('}')
+        e.write('}')
+    def _number(self, nids=0):
+        # the members of a class get consecutive ids, so an instance's id is
+        # that of its class plus its entry; the twins come after the rest
+        self._ids = {}
+        for cls, bodies in self._bodies.items():
+            self._ids[cls] = nids
+            nids += len(self._members(bodies))
+        if self.twin is not None:
+            nids = self.twin._number(nids)
+        return nids
+    def _families(self):
+        """This and its twins, if any."""
+        return [self] + ([self.twin] if self.twin is not None else [])
+    def classes(self):
+        """The names of the lambda classes, in the order they were added,
+        followed by those of the twins."""
+        return [cls for gen in self._families() for cls in gen._bodies]
+    def emit_decls(self, e):
+        """Write the class declarations of the lambdas to the Emitter e."""
+        self._number()
+        for gen in self._families():
+            for cls, bodies in gen._bodies.items():
+                gen._emit_decl(e, cls, bodies)
+    def emit_dispatch(self, e):
+        """Write dispatch(), which runs a lambda, to the Emitter e."""
+        self._number()
+        e.write(dedent('''\
+            // run lam with the arguments in f
+            schemetype_t dispatch(lambda* lam, frame* f) {
+            #ifdef SCHEME_SWITCH
+              switch (lam->_id) {'''))
+        for gen in self._families():
+            for cls, bodies in gen._bodies.items():
+                for lam, _ in gen._members(bodies):
+                    e.write('case {0}: {{'.format(gen.id(lam)))
+                    gen._emit_unpack(e, lam, 'lam')
+                    e.write('}')
+        e.write(dedent('''\
+              }
+              printf("error: this should be impossible\\n");
+              exit(-1);
+            #else
+              return (*lam)(f);
+            #endif
+            }'''))
+    def emit_profile(self, e):
+        """Write the table SCHEME_PROFILE counts in to the Emitter e: an
+        entry for main, then one for each lambda by id, with where in the
+        source it comes from."""
+        self._number()
+        entries = [('main', unkpos)]
+        for gen in self._families():
+            for bodies in gen._bodies.values():
+                for lam, _ in gen._members(bodies):
+                    entries.append((
+                        'halt' if isinstance(lam, Halt) else lam.name + gen.suffix, lam.pos))
+        e.write('#ifdef SCHEME_PROFILE')
+        e.write('profile_entry _profile[] = {')
+        e.write(',\n'.join(
+            '{{"{0}", {1}, {2}, 0, 0, 0}}'.format(name, pos.line, pos.col)
+            for name, pos in entries))
+        e.write(dedent('''\
+            }};
+            const int _profile_size = {0};
+            #endif''').format(len(entries)))
+    def emit_impls(self, e, classes=None):
+        """Write the code of the lambdas of the given classes (by default all
+        of them) to the Emitter e."""
+        self._number()
+        for cls in self.classes() if classes is None else classes:
+            for gen in self._families():
+                if cls in gen._bodies:
+                    gen._emit_impl(e, cls, gen._bodies[cls])
 
-def declare(var, construct=True):
-    return 'schemetype_t {0}{1};'.format(
-        var,
-        '(new schemetype)' if construct else '')
+def declare(var):
+    return 'schemetype_t {0};'.format(var)
 
 class Halt(LamExp):
     var = gensym('_halt')
@@ -337,6 +792,8 @@ class Halt(LamExp):
         return tok
     def map(self, f, skip=True):
         return f(self)
+    def children(self):
+        return []
 
 halt = Halt(
     [CppCode(VarExp, Halt.var.name, [])],
@@ -345,206 +802,506 @@ halt = Halt(
         '_retval',
         [(
             declare('_retval'),
-            dedent('''\
-                _retval->type = {NUM};
-                _retval->num = 0;
-                switch({arg}->type) {{
-                 case {LAM}:
-                  printf("you want to return a lambda?! really?!\\n");
-                  _retval->num = -1;
-                  break;
-                 case {NUM}:
-                  printf("%ld\\n", {arg}->num);
-                  break;
-                 case {STR}:
-                  printf("%s\\n", {arg}->str->c_str());
-                  break;
-                 default:
-                  printf("error: but our number value is %ld\\n", {arg}->num);
-                  _retval->num = -1;
-                }}''').format(
-                    arg=Halt.var.name,
-                    NUM=NUM, LAM=LAM, STR=STR)
+            '_retval = halt_value({0});'.format(Halt.var.name)
             )]
         )
     )
 
-def sanitize(exp, prefix_length=10):
+def sanitize(exp):
+    """Rename every variable bound in exp to a valid C++ identifier unique to
+    its binding, and number the lambdas of exp from 1.
+
+    The names only depend on exp, so compiling the same program twice gives
+    the same C++."""
     re_safe = re_compile(r'[^a-zA-Z0-9_]+')
+    ids = count(1)
 
     def rename_(var):
-        return VarExp('_{0}__{1}'.format(
-            ''.join(choice(hexdigits) for _ in range(prefix_length)),
-            re_safe.sub('', var.name)
-            ))
+        # the number makes the name unique, so drop any numbers gensym gave it
+        return VarExp('_{0}__{1}'.format(next(ids), re_safe.sub('', var.name).rstrip(digits)))
 
-    subs = {}
-    def sanitize_(exp):
-        if isinstance(exp, VarExp) and not is_primop(exp.name):
-            return subs[exp.name]
+    def sanitize_(exp, env):
+        """Copy exp, in which each variable bound outside it is renamed as
+        env (a dict from name to VarExp) says."""
+        if isinstance(exp, Halt):
+            return exp
+        elif isinstance(exp, VarExp):
+            return exp if is_primop(exp.name) else env[exp.name]
         elif isinstance(exp, LamExp):
+            # the parameters shadow whatever else has their names, but only
+            # within the body
+            env = dict(env)
             for arg in exp.argExps:
-                if isinstance(arg, VarExp):
-                    subs[arg.name] = rename_(arg)
+                env[arg.name] = rename_(arg)
+            lam = LamExp([env[arg.name] for arg in exp.argExps],
+                         sanitize_(exp.bodyExp, env),
+                         exp.pos)
+            lam.name = exp.name
+            return lam
+        elif isinstance(exp, AtomicExp):
+            return exp
+        elif isinstance(exp, AppExp):
+            return AppExp(sanitize_(exp.funcExp, env),
+                          *[sanitize_(arg, env) for arg in exp.argExps],
+                          pos=exp.pos)
+        elif isinstance(exp, IfExp):
+            return IfExp(sanitize_(exp.condExp, env),
+                         sanitize_(exp.thenExp, env),
+                         sanitize_(exp.elseExp, env),
+                         exp.pos)
         elif isinstance(exp, LetRecExp):
+            env = dict(env)
             for var, _ in exp.bindings:
-                if isinstance(var, VarExp):
-                    subs[var.name] = rename_(var)
+                env[var.name] = rename_(var)
+            return LetRecExp([(env[var.name], sanitize_(val, env)) for var, val in exp.bindings],
+                             sanitize_(exp.bodyExp, env))
+        elif isinstance(exp, BeginExp):
+            return BeginExp(*[sanitize_(e, env) for e in exp.exps])
+        elif isinstance(exp, SetExp):
+            return SetExp(sanitize_(exp.varExp, env), sanitize_(exp.exp, env))
+        elif isinstance(exp, SetThenExp):
+            return SetThenExp(sanitize_(exp.varExp, env),
+                              sanitize_(exp.exp, env),
+                              sanitize_(exp.thenExp, env))
+        else:
+            return exp
+
+    lam_ids = count(1)
+
+    def renumber_(exp):
+        if isinstance(exp, LamExp) and not isinstance(exp, Halt):
+            exp.name = 'lam{0}'.format(next(lam_ids))
         return exp
 
-    return exp.map(sanitize_, skip=False)
+    # map copies every lambda (but halt), so naming the copies leaves exp be
+    return sanitize_(exp, {}).map(renumber_)
+
+def read_runtime(name):
+    """The contents of the file name of the C++ runtime."""
+    with open(os.path.join(RUNTIME_DIR, name)) as f:
+        return f.read()
 
-def gen_cpp(exp):
+def run_phase(stats, name, func, arg, *args):
+    """Return func(arg, *args), recording what it cost in stats as the phase
+    name (see schemec.stats.Stats.run), unless stats is None."""
+    if stats is None:
+        return func(arg, *args)
+    return stats.run(name, func, arg, *args)
 
-    exp = sanitize(exp)
+def compile_program(exp, stats=None):
+    """Compile the CPS program exp.
 
+    @type stats: schemec.stats.Stats
+    @param stats: Where to record what each step costs, or None
+    @rtype: A tuple of the CppCode of main, the CppCode of its boxed twin
+        (see LamGenCpp), or None if main has none, the constant pool (a dict
+        from the name of each constant to the (decl, op) creating it), and
+        the LamGenCpp holding the lambdas
+    """
+    exp = run_phase(stats, 'gencpp.sanitize', sanitize, exp)
     # compute the holes at each LamExp
-    holes = compute_holes(exp)
-    lambda_gen = LamGenCpp(exp)
+    holes = run_phase(stats, 'gencpp.compute_holes', compute_holes, exp)
+    return run_phase(stats, 'gencpp.compile_sanitized', compile_sanitized, exp, holes)
 
-    # map function
-    def to_cpp(exp):
-        code = None
+def compile_sanitized(exp, holes):
+    """Compile the CPS program exp, as given by sanitize, whose lambdas
+    capture the given holes (see compute_holes), as compile_program does."""
+    # temporaries are numbered afresh too, so the C++ only depends on exp
+    gensym = GenSym()
 
-        decls = []
+    # the lambdas each variable may hold, to find calls with a known callee
+    cfa = CFA(exp, ignore=is_primop, opaque=(Halt,))
+    # variables that only ever hold numbers are stored as plain longs, as
+    # long as they fit one...
+    types = Types(exp, cfa, primop_result)
+    native = set(var.name for var, typ in types.items() if typ == NUM)
+    # ...which those that never hold a sum, difference or product always do
+    exact = Types(exp, cfa, exact_result)
+    safe = set(var.name for var, typ in exact.items() if typ == NUM)
+    # tail recursive functions, compiled into loops
+    groups, jumps = find_loops(exp, cfa)
+    # closures that die with their creator live in its C++ frame
+    escape = Escape(exp, cfa, inline_cont, jumps)
+    lambda_gen = LamGenCpp(holes, groups, native)
+    lambda_gen.add_twins(exp, safe)
+    # main goes on in a boxed twin of its own once one of its operations
+    # overflows
+    main_twin = may_overflow(exp, native - safe)
+    # the values that never change, created once at startup and shared by
+    # every use: literals, and lambdas without holes
+    pool = OrderedDict()
+    # the name of the constant holding each literal, by its C++ value
+    literals = {}
+    # the lambda, and the LamGenCpp of its class, held by every temporary
+    # holding a lambda we just created, by the code (see below) and the
+    # lambda (or None for main) whose code created it
+    lam_classes = {}
 
-        if isinstance(exp, VarExp):
-            code = exp.name
-        elif isinstance(exp, (NumExp, BoolExp, StrExp)):
-            if isinstance(exp, NumExp):
-                val = str(exp.val)
-                sym = '_num'
-                typ = NUM
-            elif isinstance(exp, BoolExp):
-                val = '1' if exp.val else '0'
-                sym = '_bool'
-                typ = NUM
-            elif isinstance(exp, StrExp):
-                val = '"{0}"'.format(exp.val)
-                sym = '_str'
-                typ = STR
-            else:
-                assert(0)
-            tmp = gensym(sym)
-            decl = (
-                declare(tmp),
+    # Each of the functions below compiles code for the LamGenCpp gen:
+    # lambda_gen for the code of the lambdas and of main, and lambda_gen.twin
+    # for that of their boxed twins.
+
+    def maker(exp, gen):
+        """The LamGenCpp of the class the code of gen creates exp as."""
+        if gen is lambda_gen.twin and lambda_gen.has_twin(exp):
+            return gen
+        return lambda_gen
+
+    def known_lam(func, code, nargs, lam, gen):
+        """The lambda func is, if it is the same at every call, and the
+        LamGenCpp of its class if that is known too (or None)."""
+        if (gen, lam, code.code) in lam_classes:
+            callee, callee_gen = lam_classes[(gen, lam, code.code)]
+            lams = [callee]
+        elif isinstance(func, VarExp):
+            lams = cfa.values(func)
+            callee_gen = None
+            if not lams or unknown in lams:
+                return None
+        else:
+            return None
+        if (len(set(lam.name for lam in lams)) == 1 and
+            len(lams[0].argExps) == nargs):
+            return lams[0], callee_gen
+        else:
+            return None
+
+    def apply_cpp(func, args, var, lam, decls, gen):
+        """Call func with the atomic expressions args, leaving the next value
+        in var."""
+        func_code = to_cpp(func, lam, decls, gen)
+        boxed = [str(to_cpp(arg, lam, decls, gen)) for arg in args]
+        known = known_lam(func, func_code, len(args), lam, gen)
+        if known is None:
+            decls.append((
+                'schemetype_t {0};'.format(var),
                 dedent('''\
-                    {var}->type = {typ};
-                    {var}->{loc} = {val};''').format(
-                        var=tmp.name,
-                        loc=typ.lower(),
-                        val=val,
-                        typ=typ.upper()
+                    pass_args({args});
+                    {var} = call_next({func});''').format(
+                        func=str(func_code),
+                        args=', '.join(boxed),
+                        var=var
                         )
+                ))
+            return
+        callee, callee_gen = known
+        guard = ''
+        if callee_gen is None:
+            callee_gen = maker(callee, gen)
+            if lambda_gen.has_twin(callee) and not escape.direct_only(callee):
+                # it may have been created by the other kind of code, as
+                # the other class
+                guard = ' && lam_of({0})->_id == {1}'.format(
+                    str(func_code), callee_gen.id_code(callee))
+        typed = []
+        for param, arg, box in zip(callee.argExps, args, boxed):
+            if str(param) in callee_gen.native:
+                typed.append(value(arg, NUM, lam, decls, gen))
+            else:
+                typed.append(box)
+        if escape.direct_only(callee):
+            # a frame-local closure must not reach the trampoline, as it is
+            # gone once we return
+            decls.append((
+                'schemetype_t {0};'.format(var),
+                '{var} = static_cast<{cls}*>(lam_of({func}))->{method}({typed});'.format(
+                    cls=callee_gen.cls(callee),
+                    method=callee_gen.method(callee),
+                    func=str(func_code),
+                    typed=', '.join(typed),
+                    var=var
+                    )
+                ))
+            return
+        # direct, non-virtual call into the known lambda class, falling back
+        # to the trampoline once the C++ stack gets deep
+        decls.append((
+            'schemetype_t {0};'.format(var),
+            dedent('''\
+                if (direct_ok(){guard}) {{
+                  ++_direct_depth;
+                  {var} = static_cast<{cls}*>(lam_of({func}))->{method}({typed});
+                  --_direct_depth;
+                }}
+                else {{
+                  pass_args({args});
+                  {var} = bounce({func});
+                }}''').format(
+                    guard=guard,
+                    cls=callee_gen.cls(callee),
+                    method=callee_gen.method(callee),
+                    func=str(func_code),
+                    typed=', '.join(typed),
+                    args=', '.join(boxed),
+                    var=var
+                    )
+            ))
+
+    def value(exp, typ, lam, decls, gen):
+        """The C++ expression of exp, as a long if typ is NUM or as a
+        std::string if it is STR."""
+        if typ == NUM and isinstance(exp, VarExp) and exp.name in gen.native:
+            return exp.name
+        elif typ == NUM and isinstance(exp, NumExp):
+            return num_literal(exp)
+        elif typ == NUM and isinstance(exp, BoolExp):
+            return '1' if exp.val else '0'
+        code = to_cpp(exp, lam, decls, gen)
+        return '{0}_of({1})'.format(typ.lower(), str(code))
+
+    def is_long(exp, gen):
+        """Whether exp is a number we have as a long."""
+        return (
+            isinstance(exp, (NumExp, BoolExp)) or
+            isinstance(exp, VarExp) and exp.name in gen.native
+            )
+
+    def literal(typ, val):
+        """The constant holding val, the C++ literal of a long if typ is NUM
+        or of a string if it is STR."""
+        key = (typ, val)
+        if key not in literals:
+            code = literals[key] = '_const_{0}'.format(len(literals) + 1)
+            pool[code] = (
+                declare(code),
+                dedent('''\
+                    {0} = make_{1}({2});
+                    gc_root(&{0});''').format(code, typ.lower(), val)
                 )
-            decls.append(decl)
-            code = tmp.name
+        return literals[key]
+
+    def compile_lam(exp, gen):
+        """Compile the code of exp into its class of gen, and into the twin
+        of that class if it has one."""
+        if exp in gen:
+            return
+        body = exp.bodyExp if isinstance(exp, Halt) else to_cpp(exp.bodyExp, exp, [], gen)
+        gen.add(exp, body)
+        if gen is lambda_gen and lambda_gen.has_twin(exp):
+            for member in lambda_gen.members(exp):
+                compile_lam(member, lambda_gen.twin)
+
+    def lam_cpp(exp, lam, decls, gen, var=None):
+        """Create the closure exp in the body of lam (or of main if lam is
+        None), in var if one is given (which the caller has declared) or in a
+        new temporary otherwise."""
+        exp_gen = maker(exp, gen)
+        compile_lam(exp, exp_gen)
+        if not exp_gen.holes_of(exp):
+            # a closed lambda needs no per-use state, so share one instance
+            code = '_closed_' + exp.name + exp_gen.suffix
+            if code not in pool:
+                pool[code] = (
+                    declare(code),
+                    dedent('''\
+                        {0} = make_lam({1});
+                        gc_root(&{0});''').format(code, exp_gen.instance(exp))
+                    )
+            lam_classes[(gen, lam, code)] = (exp, exp_gen)
+            if var is None:
+                return CppCode(LamExp, code, decls)
+            decls.append(('', '{0} = {1};'.format(var, code)))
+        elif escape.local(exp):
+            # both the closure and its box go in the current C++ frame; one
+            # made by main (or its twin) lives as long as the program, so it
+            # must not go in a block that ends before the trampoline runs
+            obj = gensym('_obj')
+            if var is None:
+                var = gensym('_lam').name
+                decls.append((declare(var), ''))
+            (main_decls if lam is None else decls).append((
+                dedent('''\
+                    local<{cls}> {obj};
+                    local_box {obj}_box;''').format(
+                        cls=exp_gen.cls(exp),
+                        obj=obj.name
+                        ),
+                ''
+                ))
+            decls.append((
+                '',
+                '{var} = make_local_lam({obj}_box, {obj}.make({args}));'.format(
+                    var=var,
+                    obj=obj.name,
+                    args=exp_gen.ctor_args(exp)
+                    )
+                ))
+        else:
+            if var is None:
+                var = gensym('_lam').name
+                decls.append((declare(var), ''))
+            decls.append(('', '{0} = make_lam({1});'.format(var, exp_gen.instance(exp))))
+        lam_classes[(gen, lam, var)] = (exp, exp_gen)
+        return CppCode(LamExp, var, decls)
+
+    def jump_cpp(exp, callee, lam, decls, gen):
+        """Assign the parameters of the loop callee in place and jump to it."""
+        temps = []
+        asmts = []
+        for param, arg in zip(callee.argExps, exp.argExps):
+            if isinstance(arg, VarExp) and arg == param:
+                continue
+            elif isinstance(arg, VarExp) and arg in callee.argExps:
+                # the old value is still needed by another assignment
+                tmp = gensym('_arg')
+                temps.append('{0} {1} = {2};'.format(
+                    gen.ctype(arg), tmp.name, str(arg)))
+                if arg.name in gen.native:
+                    gen.native.add(tmp.name)
+                arg = tmp
+            if str(param) in gen.native:
+                asmts.append('{0} = {1};'.format(str(param), value(arg, NUM, lam, decls, gen)))
+            elif is_long(arg, gen):
+                asmts.append('set_num({0}, {1});'.format(
+                    str(param), value(arg, NUM, lam, decls, gen)))
+            else:
+                asmts.append('{0} = {1};'.format(str(param), str(to_cpp(arg, lam, decls, gen))))
+        tmp = gensym('_ret')
+        decls.append((
+            'schemetype_t {0};'.format(tmp.name),
+            '\n'.join(temps + asmts + ['goto {0};'.format(LoopGroup.label(callee))])
+            ))
+        return CppCode(AppExp, tmp.name, decls)
+
+    def failover(lam):
+        """C++ leaving the code of lam (or of main if lam is None) for that
+        of its boxed twin, as one of its operations overflowed."""
+        if lam is None:
+            return 'goto _main_b;'
+        return lambda_gen.failover(lam)
+
+    def primop_cpp(op, args, param, lam, decls, gen):
+        """Store the primitive operation op applied to the atomic
+        expressions args in param, which is declared here."""
+        if primop_operand(op) == STR:
+            typ, val = gen_primop(op, *[value(arg, STR, lam, decls, gen) for arg in args])
+        elif all(is_long(arg, gen) for arg in args):
+            operands = [value(arg, NUM, lam, decls, gen) for arg in args]
+            if op not in num_primops.checked_ops:
+                typ, val = gen_primop(op, *operands)
+            elif str(param) in gen.native:
+                decls.append((
+                    'long {0};'.format(str(param)),
+                    'if ({0}) {{\n{1}\n}}'.format(
+                        num_primops.checked(op, str(param), *operands), failover(lam))
+                    ))
+                return
+            else:
+                typ, val = num_primops.boxed(op, *operands)
+        else:
+            # the runtime takes any mix of longs and values, so a literal or
+            # a long operand need not be boxed
+            operands = [
+                value(arg, NUM, lam, decls, gen) if is_long(arg, gen) else
+                str(to_cpp(arg, lam, decls, gen))
+                for arg in args
+                ]
+            typ, val = num_primops.boxed(op, *operands)
+            if typ is dynamic and str(param) in gen.native:
+                decls.append((
+                    'long {0};'.format(str(param)),
+                    'if (!fixnum_of({0}, {1})) {{\n{2}\n}}'.format(
+                        val, str(param), failover(lam))
+                    ))
+                return
+        if str(param) in gen.native:
+            decls.append((
+                'long {0};'.format(str(param)),
+                '{0} = {1};'.format(str(param), val)
+                ))
+        elif typ is dynamic:
+            decls.append((
+                declare(param),
+                '{0} = {1};'.format(str(param), val)
+                ))
+        else:
+            decls.append((
+                declare(param),
+                '{0} = make_{1}({2});'.format(str(param), typ.lower(), val)
+                ))
+
+    def to_cpp(exp, lam, decls, gen):
+        """Compile exp, which is part of the body of lam (or of main if lam
+        is None), appending what has to run first to decls."""
+        code = None
+
+        if isinstance(exp, VarExp):
+            if exp.name in gen.native:
+                code = 'make_num({0})'.format(exp.name)
+            else:
+                code = exp.name
+        elif isinstance(exp, (NumExp, BoolExp)):
+            code = literal(NUM, value(exp, NUM, lam, decls, gen))
+        elif isinstance(exp, StrExp):
+            code = literal(STR, 'std::string({0})'.format(exp.val))
         elif isinstance(exp, VoidExp):
             unimplemented(exp)
         elif isinstance(exp, LamExp):
-            cls = lambda_gen[exp]
-            # instantiate a temporary to fill with our lambda
-            tmp = gensym('_lam')
-            decl = (
-                declare(tmp),
-                dedent('''\
-                    {var}->type = {LAM};
-                    {var}->lam = lambda_t(new {cls}({holes}));''').format(
-                        var=tmp.name,
-                        cls=cls,
-                        holes=', '.join(hole.name for hole in holes[exp]),
-                        LAM=LAM
-                        )
-                )
-            decls.append(decl)
-            code = tmp.name
+            return lam_cpp(exp, lam, decls, gen)
         elif isinstance(exp, AppExp):
-            for arg in exp.argExps:
-                decls.extend(arg.decls)
-            decls.extend(exp.funcExp.decls)
+            func = exp.funcExp
             tmp = gensym('_ret')
-            func = str(exp.funcExp)
-            if is_primop(func):
-                prim = gensym('_prim')
-                typ, body = gen_primop(func, prim, *[str(arg) for arg in exp.argExps[:-1]])
-                decl = (
-                    declare(prim) + '\nschemetype_t {0};'.format(tmp.name),
-                    dedent('''\
-                        {prim}->type = {typ};
-                        {body}
-                        {func}->lam->args({prim});
-                        {var} = {func};''').format(
-                            prim=prim.name,
-                            body=body,
-                            typ=typ,
-                            var=tmp.name,
-                            func=str(exp.argExps[-1]),
-                            LAM=LAM
-                            )
-                    )
-                decls.append(decl)
-            elif exp.funcExp.typ == VarExp:
-                decl = (
-                    'schemetype_t {0};'.format(tmp.name),
-                    dedent('''\
-                        {func}->lam->args({args});
-                        {var} = {func};''').format(
-                            func=str(exp.funcExp),
-                            args=', '.join(str(arg) for arg in exp.argExps),
-                            var=tmp.name,
-                            LAM=LAM
-                            )
-                    )
-                decls.append(decl)
+            if isinstance(func, VarExp) and is_primop(func.name):
+                cont = exp.argExps[-1]
+                if inline_cont(exp):
+                    # bind the result to the continuation's parameter and
+                    # carry on with its body right here
+                    param = cont.argExps[0]
+                else:
+                    param = gensym('_prim')
+                    # boxed code keeps what may overflow boxed
+                    result = primop_result if gen is lambda_gen else exact_result
+                    if result(func.name) == NUM:
+                        gen.native.add(param.name)
+                primop_cpp(func.name, exp.argExps[:-1], param, lam, decls, gen)
+                if inline_cont(exp):
+                    return to_cpp(cont.bodyExp, lam, decls, gen)
+                apply_cpp(cont, [param], tmp.name, lam, decls, gen)
+            elif (lam is not None and id(exp) in jumps and
+                  gen.cls(jumps[id(exp)]) == gen.cls(lam)):
+                return jump_cpp(exp, jumps[id(exp)], lam, decls, gen)
+            elif isinstance(func, (VarExp, LamExp)):
+                apply_cpp(func, exp.argExps, tmp.name, lam, decls, gen)
             else:
-                raise RuntimeError('AppExp unimplemented for funcExp of type: {0}'.format(str(exp.funcExp.typ)))
+                raise RuntimeError('AppExp unimplemented for funcExp of type: {0}'.format(str(type(func))))
             code = tmp.name
         elif isinstance(exp, IfExp):
-            decls.extend(exp.condExp.decls)
-            then_decls, then_ops = exp.thenExp.decls_ops
-            else_decls, else_ops = exp.elseExp.decls_ops
+            if is_long(exp.condExp, gen):
+                cond = value(exp.condExp, NUM, lam, decls, gen)
+            else:
+                cond = 'num_true({0})'.format(str(to_cpp(exp.condExp, lam, decls, gen)))
+            # each branch is a block of its own
+            then = to_cpp(exp.thenExp, lam, [], gen)
+            else_ = to_cpp(exp.elseExp, lam, [], gen)
             tmp = gensym('_ret')
-            decl = (
+            decls.append((
                 'schemetype_t {0};'.format(tmp.name),
-                dedent('''\
-                    if ({cond}->num) {{
-                      {then_decls}
-                      {then_ops}
-                      {var} = std::move({then});
-                    }}
-                    else {{
-                      {else_decls}
-                      {else_ops}
-                      {var} = std::move({else_});
-                    }}''').format(
-                        var=tmp.name,
-                        cond=str(exp.condExp),
-                        then_decls=then_decls,
-                        then_ops=then_ops,
-                        then=str(exp.thenExp),
-                        else_decls=else_decls,
-                        else_ops=else_ops,
-                        else_=str(exp.elseExp)
-                        )
-                )
-            decls.append(decl)
+                IfCpp(cond, tmp.name, then, else_)
+                ))
             code = tmp.name
         elif isinstance(exp, LetRecExp):
-            for var, body in exp.bindings:
-                decls.extend(body.decls)
-                decl = (
-                    declare(var),
-                    dedent('''\
-                        {var}->type = {LAM};
-                        {var}->lam = {body}->lam;''').format(
+            for var, _ in exp.bindings:
+                decls.append((declare(var), ''))
+            for var, val in exp.bindings:
+                if isinstance(val, LamExp):
+                    lam_cpp(val, lam, decls, gen, str(var))
+                else:
+                    body = to_cpp(val, lam, decls, gen)
+                    decls.append(('', '{0} = {1};'.format(str(var), str(body))))
+            # the closures captured the variables of the letrec before they
+            # were bound, so fill those in now
+            letrec_vars = set(var for var, _ in exp.bindings)
+            for var, val in exp.bindings:
+                if isinstance(val, LamExp):
+                    decls.extend(
+                        ('', 'static_cast<{cls}*>(lam_of({var}))->{hole} = {hole};'.format(
+                            cls=maker(val, gen).cls(val),
                             var=str(var),
-                            body=str(body),
-                            LAM=LAM
-                            )
-                    )
-                decls.append(decl)
-            decls.extend(exp.bodyExp.decls)
-            code = str(exp.bodyExp)
+                            hole=str(hole)
+                            ))
+                        for hole in lambda_gen.holes_of(val) if hole in letrec_vars
+                        )
+            return to_cpp(exp.bodyExp, lam, decls, gen)
         elif isinstance(exp, BeginExp):
             unimplemented(exp)
         elif isinstance(exp, SetExp):
@@ -552,117 +1309,140 @@ def gen_cpp(exp):
         elif isinstance(exp, SetThenExp):
             unimplemented(exp)
         elif isinstance(exp, CppCode):
-            return exp
+            decls.extend(exp.decls)
+            return CppCode(exp.typ, exp.code, decls)
         else:
             unimplemented(exp)
         return CppCode(type(exp), code, decls)
 
-    body = exp.map(to_cpp)
+    # the outermost block of main
+    main_decls = []
+    body = to_cpp(exp, None, main_decls, lambda_gen)
+    boxed = to_cpp(exp, None, [], lambda_gen.twin) if main_twin else None
+    return body, boxed, pool, lambda_gen
 
-    main_decls, main_ops = body.decls_ops
-    lambda_decls, lambda_ops = lambda_gen.decls_ops
+def emit_main(e, body, boxed, pool):
+    """Write main(), which creates the constants of the pool and runs body,
+    or boxed (if not None) once an operation of body's overflows, to the
+    Emitter e."""
+    e.write('int main() {')
+    for _, op in pool.values():
+        e.emit(op)
+    for decl, _ in body.decls:
+        e.emit(decl)
+    e.write('SCHEME_START();')
+    for _, op in body.decls:
+        e.emit(op)
+    e.write('trampoline({0});'.format(str(body)))
+    if boxed is not None:
+        # a block of its own, as it has the same variables with other types
+        e.write('_main_b: ;\n{')
+        boxed.emit(e)
+        e.write('trampoline({0});\n}}'.format(str(boxed)))
+    e.write('}')
 
-    next = gensym('_trampoline')
+def gen_cpp(exp, standalone=True, out=None, nspace=2, stats=None):
+    """Compile the CPS program exp to C++.
 
-    # generate some C code!
-    code = dedent('''\
-        #include <cstdio>
-        #include <cstdlib>
-        #include <memory>
-        #include <string>
-        enum type_t {{ {types} }};
-        // forward decls -----------------------------------------------------------------------------------
-        class lambda;
-        class schemetype;
-        typedef std::shared_ptr<lambda> lambda_t;
-        typedef std::shared_ptr<schemetype> schemetype_t;
-        // lambda decl -------------------------------------------------------------------------------------
-        {lambda_decls}
-        // schemetype decl ---------------------------------------------------------------------------------
-        class schemetype {{
-         public:
-          union {{
-            lambda_t lam;
-            long num;
-            std::shared_ptr<std::string> str;
-          }};
-          type_t type;
-          schemetype();
-          ~schemetype();
-        }};
-        // lambda impl -------------------------------------------------------------------------------------
-        {lambda_ops}
-        // schemetype impl ---------------------------------------------------------------------------------
-        schemetype::schemetype() : lam(lambda_t()) {{ }}
-        schemetype::~schemetype() {{
-          if (type == {LAM}) {{
-            lam.reset();
-          }}
-          else if (type == {STR}) {{
-            str.reset();
-          }}
-        }}
-        // main --------------------------------------------------------------------------------------------
-        int main() {{
-          {main_decls}
-          {next_decl}
-          {main_ops}
-          {next} = {body};
-          // trampoline
-          while ({next}->type == {LAM}) {{
-            if (*({next}->lam)) {{
-              {next} = std::move((*({next}->lam))());
-            }}
-            else {{
-              printf("error: lambda called before providing arguments!\\n");
-              exit(-1);
-            }}
-          }}
-          if ({next}->type != {NUM}) {{
-            printf("error: non-number type in return value\\n");
-            return -1;
-          }}
-          return {next}->num;
-        }}
-        ''').format(
-            types=', '.join(TYPES),
-            lambda_decls=lambda_decls,
-            lambda_ops=lambda_ops,
-            main_decls=main_decls,
-            next_decl=declare(next, False),
-            next=next.name,
-            main_ops=main_ops,
-            body=str(body),
-            LAM=LAM, NUM=NUM, STR=STR
+    @type standalone: Bool
+    @param standalone: Whether to copy the runtime into the program, rather
+        than include scheme.h and leave it to be linked with libscheme.a (see
+        schemec.build)
+    @type out: A file-like object
+    @param out: Where to write the program, which is returned as a String if
+        None
+    @type nspace: Int
+    @param nspace: The number of spaces per level of indentation
+    @type stats: schemec.stats.Stats
+    @param stats: Where to record what each step costs, or None
+    """
+    body, boxed, pool, lambda_gen = compile_program(exp, stats)
+    e = Emitter(out, nspace)
+    run_phase(stats, 'gencpp.emit_program', emit_program, e, body, boxed, pool, lambda_gen,
+              standalone)
+    if out is None:
+        return e.getvalue()
+
+def emit_program(e, body, boxed, pool, lambda_gen, standalone):
+    """Write the program compile_program compiled to the Emitter e, with the
+    runtime if standalone (see gen_cpp)."""
+    if standalone:
+        runtime = '\n'.join(
+            line for line in (read_runtime('scheme.h') + read_runtime('scheme.cpp')).splitlines()
+            if line != '#include "scheme.h"'
             )
+    else:
+        runtime = '#include "scheme.h"'
+
+    # generate some C code!
+    e.verbatim(runtime)
+    e.write('// constant pool -----------------------------------------------------------------------------------')
+    for decl, _ in pool.values():
+        e.emit(decl)
+    e.write('// lambda decl -------------------------------------------------------------------------------------')
+    lambda_gen.emit_decls(e)
+    e.write('// lambda impl -------------------------------------------------------------------------------------')
+    lambda_gen.emit_dispatch(e)
+    lambda_gen.emit_profile(e)
+    lambda_gen.emit_impls(e)
+    e.write('// main --------------------------------------------------------------------------------------------')
+    emit_main(e, body, boxed, pool)
+
+def gen_cpp_units(exp, units, name='program', nspace=2):
+    """Compile the CPS program exp to C++ split across units translation
+    units, to be compiled in parallel and linked with libscheme.a (see
+    schemec.build).
+
+    The lambda classes are declared in a header shared by every unit, and
+    their code is spread over the units in order, in parts of about the same
+    size. main() and dispatch() get a unit of their own.
 
-    return code
+    @type units: Int
+    @param units: How many units to spread the lambdas over
+    @type name: String
+    @param name: What to start the name of each file with
+    @rtype: An OrderedDict from file name to contents
+    """
+    body, boxed, pool, lambda_gen = compile_program(exp)
+    header = name + '.h'
+    files = OrderedDict()
 
+    e = Emitter(nspace=nspace)
+    e.write(dedent('''\
+        #pragma once
+        #include "scheme.h"
+        // constant pool -----------------------------------------------------------------------------------'''))
+    for decl, _ in pool.values():
+        e.emit('extern ' + decl)
+    e.write('// lambda decl -------------------------------------------------------------------------------------')
+    lambda_gen.emit_decls(e)
+    files[header] = e.getvalue()
+
+    e = Emitter(nspace=nspace)
+    e.write('#include "{0}"'.format(header))
+    for decl, _ in pool.values():
+        e.emit(decl)
+    lambda_gen.emit_dispatch(e)
+    lambda_gen.emit_profile(e)
+    emit_main(e, body, boxed, pool)
+    files[name + '_main.cpp'] = e.getvalue()
+
+    impls = []
+    for cls in lambda_gen.classes():
+        e = Emitter(nspace=nspace)
+        lambda_gen.emit_impls(e, [cls])
+        impls.append(e.getvalue())
+    total = sum(len(impl) for impl in impls)
+    parts = [['#include "{0}"\n'.format(header)] for _ in range(units)]
+    done = 0
+    for impl in impls:
+        parts[min(done * units // total, units - 1)].append(impl)
+        done += len(impl)
+    for i, part in enumerate(parts):
+        files['{0}_{1}.cpp'.format(name, i)] = ''.join(part)
+    return files
 def pretty_cpp(code, nspace=2):
-    TERMINATORS = (' ', '\t', ':')
-    unindent = nspace // 2
-    # prettify code
-    pretty_code = code.splitlines()
-    indent = 0
-    for i, line in enumerate(pretty_code):
-        line = line.strip()
-        j = 0
-        if len(line) and line[0] == '}':
-            indent -= 1
-            j = 1
-        if len(line) and line[0] == '#':
-            prefix = ''
-        elif ((len(line) >= 5 and line[:5].lower() == 'case ') or
-            (len(line) >= 6 and line[:6].lower() == 'public'  and line[6] in TERMINATORS) or
-            (len(line) >= 7 and line[:7].lower() == 'default' and line[7] in TERMINATORS) or
-            (len(line) >= 7 and line[:7].lower() == 'private' and line[7] in TERMINATORS)):
-            prefix = ' ' * (nspace * indent - unindent)
-        else:
-            prefix = ' ' * (nspace * indent)
-        pretty_code[i] = prefix + line
-        for char in line[j:]:
-            if char == '{':
-                indent += 1
-            elif char == '}':
-                indent -= 1
-    return '\n'.join(pretty_code)
+    """Reindent code, with nspace spaces per level of nesting."""
+    e = Emitter(nspace=nspace)
+    e.write(code)
+    return e.getvalue()[:-1]
@@ -0,0 +1,149 @@
+from schemec.gencpp import Halt, inline_cont, sanitize
+from schemec.interp import halt_value, num_value, str_value
+from schemec.typs import (
+    GenSym,
+    VarExp,
+    NumExp,
+    BoolExp,
+    StrExp,
+    LamExp,
+    AppExp,
+    IfExp,
+    LetRecExp,
+    )
+
+__all__ = [
+    'gen_py',
+    'compile_py',
+    'run'
+    ]
+
+# how each primitive operation computes its result, as gencpp implements it
+# (with numbers and Booleans both being ints, of any size)
+PRIM_OPS = {
+    '+': '{0} + {1}',
+    '-': '{0} - {1}',
+    '*': '{0} * {1}',
+    '=': '1 if {0} == {1} else 0',
+    'zero?': '1 if {0} == 0 else 0',
+    'string-append': '{0} + {1}',
+    'string=?': '1 if {0} == {1} else 0'
+    }
+
+INDENT = '    '
+
+def halt(value):
+    """The continuation the program finishes with, which the trampoline
+    stops at rather than calls."""
+    return halt, (value,)
+
+def trampoline(func, args):
+    """Call func with args, then whatever it tail calls, and so on until a
+    call to halt. Return the value halt is called with."""
+    try:
+        while func is not halt:
+            func, args = func(*args)
+    except TypeError as e:
+        # a call to something that is not a lambda, or with the wrong
+        # number of arguments
+        raise RuntimeError('error: {0}'.format(e))
+    return args[0]
+
+def gen_py(exp):
+    """Compile the CPS program exp to the source of a Python module
+    defining program(), which returns the first call of the program as a
+    (function, arguments) pair for trampoline.
+
+    Each lambda becomes a nested Python function, so its variables are
+    Python locals (or closure cells), and each call a return of the callee
+    and its arguments.
+    """
+    # a function shares its locals with the continuations compiled into it
+    # and the closures it creates, so a variable bound again in the same
+    # function must not take over the name of one bound before: sanitize
+    # gives each binding a name of its own
+    exp = sanitize(exp)
+    gensym = GenSym()
+    lines = ['def program():']
+
+    def atom(exp, depth):
+        """The Python expression of the atomic expression exp, defining it
+        first if it is a lambda."""
+        if isinstance(exp, Halt):
+            return 'halt'
+        elif isinstance(exp, LamExp):
+            lines.append('{0}def {1}({2}):'.format(
+                INDENT * depth, exp.name, ', '.join(arg.name for arg in exp.argExps)))
+            body(exp.bodyExp, depth + 1)
+            return exp.name
+        elif isinstance(exp, VarExp):
+            if exp.name in PRIM_OPS:
+                raise RuntimeError('primitive operation used as a value: {0}'.format(exp.name))
+            return exp.name
+        elif isinstance(exp, NumExp):
+            return repr(num_value(exp))
+        elif isinstance(exp, BoolExp):
+            return '1' if exp.val else '0'
+        elif isinstance(exp, StrExp):
+            return repr(str_value(exp))
+        else:
+            raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
+
+    def body(exp, depth):
+        """Write the statements running exp, at the given indentation."""
+        indent = INDENT * depth
+        while True:
+            if isinstance(exp, AppExp):
+                func = exp.funcExp
+                name = func.name if isinstance(func, VarExp) else None
+                if name in PRIM_OPS:
+                    operands = [atom(arg, depth) for arg in exp.argExps[:-1]]
+                    cont = exp.argExps[-1]
+                    if inline_cont(exp):
+                        # bind the result to the continuation's parameter
+                        # and carry on with its body right here
+                        var = cont.argExps[0].name
+                        exp = cont.bodyExp
+                    else:
+                        var = gensym('_prim').name
+                        exp = AppExp(cont, VarExp(var))
+                    lines.append('{0}{1} = {2}'.format(
+                        indent, var, PRIM_OPS[name].format(*operands)))
+                    continue
+                func = atom(func, depth)
+                args = [atom(arg, depth) for arg in exp.argExps]
+                lines.append('{0}return {1}, ({2})'.format(
+                    indent, func, ''.join(arg + ', ' for arg in args).rstrip(' ')))
+                return
+            elif isinstance(exp, IfExp):
+                lines.append('{0}if {1} != 0:'.format(indent, atom(exp.condExp, depth)))
+                # the branch returns, so the other one needs no else
+                body(exp.thenExp, depth + 1)
+                exp = exp.elseExp
+            elif isinstance(exp, LetRecExp):
+                # functions see the variables as they are when called, so
+                # these can refer to each other
+                for var, val in exp.bindings:
+                    lines.append('{0}{1} = {2}'.format(indent, var.name, atom(val, depth)))
+                exp = exp.bodyExp
+            else:
+                raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
+
+    body(exp, 1)
+    return '\n'.join(lines) + '\n'
+
+def compile_py(exp):
+    """Compile the CPS program exp to Python, returning program() (see
+    gen_py)."""
+    code = gen_py(exp)
+    scope = {'halt': halt}
+    try:
+        exec(compile(code, '<scheme>', 'exec'), scope)
+    except (SyntaxError, RecursionError, MemoryError) as e:
+        raise RuntimeError('program too deeply nested for Python: {0}'.format(e))
+    return scope['program']
+
+def run(exp, out=None):
+    """Run the CPS program exp as its C++ would: print the value it halts
+    with to out (stdout by default) and return the exit status."""
+    return halt_value(trampoline(*compile_py(exp)()), out)
@@ -0,0 +1,145 @@
+from schemec.typs import (
+    AtomicExp,
+    VarExp,
+    NumExp,
+    BoolExp,
+    StrExp,
+    LamExp,
+    AppExp,
+    LetRecExp,
+    SetExp,
+    SetThenExp,
+    subexps
+    )
+
+__all__ = [
+    'Types',
+    'LAM',
+    'NUM',
+    'STR',
+    'dynamic'
+    ]
+
+
+LAM, NUM, STR = 'LAM', 'NUM', 'STR'
+# the type of a variable that may hold values of more than one type
+dynamic = None
+
+
+################################################################################
+## Type inference
+################################################################################
+
+class Types:
+    """The type of every variable in a CPS program.
+
+    Types flow forward from the values that are created: literals, lambdas,
+    and the results of primitive operations, whose types are given by their
+    signatures. A variable bound to values of different types, or to values
+    we cannot see (because it is free in the program, or is a parameter of a
+    lambda called from code we cannot see), is `dynamic`. A variable that is
+    never bound to anything has no type at all.
+
+    Like the 0-CFA the call graph comes from, propagation is driven by a
+    worklist of the variables whose type changed, and each variable changes
+    at most twice.
+
+    @type rootExp: A CPS expression
+    @param rootExp: The whole program
+    @type cfa: CFA
+    @param cfa: The control flow analysis of rootExp
+    @type signature: A function from String -> String
+    @param signature: The type of the result of a primitive operation
+    """
+    def __init__(self, rootExp, cfa, signature):
+        self.cfa = cfa
+        self.signature = signature
+        self._types = {}
+        self._edges = {}
+        self._worklist = []
+        bound = set()
+        used = set()
+        for exp in subexps(rootExp):
+            if isinstance(exp, VarExp):
+                used.add(exp)
+            elif isinstance(exp, LamExp):
+                bound.update(var for var in exp.argExps if isinstance(var, VarExp))
+                if cfa.escapes(exp):
+                    for param in exp.argExps:
+                        self._flows(dynamic, param)
+            elif isinstance(exp, AppExp):
+                self._site(exp)
+            elif isinstance(exp, LetRecExp):
+                for var, val in exp.bindings:
+                    bound.add(var)
+                    self._flows(val, var)
+            elif isinstance(exp, (SetExp, SetThenExp)):
+                self._flows(exp.exp, exp.varExp)
+        for var in used - bound:
+            if not cfa.ignore(var.name):
+                self._flows(dynamic, var)
+        self._solve()
+
+    def __getitem__(self, var):
+        """The type of var, or `dynamic` if it does not have a single one."""
+        return self._types.get(var, dynamic)
+
+    def __contains__(self, var):
+        return var in self._types
+
+    def items(self):
+        """Iterate over (VarExp, type) for every variable that has a type."""
+        return self._types.items()
+
+    def _site(self, app):
+        if self.cfa.is_primop(app):
+            result = self.signature(app.funcExp.name)
+            cont = app.argExps[-1]
+            for lam in self.cfa.values(cont):
+                if lam is not None and len(lam.argExps) == 1:
+                    self._flows(result, lam.argExps[0])
+            return
+        for lam in self.cfa.targets(app):
+            if lam is None or len(lam.argExps) != len(app.argExps):
+                continue
+            for param, arg in zip(lam.argExps, app.argExps):
+                self._flows(arg, param)
+
+    def _flows(self, exp, var):
+        """Record that the values of exp (an expression, or a type) flow into
+        var."""
+        if not isinstance(var, VarExp):
+            return
+        if isinstance(exp, VarExp):
+            if self.cfa.ignore(exp.name):
+                return
+            self._edges.setdefault(exp, []).append(var)
+            if exp in self._types:
+                self._add(var, self._types[exp])
+        elif isinstance(exp, (NumExp, BoolExp)):
+            self._add(var, NUM)
+        elif isinstance(exp, StrExp):
+            self._add(var, STR)
+        elif isinstance(exp, LamExp):
+            self._add(var, LAM)
+        elif isinstance(exp, AtomicExp):
+            self._add(var, dynamic)
+        elif exp in (LAM, NUM, STR, dynamic):
+            self._add(var, exp)
+        else:
+            self._add(var, dynamic)
+
+    def _add(self, var, typ):
+        if var in self._types:
+            if self._types[var] in (typ, dynamic):
+                return
+            typ = dynamic
+        self._types[var] = typ
+        self._worklist.append(var)
+
+    def _solve(self):
+        while self._worklist:
+            var = self._worklist.pop()
+            typ = self._types[var]
+            for dst in self._edges.get(var, []):
+                self._add(dst, typ)
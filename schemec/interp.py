@@ -0,0 +1,232 @@
+from re import compile as re_compile
+import sys
+
+from schemec.gencpp import Halt, inline_cont
+from schemec.typs import (
+    VarExp,
+    NumExp,
+    BoolExp,
+    StrExp,
+    LamExp,
+    AppExp,
+    IfExp,
+    LetRecExp,
+    )
+
+__all__ = [
+    'Closure',
+    'resolve',
+    'interpret',
+    'halt_value',
+    'run'
+    ]
+
+# the kinds of resolved atomic expressions
+CONST = 'const'
+LOCAL = 'local'
+VAR = 'var'
+LAM = 'lam'
+HALT = 'halt'
+# the kinds of resolved expressions
+APP = 'app'
+PRIM = 'prim'
+LET = 'let'
+IF = 'if'
+LETREC = 'letrec'
+
+LONG_MIN = -(1 << 63)
+LONG_MAX = (1 << 63) - 1
+
+# the primitive operations, as gencpp implements them (with numbers and
+# Booleans both being ints, of any size)
+PRIMOPS = {
+    '+': lambda lhs, rhs: lhs + rhs,
+    '-': lambda lhs, rhs: lhs - rhs,
+    '*': lambda lhs, rhs: lhs * rhs,
+    '=': lambda lhs, rhs: int(lhs == rhs),
+    'zero?': lambda lhs: int(lhs == 0),
+    'string-append': lambda lhs, rhs: lhs + rhs,
+    'string=?': lambda lhs, rhs: int(lhs == rhs)
+    }
+
+re_escape = re_compile(r'\\(.)')
+
+def num_value(exp):
+    try:
+        num = int(exp.val)
+    except ValueError:
+        # a decimal, which C++ truncates
+        return int(float(exp.val))
+    # as gencpp only takes literals that fit in a long
+    if not LONG_MIN < num <= LONG_MAX:
+        raise RuntimeError('number literal out of range: {0}'.format(exp.val))
+    return num
+
+def str_value(exp):
+    return re_escape.sub(r'\1', exp.val[1:-1])
+
+class Closure:
+    """A lambda together with the environment it was created in.
+
+    @type lam: A tuple of the number of parameters and the resolved body
+    @type env: A list holding the enclosing environment, then a value for
+        each variable of the innermost scope
+    """
+    __slots__ = ('lam', 'env')
+    def __init__(self, lam, env):
+        self.lam = lam
+        self.env = env
+    def __repr__(self):
+        return '<closure>'
+
+def resolve(exp, scope=()):
+    """Resolve the CPS expression exp into the nested tuples interpret() runs,
+    with every variable replaced by its lexical address: how many scopes out
+    it is bound, and where in that scope.
+
+    @type scope: A tuple of lists of variable names
+    @param scope: The scopes exp is in, innermost last
+    """
+    if isinstance(exp, AppExp):
+        func = exp.funcExp
+        if inline_cont(exp):
+            cont = exp.argExps[-1]
+            # bind the result to the continuation's parameter and carry on
+            # with its body, without creating the continuation
+            return (
+                LET,
+                PRIMOPS[func.name],
+                [resolve_atom(arg, scope) for arg in exp.argExps[:-1]],
+                resolve(cont.bodyExp, scope + ([cont.argExps[0].name],))
+                )
+        elif isinstance(func, VarExp) and func.name in PRIMOPS:
+            return (
+                PRIM,
+                PRIMOPS[func.name],
+                [resolve_atom(arg, scope) for arg in exp.argExps[:-1]],
+                resolve_atom(exp.argExps[-1], scope)
+                )
+        return (
+            APP,
+            resolve_atom(func, scope),
+            [resolve_atom(arg, scope) for arg in exp.argExps]
+            )
+    elif isinstance(exp, IfExp):
+        return (
+            IF,
+            resolve_atom(exp.condExp, scope),
+            resolve(exp.thenExp, scope),
+            resolve(exp.elseExp, scope)
+            )
+    elif isinstance(exp, LetRecExp):
+        inner = scope + ([var.name for var, _ in exp.bindings],)
+        return (
+            LETREC,
+            [resolve_atom(val, inner) for _, val in exp.bindings],
+            resolve(exp.bodyExp, inner)
+            )
+    else:
+        raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
+
+def resolve_atom(exp, scope):
+    if isinstance(exp, Halt):
+        return (HALT,)
+    elif isinstance(exp, LamExp):
+        inner = scope + ([arg.name for arg in exp.argExps],)
+        return (LAM, (len(exp.argExps), resolve(exp.bodyExp, inner)))
+    elif isinstance(exp, VarExp):
+        for depth, names in enumerate(reversed(scope)):
+            if exp.name in names:
+                # slot 0 of each environment holds the enclosing one
+                index = names.index(exp.name) + 1
+                return (LOCAL, index) if depth == 0 else (VAR, depth, index)
+        raise RuntimeError('unbound variable: {0}'.format(exp.name))
+    elif isinstance(exp, (NumExp, BoolExp)):
+        return (CONST, num_value(exp) if isinstance(exp, NumExp) else int(exp.val))
+    elif isinstance(exp, StrExp):
+        return (CONST, str_value(exp))
+    else:
+        raise RuntimeError('unimplemented expression type: {0}'.format(str(type(exp))))
+
+def interpret(exp):
+    """Run the CPS program exp, as compiled by T_c(..., halt) and perhaps
+    optimized, and return the value it halts with: an int (for numbers and
+    Booleans alike), a str or a Closure.
+
+    Every call in a CPS program is a tail call, so the program runs in a
+    single loop, without growing the Python stack.
+    """
+    code = resolve(exp)
+    env = None
+    halt = object()
+
+    def value(atom, env):
+        kind = atom[0]
+        if kind is LOCAL:
+            return env[atom[1]]
+        elif kind is VAR:
+            depth = atom[1]
+            while depth:
+                env = env[0]
+                depth -= 1
+            return env[atom[2]]
+        elif kind is CONST:
+            return atom[1]
+        elif kind is LAM:
+            return Closure(atom[1], env)
+        else:
+            return halt
+
+    while True:
+        kind = code[0]
+        if kind is IF:
+            code = code[2] if value(code[1], env) != 0 else code[3]
+            continue
+        elif kind is LETREC:
+            env = [env] + [None] * len(code[1])
+            for i, atom in enumerate(code[1]):
+                env[i + 1] = value(atom, env)
+            code = code[2]
+            continue
+        elif kind is LET or kind is PRIM:
+            # every primitive operation takes one or two operands
+            operands = code[2]
+            if len(operands) == 2:
+                val = code[1](value(operands[0], env), value(operands[1], env))
+            else:
+                val = code[1](value(operands[0], env))
+            if kind is LET:
+                env = [env, val]
+                code = code[3]
+                continue
+            func = value(code[3], env)
+            args = [val]
+        else:
+            func = value(code[1], env)
+            args = [value(arg, env) for arg in code[2]]
+        if func is halt:
+            return args[0]
+        elif not isinstance(func, Closure):
+            raise RuntimeError('error: calling a non-lambda: {0!r}'.format(func))
+        nargs, body = func.lam
+        if len(args) != nargs:
+            raise RuntimeError('error: lambda called with an improper number of arguments')
+        env = [func.env] + args
+        code = body
+
+def halt_value(val, out=None):
+    """Print val, the value a program halts with, to out (stdout by
+    default) as the C++ runtime's halt_value does, and return the exit
+    status. Numbers and Booleans are ints and strings strs, in every Python
+    backend; anything else is a lambda."""
+    out = out or sys.stdout
+    if not isinstance(val, (int, str)):
+        out.write('you want to return a lambda?! really?!\n')
+        return 255
+    out.write('{0}\n'.format(val))
+    return 0
+
+def run(exp, out=None):
+    """Run the CPS program exp as its C++ would: print the value it halts
+    with to out (stdout by default) and return the exit status."""
+    return halt_value(interpret(exp), out)
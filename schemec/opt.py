@@ -1,11 +1,20 @@
-
 from functools import partial
 
+from schemec.cfa import CFA
+from schemec.freevars import FreeVars
+from schemec.gencpp import Halt, is_primop
 from schemec.typs import (
     AtomicExp,
     VarExp,
     AppExp,
-    LamExp
+    IfExp,
+    LamExp,
+    LetRecExp,
+    BeginExp,
+    SetExp,
+    SetThenExp,
+    gensym,
+    subexps
     )
 
 
@@ -20,21 +29,327 @@ def substitute_vars(vars_dict, exp):
     else:
         return exp
 
+def rename(exp, env=None):
+    """Copy exp, giving every variable it binds and every lambda it contains a
+    fresh name, so the copy can live next to the original.
+
+    @type env: A dict from VarExp -> VarExp
+    @param env: Renamings of the variables free in exp
+    """
+    env = env if env is not None else {}
+    if isinstance(exp, Halt):
+        return exp
+    elif isinstance(exp, VarExp):
+        return env.get(exp, exp)
+    elif isinstance(exp, LamExp):
+        env = dict(env)
+        args = []
+        for arg in exp.argExps:
+            env[arg] = gensym(arg.name)
+            args.append(env[arg])
+        return LamExp(args, rename(exp.bodyExp, env), exp.pos)
+    elif isinstance(exp, AtomicExp):
+        return exp
+    elif isinstance(exp, AppExp):
+        return AppExp(rename(exp.funcExp, env),
+                      *[rename(arg, env) for arg in exp.argExps],
+                      pos=exp.pos)
+    elif isinstance(exp, IfExp):
+        return IfExp(rename(exp.condExp, env),
+                     rename(exp.thenExp, env),
+                     rename(exp.elseExp, env),
+                     exp.pos)
+    elif isinstance(exp, LetRecExp):
+        env = dict(env)
+        for var, _ in exp.bindings:
+            env[var] = gensym(var.name)
+        return LetRecExp([[env[var], rename(val, env)] for var, val in exp.bindings],
+                         rename(exp.bodyExp, env))
+    elif isinstance(exp, BeginExp):
+        return BeginExp(*[rename(e, env) for e in exp.exps])
+    elif isinstance(exp, SetExp):
+        return SetExp(rename(exp.varExp, env), rename(exp.exp, env))
+    elif isinstance(exp, SetThenExp):
+        return SetThenExp(rename(exp.varExp, env),
+                          rename(exp.exp, env),
+                          rename(exp.thenExp, env))
+    else:
+        raise TypeError(exp)
+
+def size(exp):
+    """The number of nodes in exp, our measure of code size."""
+    return sum(1 for _ in subexps(exp))
+
+def uses(exp):
+    """Count the occurrences of each variable in exp."""
+    counts = {}
+    for e in subexps(exp):
+        if isinstance(e, VarExp):
+            counts[e] = counts.get(e, 0) + 1
+    return counts
+
+def bind(params, args, body):
+    """A fresh copy of body with params bound to args.
+
+    Variables and constants are substituted. A lambda is substituted only if
+    its parameter is used at most once; otherwise it is bound to a fresh
+    temporary with a letrec, so neither its code nor its allocation gets
+    duplicated. Anything else is bound by applying a lambda to it. The args
+    themselves end up in the result as they are, without being copied.
+    """
+    counts = uses(body)
+    env = {}
+    lams = []
+    rest = []
+    for param, arg in zip(params, args):
+        if not isinstance(arg, AtomicExp):
+            env[param] = gensym(param.name)
+            rest.append((env[param], arg))
+        elif (isinstance(arg, LamExp) and not isinstance(arg, Halt) and
+              counts.get(param, 0) > 1):
+            env[param] = gensym(param.name)
+            lams.append([env[param], arg])
+        else:
+            env[param] = arg
+    body = rename(body, env)
+    if lams:
+        body = LetRecExp(lams, body)
+    if rest:
+        body = AppExp(LamExp([var for var, _ in rest], body),
+                      *[arg for _, arg in rest])
+    return body
+
 def inline(exp):
     # basic idea: AppExp(LamExp(), AtomExps) -> body of LamExp
     if (isinstance(exp, AppExp) and
         isinstance(exp.funcExp, LamExp) and
-        all(isinstance(arg, AtomicExp) for arg in exp.argExps)):
-        vars_dict = dict(zip(exp.funcExp.argExps, exp.argExps))
-        ret = exp.funcExp.bodyExp.map(partial(substitute_vars, vars_dict))
-        return ret
+        not isinstance(exp.funcExp, Halt) and
+        len(exp.funcExp.argExps) == len(exp.argExps) and
+        # bind applies a lambda of its own to the arguments that are not
+        # atomic, and inlining that again would only rebuild it, forever
+        any(isinstance(arg, AtomicExp) for arg in exp.argExps)):
+        return bind(exp.funcExp.argExps, exp.argExps, exp.funcExp.bodyExp)
     else:
         return exp
 
-def optimize(exp):
+def binders(exp):
+    """Iterate over every variable bound anywhere in exp."""
+    for e in subexps(exp):
+        if isinstance(e, LamExp) and not isinstance(e, Halt):
+            for arg in e.argExps:
+                yield arg
+        elif isinstance(e, LetRecExp):
+            for var, _ in e.bindings:
+                yield var
+
+def top_level_vars(exp):
+    """The variables bound by letrecs outside of every lambda."""
+    if isinstance(exp, LetRecExp):
+        top = set(var for var, _ in exp.bindings)
+        return top | top_level_vars(exp.bodyExp)
+    elif isinstance(exp, IfExp):
+        return top_level_vars(exp.thenExp) | top_level_vars(exp.elseExp)
+    else:
+        return set()
+
+def inline_known(exp, budget, max_size, max_unroll):
+    """Inline calls whose callee 0-CFA resolves to a single small lambda.
+
+    A lambda whose only caller is the site at hand, and whose letrec binding
+    is used nowhere else, is inlined whatever its size: the original becomes
+    dead, so the program does not grow. Any other lambda is inlined only if
+    its body has at most max_size nodes, and the copies made this way add at
+    most budget nodes to the program in total. A lambda is never unrolled
+    into itself more than max_unroll times, counting the copy being inlined
+    into as well as the lambdas lexically around the call site, so recursive
+    functions are peeled at most max_unroll times rather than expanded
+    forever.
+
+    Every variable the lambda captures must be bound at the top level and
+    nowhere else, so the copy sees the same bindings as the original would
+    have.
+    """
+    cfa = CFA(exp, ignore=is_primop, opaque=(Halt,))
+    free_vars = FreeVars(ignore=is_primop, opaque=(Halt,))
+    counts = {}
+    for var in binders(exp):
+        counts[var] = counts.get(var, 0) + 1
+    top = set(var for var in top_level_vars(exp) if counts[var] == 1)
+    refs = uses(exp)
+    letrec_bound = {}
+    for e in subexps(exp):
+        if isinstance(e, LetRecExp):
+            for var, val in e.bindings:
+                letrec_bound[id(val)] = var
+    budget = [budget]
+    # the arguments already inlined into, by id; holding on to them keeps
+    # their ids from being reused by the nodes built later
+    done = {}
+
+    def cost(site, lam):
+        """The number of nodes inlining lam at site adds, or None if it
+        should not be inlined there."""
+        var = letrec_bound.get(id(lam))
+        if ([id(s) for s in cfa.callers(lam)] == [id(site)] and
+            not cfa.escapes(lam) and
+            var is not None and refs.get(var, 0) == 1):
+            return 0
+        body_size = size(lam.bodyExp)
+        if body_size > max_size or body_size > budget[0]:
+            return None
+        return body_size
+
+    def inlinable(site, stack):
+        lam = cfa.target(site)
+        if (lam is None or
+            isinstance(lam, Halt) or
+            stack.count(id(lam)) >= max_unroll or
+            not all(var in top for var in free_vars(lam))):
+            return None, None
+        return lam, cost(site, lam)
+
+    def inline_(exp, stack):
+        if id(exp) in done:
+            return exp
+        elif isinstance(exp, LamExp) and not isinstance(exp, Halt):
+            lam = LamExp(exp.argExps, inline_(exp.bodyExp, stack + [id(exp)]), exp.pos)
+            lam.name = exp.name
+            return lam
+        elif isinstance(exp, AtomicExp):
+            return exp
+        elif isinstance(exp, AppExp):
+            lam, growth = inlinable(exp, stack)
+            if growth is not None:
+                budget[0] -= growth
+                # the arguments belong to the caller, so they are inlined
+                # into first and left alone inside the copy
+                args = [inline_(arg, stack) for arg in exp.argExps]
+                done.update((id(arg), arg) for arg in args)
+                body = bind(lam.argExps, args, lam.bodyExp)
+                return inline_(body, stack + [id(lam)])
+            return AppExp(inline_(exp.funcExp, stack),
+                          *[inline_(arg, stack) for arg in exp.argExps],
+                          pos=exp.pos)
+        elif isinstance(exp, IfExp):
+            return IfExp(inline_(exp.condExp, stack),
+                         inline_(exp.thenExp, stack),
+                         inline_(exp.elseExp, stack),
+                         exp.pos)
+        elif isinstance(exp, LetRecExp):
+            return LetRecExp([[var, inline_(val, stack)]
+                              for var, val in exp.bindings],
+                             inline_(exp.bodyExp, stack))
+        else:
+            return exp
+
+    return inline_(exp, [])
+
+# primitive operations whose operands may be given in any order
+COMMUTATIVE = ('+', '*', '=', 'string=?')
+
+def cse(exp):
+    """Eliminate common subexpressions among primitive operations.
+
+    All primitive operations are pure, so within the continuation of one, an
+    application of the same primitive to the same operands can reuse its
+    result instead. Results are only reused in code that runs in the same
+    activation (continuations compiled in place, and the branches of ifs);
+    entering any other lambda starts afresh, so no closure gets a new hole.
+    """
+    def key(app):
+        op = app.funcExp.name
+        operands = [(type(arg).__name__, repr(arg)) for arg in app.argExps[:-1]]
+        if op in COMMUTATIVE:
+            operands.sort()
+        return (op, tuple(operands))
+
+    def cse_(exp, avail):
+        if (isinstance(exp, AppExp) and
+            isinstance(exp.funcExp, VarExp) and
+            is_primop(exp.funcExp.name) and
+            isinstance(exp.argExps[-1], LamExp) and
+            not isinstance(exp.argExps[-1], Halt) and
+            len(exp.argExps[-1].argExps) == 1 and
+            all(isinstance(arg, AtomicExp) and not isinstance(arg, LamExp)
+                for arg in exp.argExps[:-1])):
+            cont = exp.argExps[-1]
+            param = cont.argExps[0]
+            k = key(exp)
+            if k in avail:
+                body = cont.bodyExp.map(partial(substitute_vars, {param: avail[k]}))
+                return cse_(body, avail)
+            inner = dict(avail)
+            inner[k] = param
+            lam = LamExp(cont.argExps, cse_(cont.bodyExp, inner), cont.pos)
+            lam.name = cont.name
+            return AppExp(exp.funcExp, *(list(exp.argExps[:-1]) + [lam]), pos=exp.pos)
+        elif isinstance(exp, LamExp) and not isinstance(exp, Halt):
+            lam = LamExp(exp.argExps, cse_(exp.bodyExp, {}), exp.pos)
+            lam.name = exp.name
+            return lam
+        elif isinstance(exp, AtomicExp):
+            return exp
+        elif isinstance(exp, AppExp):
+            return AppExp(cse_(exp.funcExp, avail),
+                          *[cse_(arg, avail) for arg in exp.argExps],
+                          pos=exp.pos)
+        elif isinstance(exp, IfExp):
+            return IfExp(cse_(exp.condExp, avail),
+                         cse_(exp.thenExp, avail),
+                         cse_(exp.elseExp, avail),
+                         exp.pos)
+        elif isinstance(exp, LetRecExp):
+            return LetRecExp([[var, cse_(val, avail)] for var, val in exp.bindings],
+                             cse_(exp.bodyExp, avail))
+        else:
+            return exp
+
+    return cse_(exp, {})
+
+def drop_dead_bindings(exp):
+    """Remove letrec bindings that are unreachable from the letrec's body."""
+    free_vars = FreeVars(ignore=is_primop, opaque=(Halt,))
+    def drop_(exp):
+        if isinstance(exp, LetRecExp):
+            vals = dict((var, val) for var, val in exp.bindings)
+            live = set(var for var in free_vars(exp.bodyExp) if var in vals)
+            todo = list(live)
+            while todo:
+                for var in free_vars(vals[todo.pop()]):
+                    if var in vals and var not in live:
+                        live.add(var)
+                        todo.append(var)
+            bindings = [(var, val) for var, val in exp.bindings if var in live]
+            if not bindings:
+                return exp.bodyExp
+            return LetRecExp(bindings, exp.bodyExp)
+        return exp
+    return exp.map(drop_)
+
+# how many nodes inlining may add to a program
+INLINE_BUDGET = 200
+# the largest lambda body inlined at a call site that is not its only caller
+INLINE_SIZE = 24
+# how many copies of a recursive function may be nested inside each other
+MAX_UNROLL = 1
+
+def optimize(exp, inline_budget=INLINE_BUDGET, inline_size=INLINE_SIZE,
+             max_unroll=MAX_UNROLL):
     opts = [
         inline
         ]
+    program_opts = [
+        partial(inline_known,
+                budget=inline_budget,
+                max_size=inline_size,
+                max_unroll=max_unroll),
+        drop_dead_bindings,
+        cse
+        ]
+    for opt in opts:
+        exp = exp.map(opt)
+    for opt in program_opts:
+        exp = opt(exp)
     for opt in opts:
         exp = exp.map(opt)
     return exp
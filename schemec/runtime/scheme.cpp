@@ -0,0 +1,329 @@
+#include "scheme.h"
+#include <algorithm>
+#include <vector>
+// values ------------------------------------------------------------------------------------------
+#ifdef SCHEME_GC
+std::vector<gc_chunk> _gc_chunks;
+gc_chunk _gc_to;
+size_t _gc_allocated = 0;
+size_t _gc_threshold = SCHEME_GC_NURSERY;
+std::vector<schemetype_t*> _gc_roots;
+std::vector<heap_object*> _gc_pinned;
+gc_chunk gc_new_chunk(size_t size) {
+  char* begin = static_cast<char*>(malloc(size));
+  if (!begin) {
+    printf("error: out of memory\n");
+    exit(-1);
+  }
+  gc_chunk chunk = { begin, begin, begin + size };
+  return chunk;
+}
+void gc_collect(schemetype_t& next) {
+  // nothing survives that was not allocated since the last collection
+  _gc_to = gc_new_chunk(_gc_allocated ? _gc_allocated : 8);
+  gc_forward(next);
+  for (schemetype_t* root : _gc_roots) {
+    gc_forward(*root);
+  }
+  if (_frame) {
+    for (int i = 0; i < _frame->argc; ++i) {
+      gc_forward(_frame->argv()[i]);
+    }
+  }
+  for (heap_object* obj : _gc_pinned) {
+    obj->gc_trace();
+  }
+  for (char* scan = _gc_to.begin; scan < _gc_to.top; ) {
+    heap_object* obj = reinterpret_cast<heap_object*>(scan);
+    obj->gc_trace();
+    scan += gc_round(obj->gc_size());
+  }
+  for (const gc_chunk& chunk : _gc_chunks) {
+    free(chunk.begin);
+  }
+  _gc_chunks.clear();
+  _gc_chunks.push_back(_gc_to);
+  _gc_allocated = _gc_to.top - _gc_to.begin;
+  _gc_threshold = 2 * _gc_allocated > SCHEME_GC_NURSERY ? 2 * _gc_allocated : SCHEME_GC_NURSERY;
+}
+#endif
+// arithmetic --------------------------------------------------------------------------------------
+namespace {
+// a number as the slow paths work on it: its sign, and the base 2^32 digits
+// of its magnitude, least significant first and without leading zeros
+struct bigint {
+  bool negative;
+  std::vector<uint32_t> digits;
+};
+bigint long_to_bigint(long num) {
+  bigint big;
+  big.negative = num < 0;
+  uint64_t mag = num < 0 ? -uint64_t(num) : uint64_t(num);
+  for (; mag; mag >>= 32) {
+    big.digits.push_back(uint32_t(mag));
+  }
+  return big;
+}
+bigint to_bigint(const schemetype_t& var) {
+  switch (type_of(var)) {
+   case NUM:
+    return long_to_bigint(num_of(var));
+   case BIG: {
+    bignum* num = big_of(var);
+    bigint big;
+    big.negative = num->_negative;
+    big.digits.assign(num->digits(), num->digits() + num->_size);
+    return big;
+   }
+   default:
+    printf("error: arithmetic on a non-number\n");
+    exit(-1);
+  }
+}
+// the number big is, as a fixnum if it fits one
+schemetype_t from_bigint(bigint& big) {
+  while (!big.digits.empty() && !big.digits.back()) {
+    big.digits.pop_back();
+  }
+  if (big.digits.size() <= 2) {
+    uint64_t mag = 0;
+    for (size_t i = 0; i < big.digits.size(); ++i) {
+      mag |= uint64_t(big.digits[i]) << (32 * i);
+    }
+    if (mag <= uint64_t(LONG_MAX)) {
+      return make_num(big.negative ? -long(mag) : long(mag));
+    }
+    if (big.negative && mag == uint64_t(LONG_MAX) + 1) {
+      return make_num(LONG_MIN);
+    }
+  }
+  return make_big(bignum::make(big.negative, big.digits.data(), big.digits.size()));
+}
+int compare_mags(const std::vector<uint32_t>& lhs, const std::vector<uint32_t>& rhs) {
+  if (lhs.size() != rhs.size()) {
+    return lhs.size() < rhs.size() ? -1 : 1;
+  }
+  for (size_t i = lhs.size(); i-- > 0; ) {
+    if (lhs[i] != rhs[i]) {
+      return lhs[i] < rhs[i] ? -1 : 1;
+    }
+  }
+  return 0;
+}
+std::vector<uint32_t> add_mags(const std::vector<uint32_t>& lhs, const std::vector<uint32_t>& rhs) {
+  std::vector<uint32_t> sum;
+  uint64_t carry = 0;
+  for (size_t i = 0; i < lhs.size() || i < rhs.size() || carry; ++i) {
+    carry += (i < lhs.size() ? lhs[i] : 0) + uint64_t(i < rhs.size() ? rhs[i] : 0);
+    sum.push_back(uint32_t(carry));
+    carry >>= 32;
+  }
+  return sum;
+}
+// lhs must be at least as big as rhs
+std::vector<uint32_t> sub_mags(const std::vector<uint32_t>& lhs, const std::vector<uint32_t>& rhs) {
+  std::vector<uint32_t> diff;
+  int64_t borrow = 0;
+  for (size_t i = 0; i < lhs.size(); ++i) {
+    int64_t digit = int64_t(lhs[i]) - (i < rhs.size() ? rhs[i] : 0) - borrow;
+    borrow = digit < 0;
+    diff.push_back(uint32_t(digit + (borrow << 32)));
+  }
+  return diff;
+}
+schemetype_t add_bigints(bigint lhs, const bigint& rhs) {
+  if (lhs.negative == rhs.negative) {
+    lhs.digits = add_mags(lhs.digits, rhs.digits);
+  }
+  else if (compare_mags(lhs.digits, rhs.digits) >= 0) {
+    lhs.digits = sub_mags(lhs.digits, rhs.digits);
+  }
+  else {
+    lhs.negative = rhs.negative;
+    lhs.digits = sub_mags(rhs.digits, lhs.digits);
+  }
+  return from_bigint(lhs);
+}
+}
+schemetype_t make_big_num(long num) {
+  bigint big = long_to_bigint(num);
+  return make_big(bignum::make(big.negative, big.digits.data(), big.digits.size()));
+}
+long big_to_long(const bignum* big) {
+  uint64_t mag = 0;
+  for (size_t i = 0; i < big->_size; ++i) {
+    mag |= uint64_t(big->digits()[i]) << (32 * i);
+  }
+  return big->_negative ? long(0 - mag) : long(mag);
+}
+schemetype_t num_add_slow(const schemetype_t& lhs, const schemetype_t& rhs) {
+  return add_bigints(to_bigint(lhs), to_bigint(rhs));
+}
+schemetype_t num_sub_slow(const schemetype_t& lhs, const schemetype_t& rhs) {
+  bigint neg = to_bigint(rhs);
+  neg.negative = !neg.negative;
+  return add_bigints(to_bigint(lhs), neg);
+}
+schemetype_t num_mul_slow(const schemetype_t& lhs, const schemetype_t& rhs) {
+  bigint a = to_bigint(lhs);
+  bigint b = to_bigint(rhs);
+  bigint product;
+  product.negative = a.negative != b.negative;
+  product.digits.assign(a.digits.size() + b.digits.size(), 0);
+  for (size_t i = 0; i < a.digits.size(); ++i) {
+    uint64_t carry = 0;
+    for (size_t j = 0; j < b.digits.size() || carry; ++j) {
+      carry += product.digits[i + j] + (j < b.digits.size() ? uint64_t(a.digits[i]) * b.digits[j] : 0);
+      product.digits[i + j] = uint32_t(carry);
+      carry >>= 32;
+    }
+  }
+  return from_bigint(product);
+}
+bool num_eq_slow(const schemetype_t& lhs, const schemetype_t& rhs) {
+  bigint a = to_bigint(lhs);
+  bigint b = to_bigint(rhs);
+  return a.negative == b.negative && a.digits == b.digits;
+}
+std::string big_to_string(const bignum* big) {
+  std::vector<uint32_t> mag(big->digits(), big->digits() + big->_size);
+  std::string str;
+  // divide by 10^9 until nothing is left, taking nine digits at a time
+  while (!mag.empty()) {
+    uint64_t rem = 0;
+    for (size_t i = mag.size(); i-- > 0; ) {
+      uint64_t cur = (rem << 32) | mag[i];
+      mag[i] = uint32_t(cur / 1000000000);
+      rem = cur % 1000000000;
+    }
+    while (!mag.empty() && !mag.back()) {
+      mag.pop_back();
+    }
+    for (int i = 0; i < 9 && (rem || !mag.empty()); ++i) {
+      str.push_back(char('0' + rem % 10));
+      rem /= 10;
+    }
+  }
+  if (big->_negative) {
+    str.push_back('-');
+  }
+  std::reverse(str.begin(), str.end());
+  return str;
+}
+// direct calls ------------------------------------------------------------------------------------
+unsigned _direct_depth = 0;
+#ifdef SCHEME_MTA
+char* _mta_base;
+std::jmp_buf _mta_restart;
+schemetype_t _mta_next;
+__attribute__((noinline)) char* mta_frame() {
+  return static_cast<char*>(__builtin_frame_address(0));
+}
+#endif
+// lambdas -----------------------------------------------------------------------------------------
+frame* _free_frames[SCHEME_MAX_ARGS + 1];
+frame* _frame = nullptr;
+frame* alloc_frame(int argc) {
+  void* mem = malloc(sizeof(frame) + argc * sizeof(schemetype_t));
+  if (!mem) {
+    printf("error: out of memory\n");
+    exit(-1);
+  }
+  frame* f = new (mem) frame;
+  f->argc = argc;
+  for (int i = 0; i < argc; ++i) {
+    new (f->argv() + i) schemetype_t();
+  }
+  return f;
+}
+void arity_error() {
+  printf("error: lambda called with an improper number of arguments\n");
+  exit(-1);
+}
+schemetype_t lambda::operator()(frame* f) {
+  printf("error: this should be impossible\n");
+  exit(-1);
+}
+// profiling ---------------------------------------------------------------------------------------
+#ifdef SCHEME_PROFILE
+int _profile_current = 0;
+unsigned long long _profile_since = 0;
+namespace {
+void write_profile() {
+  // charge whatever ran last
+  unsigned long long now = profile_clock();
+  _profile[_profile_current].cycles += now - _profile_since;
+  _profile_since = now;
+  const char* path = getenv("SCHEME_PROFILE_OUT");
+  if (!path || !*path) {
+    path = "scheme-profile.json";
+  }
+  FILE* out = fopen(path, "w");
+  if (!out) {
+    fprintf(stderr, "error: cannot write the profile to %s\n", path);
+    return;
+  }
+#if defined(__x86_64__) || defined(__i386__)
+  fprintf(out, "{\n  \"clock\": \"cycles\",\n  \"lambdas\": [\n");
+#else
+  fprintf(out, "{\n  \"clock\": \"ns\",\n  \"lambdas\": [\n");
+#endif
+  for (int i = 0; i < _profile_size; ++i) {
+    const profile_entry& entry = _profile[i];
+    fprintf(out, "    {\"name\": \"%s\", ", entry.name);
+    if (entry.line < 0) {
+      fprintf(out, "\"line\": null, \"col\": null, ");
+    }
+    else {
+      fprintf(out, "\"line\": %d, \"col\": %d, ", entry.line, entry.col);
+    }
+    fprintf(out, "\"calls\": %lu, \"allocs\": %lu, \"cycles\": %llu}%s\n",
+            entry.calls, entry.allocs, entry.cycles, i + 1 < _profile_size ? "," : "");
+  }
+  fprintf(out, "  ]\n}\n");
+  fclose(out);
+}
+}
+void profile_start() {
+  _profile_since = profile_clock();
+  atexit(write_profile);
+}
+#endif
+// main --------------------------------------------------------------------------------------------
+schemetype_t halt_value(const schemetype_t& value) {
+  switch (type_of(value)) {
+   case LAM:
+    printf("you want to return a lambda?! really?!\n");
+    return make_num(-1);
+   case NUM:
+    printf("%ld\n", num_of(value));
+    return make_num(0);
+   case STR:
+    printf("%s\n", str_of(value).c_str());
+    return make_num(0);
+   case BIG:
+    printf("%s\n", big_to_string(big_of(value)).c_str());
+    return make_num(0);
+   default:
+    printf("error: but our number value is %ld\n", num_of(value));
+    return make_num(-1);
+  }
+}
+void trampoline(schemetype_t next) {
+#ifdef SCHEME_MTA
+  // whatever the frames we jumped out of were doing is done
+  _direct_depth = 0;
+  gc_unpin_below(_mta_base);
+#endif
+  while (type_of(next) == LAM) {
+    gc_safepoint(next);
+    next = dispatch(lam_of(next), take_frame());
+  }
+  if (type_of(next) != NUM) {
+    printf("error: non-number type in return value\n");
+    exit(-1);
+  }
+  // leave without unwinding main, whose frame-local closures may hold long
+  // chains of continuations not worth freeing one by one
+  exit(num_of(next));
+}
@@ -0,0 +1,849 @@
+// The runtime shared by every program gen_cpp compiles.
+//
+// The representation of values, which is all the generated code relies on:
+//   schemetype_t                  a value
+//   make_num, make_str, make_lam  wrap a long, a string or a new lambda
+//   make_local_lam                wrap a lambda living in a local<T>
+//   type_of, num_of, long_of, str_of, lam_of
+//   set_num                       store a number in a variable
+//   num_add, num_sub, num_mul     exact arithmetic on values or longs
+//   num_eq, num_zero, fixnum_of
+//   gc_root, gc_safepoint         register a global, and collect garbage
+// Numbers are fixnums (num_of) unless they do not fit one, in which case
+// they are bignums (big_of).
+// By default a value is a shared_ptr to a boxed schemetype. With
+// SCHEME_TAGGED it is a single tagged word: numbers (and booleans) are
+// immediates, and only lambdas and strings live on the heap, reference
+// counted without atomics. SCHEME_GC implies SCHEME_TAGGED, but heap
+// objects are bump allocated instead, and reclaimed by a copying collector
+// that runs between two trips through the trampoline. SCHEME_MTA implies
+// SCHEME_GC, and makes every call a direct C++ call. SCHEME_SWITCH
+// dispatches on lambda ids rather than through a virtual call.
+// SCHEME_PROFILE counts the calls, allocations and clock cycles of every
+// lambda, and writes them to $SCHEME_PROFILE_OUT (scheme-profile.json by
+// default) as JSON when the program exits.
+//
+// The library (scheme.cpp) must be built with the same SCHEME_* macros as
+// the programs it is linked with.
+#ifndef SCHEME_H
+#define SCHEME_H
+#include <climits>
+#include <csetjmp>
+#include <cstdint>
+#include <cstdio>
+#include <cstdlib>
+#include <cstring>
+#include <memory>
+#include <new>
+#include <string>
+#include <utility>
+#if defined(SCHEME_MTA) && !defined(SCHEME_GC)
+#define SCHEME_GC
+#endif
+#if defined(SCHEME_GC) && !defined(SCHEME_TAGGED)
+#define SCHEME_TAGGED
+#endif
+enum type_t { LAM, NUM, STR, BIG };
+// forward decls -----------------------------------------------------------------------------------
+class lambda;
+// profiling ---------------------------------------------------------------------------------------
+#ifdef SCHEME_PROFILE
+#if !defined(__x86_64__) && !defined(__i386__)
+#include <chrono>
+#endif
+// what a lambda has cost so far, and where in the source it comes from
+// (line and col are -1 if nowhere); every program defines its own table,
+// with an entry for main, then one for each lambda by id
+struct profile_entry {
+  const char* name;
+  int line;
+  int col;
+  unsigned long calls;
+  unsigned long allocs;
+  unsigned long long cycles;
+};
+extern profile_entry _profile[];
+extern const int _profile_size;
+// the entry running now, and when it started
+extern int _profile_current;
+extern unsigned long long _profile_since;
+inline unsigned long long profile_clock() {
+#if defined(__x86_64__) || defined(__i386__)
+  return __builtin_ia32_rdtsc();
+#else
+  // (nanoseconds rather than cycles)
+  return std::chrono::steady_clock::now().time_since_epoch().count();
+#endif
+}
+// charge the time since the last switch to the entry running until now,
+// and switch to entry i
+inline void profile_enter(int i) {
+  unsigned long long now = profile_clock();
+  _profile[_profile_current].cycles += now - _profile_since;
+  _profile_since = now;
+  _profile_current = i;
+  ++_profile[i].calls;
+}
+inline void profile_alloc() {
+  ++_profile[_profile_current].allocs;
+}
+// start the clock, and write the report at exit
+void profile_start();
+#else
+inline void profile_alloc() { }
+#endif
+// values ------------------------------------------------------------------------------------------
+#ifdef SCHEME_TAGGED
+#ifdef SCHEME_GC
+#include <vector>
+#ifndef SCHEME_GC_NURSERY
+#define SCHEME_GC_NURSERY (4L << 20)
+#endif
+// objects are bump allocated out of chunks; all of those allocated since
+// the last collection form from-space
+struct gc_chunk {
+  char* begin;
+  char* top;
+  char* end;
+};
+extern std::vector<gc_chunk> _gc_chunks;
+extern gc_chunk _gc_to;
+extern size_t _gc_allocated;
+extern size_t _gc_threshold;
+inline size_t gc_round(size_t size) {
+  return (size + 7) & ~size_t(7);
+}
+gc_chunk gc_new_chunk(size_t size);
+inline void* gc_alloc(size_t size) {
+  size = gc_round(size);
+  if (_gc_chunks.empty() || _gc_chunks.back().top + size > _gc_chunks.back().end) {
+    _gc_chunks.push_back(gc_new_chunk(size > SCHEME_GC_NURSERY ? size : SCHEME_GC_NURSERY));
+  }
+  void* mem = _gc_chunks.back().top;
+  _gc_chunks.back().top += size;
+  _gc_allocated += size;
+  return mem;
+}
+class heap_object {
+ public:
+  heap_object() : _forward(nullptr) { }
+  heap_object(const heap_object&) : _forward(nullptr) { }
+  virtual ~heap_object() { }
+  static void* operator new(size_t size) {
+    return gc_alloc(size);
+  }
+  static void* operator new(size_t, void* at) {
+    return at;
+  }
+  static void operator delete(void*) { }
+  static void operator delete(void*, void*) { }
+  virtual size_t gc_size() const = 0;
+  // copy the object to the memory at to
+  virtual heap_object* gc_move(void* to) = 0;
+  // forward every value the object refers to
+  virtual void gc_trace() { }
+  heap_object* _forward;
+};
+#else
+class heap_object {
+ public:
+  heap_object() : _refs(0) { }
+  virtual ~heap_object() { }
+  mutable long _refs;
+};
+#endif
+// low bits: ...1 number, .000 lambda, .010 string, .100 bignum
+class schemetype_t {
+ public:
+  schemetype_t() : _bits(0) { }
+  explicit schemetype_t(uintptr_t bits) : _bits(bits) {
+    retain();
+  }
+#ifndef SCHEME_GC
+  // (with a collector, values are plain words that copy trivially)
+  schemetype_t(const schemetype_t& other) : _bits(other._bits) {
+    retain();
+  }
+  schemetype_t(schemetype_t&& other) : _bits(other._bits) {
+    other._bits = 0;
+  }
+  ~schemetype_t() {
+    release();
+  }
+  schemetype_t& operator=(const schemetype_t& other) {
+    other.retain();
+    release();
+    _bits = other._bits;
+    return *this;
+  }
+  schemetype_t& operator=(schemetype_t&& other) {
+    if (this != &other) {
+      release();
+      _bits = other._bits;
+      other._bits = 0;
+    }
+    return *this;
+  }
+#endif
+  void reset() {
+    release();
+    _bits = 0;
+  }
+  uintptr_t bits() const {
+    return _bits;
+  }
+  heap_object* ptr() const {
+    return reinterpret_cast<heap_object*>(_bits & ~uintptr_t(7));
+  }
+  bool is_ptr() const {
+    return _bits && !(_bits & 1);
+  }
+ private:
+  void retain() const {
+#ifndef SCHEME_GC
+    if (is_ptr()) {
+      ++ptr()->_refs;
+    }
+#endif
+  }
+  void release() {
+#ifndef SCHEME_GC
+    if (is_ptr() && --ptr()->_refs == 0) {
+      delete ptr();
+    }
+#endif
+  }
+  uintptr_t _bits;
+};
+#ifdef SCHEME_GC
+// the roots besides the trampoline's next lambda: globals, and the
+// objects living in C++ frames rather than on the heap
+extern std::vector<schemetype_t*> _gc_roots;
+extern std::vector<heap_object*> _gc_pinned;
+inline void gc_root(schemetype_t* var) {
+  _gc_roots.push_back(var);
+}
+inline void gc_pin(heap_object* obj) {
+  _gc_pinned.push_back(obj);
+}
+// forget the objects of frames abandoned below the address base
+inline void gc_unpin_below(char* base) {
+  size_t kept = 0;
+  for (heap_object* obj : _gc_pinned) {
+    if (reinterpret_cast<char*>(obj) >= base) {
+      _gc_pinned[kept++] = obj;
+    }
+  }
+  _gc_pinned.resize(kept);
+}
+inline void gc_unpin(heap_object* obj) {
+  for (size_t i = _gc_pinned.size(); i-- > 0; ) {
+    if (_gc_pinned[i] == obj) {
+      _gc_pinned.erase(_gc_pinned.begin() + i);
+      return;
+    }
+  }
+}
+inline bool gc_in_from_space(heap_object* obj) {
+  char* at = reinterpret_cast<char*>(obj);
+  for (const gc_chunk& chunk : _gc_chunks) {
+    if (at >= chunk.begin && at < chunk.top) {
+      return true;
+    }
+  }
+  return false;
+}
+// point var at the to-space copy of what it refers to, copying it first
+// if need be
+inline void gc_forward(schemetype_t& var) {
+  if (!var.is_ptr() || !gc_in_from_space(var.ptr())) {
+    return;
+  }
+  heap_object* obj = var.ptr();
+  if (!obj->_forward) {
+    obj->_forward = obj->gc_move(_gc_to.top);
+    _gc_to.top += gc_round(obj->gc_size());
+  }
+  var = schemetype_t(reinterpret_cast<uintptr_t>(obj->_forward) | (var.bits() & 7));
+}
+void gc_collect(schemetype_t& next);
+// collect if enough has been allocated; next must be the only live value
+// outside the roots
+inline void gc_safepoint(schemetype_t& next) {
+  if (_gc_allocated > _gc_threshold) {
+    gc_collect(next);
+  }
+}
+#endif
+// keeps a heap object that is not on the heap from ever being freed
+#define LOCAL_REFS (1L << 62)
+struct local_box { };
+#else
+class heap_object {
+ public:
+  virtual ~heap_object() { }
+};
+class schemetype;
+typedef std::shared_ptr<lambda> lambda_t;
+typedef std::shared_ptr<schemetype> schemetype_t;
+#endif
+#ifndef SCHEME_GC
+inline void gc_root(schemetype_t*) { }
+inline void gc_safepoint(schemetype_t&) { }
+#endif
+// direct calls ------------------------------------------------------------------------------------
+#ifndef SCHEME_MAX_DIRECT_DEPTH
+#define SCHEME_MAX_DIRECT_DEPTH 16
+#endif
+extern unsigned _direct_depth;
+#ifdef SCHEME_MTA
+// Cheney on the M.T.A.: no call ever goes back to the trampoline until
+// the C++ stack gets SCHEME_MTA_STACK bytes deep. Then the frames on it,
+// all of which are done, are dropped by jumping back to main, which
+// carries on with the lambda that was about to be called.
+#ifndef SCHEME_MTA_STACK
+#define SCHEME_MTA_STACK (1L << 20)
+#endif
+extern char* _mta_base;
+extern std::jmp_buf _mta_restart;
+extern schemetype_t _mta_next;
+char* mta_frame();
+inline bool direct_ok() {
+  char here;
+  return _mta_base - &here < SCHEME_MTA_STACK;
+}
+[[noreturn]] inline void mta_restart(const schemetype_t& next) {
+  _mta_next = next;
+  std::longjmp(_mta_restart, 1);
+}
+inline schemetype_t bounce(const schemetype_t& next) {
+  mta_restart(next);
+}
+#else
+inline bool direct_ok() {
+  return _direct_depth < SCHEME_MAX_DIRECT_DEPTH;
+}
+// hand next to the trampoline, to call once we have returned
+inline schemetype_t bounce(const schemetype_t& next) {
+  return next;
+}
+#endif
+// storage for a closure that does not outlive the C++ frame creating it
+template <class T> class local {
+ public:
+  local() : _made(false) { }
+  ~local() {
+    if (_made) {
+#ifdef SCHEME_GC
+      gc_unpin(get());
+#endif
+      get()->~T();
+    }
+  }
+  template <class... A> T* make(A&&... args) {
+    if (_made) {
+      get()->~T();
+    }
+    T* obj = new (_buf) T(std::forward<A>(args)...);
+#ifdef SCHEME_GC
+    // the collector must see what the closure refers to
+    if (!_made) {
+      gc_pin(obj);
+    }
+#endif
+    _made = true;
+    return obj;
+  }
+  T* get() {
+    return reinterpret_cast<T*>(_buf);
+  }
+ private:
+  alignas(T) unsigned char _buf[sizeof(T)];
+  bool _made;
+};
+// lambdas -----------------------------------------------------------------------------------------
+// the arguments of a call that goes through the trampoline, waiting for the
+// callee to run; the values follow the frame in memory
+struct frame {
+  schemetype_t* argv() {
+    return reinterpret_cast<schemetype_t*>(this + 1);
+  }
+  // move argument i out, so a free frame refers to nothing
+  schemetype_t take(int i) {
+    return std::move(argv()[i]);
+  }
+  int argc;
+  frame* _next_free;
+};
+class lambda : public heap_object {
+ public:
+  // run with the arguments in f, which this frees
+  virtual schemetype_t operator()(frame* f);
+  int _id;
+};
+// the most arguments a lambda may take
+#define SCHEME_MAX_ARGS 64
+// the frames no call is using, by number of arguments; a callee frees its
+// frame as soon as it has taken the arguments out, so once a program has
+// made a call of each arity, calls allocate nothing
+extern frame* _free_frames[SCHEME_MAX_ARGS + 1];
+frame* alloc_frame(int argc);
+inline frame* new_frame(int argc) {
+  frame* f = _free_frames[argc];
+  if (!f) {
+    return alloc_frame(argc);
+  }
+  _free_frames[argc] = f->_next_free;
+  return f;
+}
+// the arguments must have been moved out of f
+inline void free_frame(frame* f) {
+  f->_next_free = _free_frames[f->argc];
+  _free_frames[f->argc] = f;
+}
+// the frame of the call the trampoline makes next
+extern frame* _frame;
+inline frame* take_frame() {
+  frame* f = _frame;
+  _frame = nullptr;
+  return f;
+}
+[[noreturn]] void arity_error();
+// value impl --------------------------------------------------------------------------------------
+// an integer too big for a fixnum: its sign, and the base 2^32 digits of
+// its magnitude, least significant first, which follow the object in memory
+class bignum : public heap_object {
+ public:
+  static bignum* make(bool negative, const uint32_t* digits, size_t size) {
+    size_t bytes = sizeof(bignum) + size * sizeof(uint32_t);
+#ifdef SCHEME_GC
+    return make_at(gc_alloc(bytes), negative, digits, size);
+#else
+    return make_at(::operator new(bytes), negative, digits, size);
+#endif
+  }
+#ifdef SCHEME_GC
+  size_t gc_size() const {
+    return sizeof(bignum) + _size * sizeof(uint32_t);
+  }
+  heap_object* gc_move(void* to) {
+    return make_at(to, _negative, digits(), _size);
+  }
+#else
+  static void operator delete(void* mem) {
+    ::operator delete(mem);
+  }
+#endif
+  const uint32_t* digits() const {
+    return reinterpret_cast<const uint32_t*>(this + 1);
+  }
+  bool _negative;
+  size_t _size;
+ private:
+  bignum(bool negative, size_t size) : _negative(negative), _size(size) { }
+  static bignum* make_at(void* to, bool negative, const uint32_t* digits, size_t size) {
+    bignum* big = new (to) bignum(negative, size);
+    memcpy(reinterpret_cast<uint32_t*>(big + 1), digits, size * sizeof(uint32_t));
+    return big;
+  }
+};
+#ifdef SCHEME_TAGGED
+#ifdef SCHEME_GC
+// the characters follow the object in the heap
+class string_object : public heap_object {
+ public:
+  static string_object* make(const char* chars, size_t size) {
+    string_object* str = new (gc_alloc(sizeof(string_object) + size + 1)) string_object(size);
+    memcpy(str->chars(), chars, size + 1);
+    return str;
+  }
+  size_t gc_size() const {
+    return sizeof(string_object) + _size + 1;
+  }
+  heap_object* gc_move(void* to) {
+    return make_at(to, chars(), _size);
+  }
+  char* chars() {
+    return reinterpret_cast<char*>(this + 1);
+  }
+  size_t _size;
+ private:
+  string_object(size_t size) : _size(size) { }
+  static string_object* make_at(void* to, const char* chars, size_t size) {
+    string_object* str = new (to) string_object(size);
+    memcpy(str->chars(), chars, size + 1);
+    return str;
+  }
+};
+#else
+class string_object : public heap_object {
+ public:
+  string_object(const std::string& str) : str(str) { }
+  std::string str;
+};
+#endif
+inline schemetype_t make_big(bignum* big) {
+  profile_alloc();
+  return schemetype_t(reinterpret_cast<uintptr_t>(static_cast<heap_object*>(big)) | 4);
+}
+// num as a bignum, for when it needs all 64 bits
+schemetype_t make_big_num(long num);
+// the long big holds, which must fit one
+long big_to_long(const bignum* big);
+inline schemetype_t make_num(long num) {
+  long tagged;
+  if (__builtin_add_overflow(num, num, &tagged)) {
+    return make_big_num(num);
+  }
+  return schemetype_t(uintptr_t(tagged) | 1);
+}
+inline schemetype_t make_str(const std::string& str) {
+  profile_alloc();
+#ifdef SCHEME_GC
+  heap_object* obj = string_object::make(str.c_str(), str.size());
+#else
+  heap_object* obj = new string_object(str);
+#endif
+  return schemetype_t(reinterpret_cast<uintptr_t>(obj) | 2);
+}
+inline schemetype_t make_lam(lambda* lam) {
+  profile_alloc();
+  return schemetype_t(reinterpret_cast<uintptr_t>(static_cast<heap_object*>(lam)));
+}
+inline schemetype_t make_local_lam(local_box& box, lambda* lam) {
+#ifndef SCHEME_GC
+  lam->_refs = LOCAL_REFS;
+#endif
+  return schemetype_t(reinterpret_cast<uintptr_t>(static_cast<heap_object*>(lam)));
+}
+inline type_t type_of(const schemetype_t& var) {
+  return var.bits() & 1 ? NUM : (var.bits() & 2 ? STR : (var.bits() & 4 ? BIG : LAM));
+}
+inline long num_of(const schemetype_t& var) {
+  return static_cast<long>(var.bits()) >> 1;
+}
+#ifdef SCHEME_GC
+inline std::string str_of(const schemetype_t& var) {
+  string_object* str = static_cast<string_object*>(var.ptr());
+  return std::string(str->chars(), str->_size);
+}
+#else
+inline const std::string& str_of(const schemetype_t& var) {
+  return static_cast<string_object*>(var.ptr())->str;
+}
+#endif
+inline lambda* lam_of(const schemetype_t& var) {
+  return static_cast<lambda*>(var.ptr());
+}
+inline bignum* big_of(const schemetype_t& var) {
+  return static_cast<bignum*>(var.ptr());
+}
+// a number that fits a long, which may need all 64 bits and so be a bignum
+inline long long_of(const schemetype_t& var) {
+  return var.bits() & 1 ? num_of(var) : big_to_long(big_of(var));
+}
+inline void set_num(schemetype_t& var, long num) {
+  var = make_num(num);
+}
+#else
+class schemetype {
+ public:
+  union {
+    lambda_t lam;
+    long num;
+    std::shared_ptr<std::string> str;
+    std::shared_ptr<bignum> big;
+  };
+  type_t type;
+  schemetype();
+  ~schemetype();
+};
+typedef schemetype local_box;
+inline schemetype_t make_num(long num) {
+  profile_alloc();
+  schemetype_t var = std::make_shared<schemetype>();
+  var->type = NUM;
+  var->num = num;
+  return var;
+}
+inline schemetype_t make_str(const std::string& str) {
+  profile_alloc();
+  schemetype_t var = std::make_shared<schemetype>();
+  var->type = STR;
+  var->lam.~lambda_t();
+  new (&var->str) std::shared_ptr<std::string>(new std::string(str));
+  return var;
+}
+inline schemetype_t make_lam(lambda* lam) {
+  profile_alloc();
+  schemetype_t var = std::make_shared<schemetype>();
+  var->lam = lambda_t(lam);
+  return var;
+}
+inline schemetype_t make_big(bignum* big) {
+  profile_alloc();
+  schemetype_t var = std::make_shared<schemetype>();
+  var->type = BIG;
+  var->lam.~lambda_t();
+  new (&var->big) std::shared_ptr<bignum>(big);
+  return var;
+}
+// neither the lambda nor its box are owned by the value
+inline schemetype_t make_local_lam(local_box& box, lambda* lam) {
+  box.type = LAM;
+  box.lam = lambda_t(lambda_t(), lam);
+  return schemetype_t(schemetype_t(), &box);
+}
+inline type_t type_of(const schemetype_t& var) {
+  return var->type;
+}
+inline long num_of(const schemetype_t& var) {
+  return var->num;
+}
+// (any number that fits a long is a fixnum)
+inline long long_of(const schemetype_t& var) {
+  return var->num;
+}
+inline const std::string& str_of(const schemetype_t& var) {
+  return *var->str;
+}
+inline lambda* lam_of(const schemetype_t& var) {
+  return var->lam.get();
+}
+inline bignum* big_of(const schemetype_t& var) {
+  return var->big.get();
+}
+// store a number in var, reusing its box if nothing else refers to it
+inline void set_num(schemetype_t& var, long num) {
+  if (var.use_count() == 1 && var->type == NUM) {
+    var->num = num;
+  }
+  else {
+    var = make_num(num);
+  }
+}
+inline schemetype::schemetype() : lam(lambda_t()), type(LAM) { }
+inline schemetype::~schemetype() {
+  if (type == LAM) {
+    lam.reset();
+  }
+  else if (type == STR) {
+    str.reset();
+  }
+  else if (type == BIG) {
+    big.reset();
+  }
+}
+#endif
+// arithmetic --------------------------------------------------------------------------------------
+// Each operation takes any mix of longs and values. The result is a
+// fixnum computed with a single checked instruction, unless it overflows or
+// an operand is a bignum; then it is left to the exact, out of line *_slow.
+// Code that keeps its numbers as longs checks +, - and * itself, with
+// __builtin_*_overflow, and only calls these once one does not fit.
+schemetype_t num_add_slow(const schemetype_t& lhs, const schemetype_t& rhs);
+schemetype_t num_sub_slow(const schemetype_t& lhs, const schemetype_t& rhs);
+schemetype_t num_mul_slow(const schemetype_t& lhs, const schemetype_t& rhs);
+bool num_eq_slow(const schemetype_t& lhs, const schemetype_t& rhs);
+std::string big_to_string(const bignum* big);
+inline schemetype_t num_add(long lhs, long rhs) {
+  long num;
+  if (__builtin_add_overflow(lhs, rhs, &num)) {
+    return num_add_slow(make_num(lhs), make_num(rhs));
+  }
+  return make_num(num);
+}
+inline schemetype_t num_sub(long lhs, long rhs) {
+  long num;
+  if (__builtin_sub_overflow(lhs, rhs, &num)) {
+    return num_sub_slow(make_num(lhs), make_num(rhs));
+  }
+  return make_num(num);
+}
+inline schemetype_t num_mul(long lhs, long rhs) {
+  long num;
+  if (__builtin_mul_overflow(lhs, rhs, &num)) {
+    return num_mul_slow(make_num(lhs), make_num(rhs));
+  }
+  return make_num(num);
+}
+inline long num_eq(long lhs, long rhs) {
+  return lhs == rhs;
+}
+inline long num_zero(long num) {
+  return num == 0;
+}
+#ifdef SCHEME_TAGGED
+// (a fixnum n is the word 2n + 1, so the operations work on the words
+// themselves, and overflow exactly when the fixnum would)
+inline bool fixnums(const schemetype_t& lhs, const schemetype_t& rhs) {
+  return lhs.bits() & rhs.bits() & 1;
+}
+inline schemetype_t num_add(const schemetype_t& lhs, const schemetype_t& rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || __builtin_add_overflow(long(lhs.bits()), long(rhs.bits() - 1), &num)) {
+    return num_add_slow(lhs, rhs);
+  }
+  return schemetype_t(uintptr_t(num));
+}
+inline schemetype_t num_sub(const schemetype_t& lhs, const schemetype_t& rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || __builtin_sub_overflow(long(lhs.bits()), long(rhs.bits() - 1), &num)) {
+    return num_sub_slow(lhs, rhs);
+  }
+  return schemetype_t(uintptr_t(num));
+}
+inline schemetype_t num_mul(const schemetype_t& lhs, const schemetype_t& rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || __builtin_mul_overflow(num_of(lhs), long(rhs.bits() - 1), &num)) {
+    return num_mul_slow(lhs, rhs);
+  }
+  return schemetype_t(uintptr_t(num) | 1);
+}
+// a number is a fixnum whenever it fits one, so equal fixnums are equal words
+inline long num_eq(const schemetype_t& lhs, const schemetype_t& rhs) {
+  if (fixnums(lhs, rhs)) {
+    return lhs.bits() == rhs.bits();
+  }
+  return num_eq_slow(lhs, rhs);
+}
+inline long num_zero(const schemetype_t& num) {
+  return num.bits() == 1;
+}
+#else
+inline bool fixnums(const schemetype_t& lhs, const schemetype_t& rhs) {
+  return lhs->type == NUM && rhs->type == NUM;
+}
+inline schemetype_t num_add(const schemetype_t& lhs, const schemetype_t& rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || __builtin_add_overflow(lhs->num, rhs->num, &num)) {
+    return num_add_slow(lhs, rhs);
+  }
+  return make_num(num);
+}
+inline schemetype_t num_sub(const schemetype_t& lhs, const schemetype_t& rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || __builtin_sub_overflow(lhs->num, rhs->num, &num)) {
+    return num_sub_slow(lhs, rhs);
+  }
+  return make_num(num);
+}
+inline schemetype_t num_mul(const schemetype_t& lhs, const schemetype_t& rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || __builtin_mul_overflow(lhs->num, rhs->num, &num)) {
+    return num_mul_slow(lhs, rhs);
+  }
+  return make_num(num);
+}
+inline long num_eq(const schemetype_t& lhs, const schemetype_t& rhs) {
+  if (fixnums(lhs, rhs)) {
+    return lhs->num == rhs->num;
+  }
+  return num_eq_slow(lhs, rhs);
+}
+inline long num_zero(const schemetype_t& num) {
+  return num->type == NUM && num->num == 0;
+}
+#endif
+// a value and a long, for when only one operand is native: the long is
+// only boxed if the other operand is not a fixnum, or the result overflows
+inline schemetype_t num_add(const schemetype_t& lhs, long rhs) {
+  long num;
+  if (type_of(lhs) != NUM || __builtin_add_overflow(num_of(lhs), rhs, &num)) {
+    return num_add_slow(lhs, make_num(rhs));
+  }
+  return make_num(num);
+}
+inline schemetype_t num_add(long lhs, const schemetype_t& rhs) {
+  return num_add(rhs, lhs);
+}
+inline schemetype_t num_sub(const schemetype_t& lhs, long rhs) {
+  long num;
+  if (type_of(lhs) != NUM || __builtin_sub_overflow(num_of(lhs), rhs, &num)) {
+    return num_sub_slow(lhs, make_num(rhs));
+  }
+  return make_num(num);
+}
+inline schemetype_t num_sub(long lhs, const schemetype_t& rhs) {
+  long num;
+  if (type_of(rhs) != NUM || __builtin_sub_overflow(lhs, num_of(rhs), &num)) {
+    return num_sub_slow(make_num(lhs), rhs);
+  }
+  return make_num(num);
+}
+inline schemetype_t num_mul(const schemetype_t& lhs, long rhs) {
+  long num;
+  if (type_of(lhs) != NUM || __builtin_mul_overflow(num_of(lhs), rhs, &num)) {
+    return num_mul_slow(lhs, make_num(rhs));
+  }
+  return make_num(num);
+}
+inline schemetype_t num_mul(long lhs, const schemetype_t& rhs) {
+  return num_mul(rhs, lhs);
+}
+// (a long may not fit a fixnum, so a bignum may still equal it)
+inline long num_eq(const schemetype_t& lhs, long rhs) {
+  if (type_of(lhs) == NUM) {
+    return num_of(lhs) == rhs;
+  }
+  return num_eq_slow(lhs, make_num(rhs));
+}
+inline long num_eq(long lhs, const schemetype_t& rhs) {
+  return num_eq(rhs, lhs);
+}
+// store var in num if it is a fixnum, for code that keeps numbers as longs
+// on the assumption that they fit one
+inline bool fixnum_of(const schemetype_t& var, long& num) {
+  if (type_of(var) != NUM) {
+    return false;
+  }
+  num = num_of(var);
+  return true;
+}
+// whether a value counts as true: anything but #f, which is the number 0
+inline long num_true(const schemetype_t& val) {
+  return type_of(val) != NUM || num_of(val) != 0;
+}
+// calls -------------------------------------------------------------------------------------------
+// run lam with the arguments in f, which this frees; every program defines
+// its own
+schemetype_t dispatch(lambda* lam, frame* f);
+// pass the arguments of the call the trampoline makes next
+template <class... A> inline void pass_args(A&&... args) {
+  _frame = new_frame(sizeof...(A));
+  schemetype_t* argv = _frame->argv();
+  int assigned[] = { 0, (*argv++ = std::forward<A>(args), 0)... };
+  (void) assigned;
+}
+// call a lambda whose arguments have been passed
+inline schemetype_t call_next(const schemetype_t& next) {
+#ifdef SCHEME_MTA
+  if (type_of(next) == LAM && direct_ok()) {
+    return dispatch(lam_of(next), take_frame());
+  }
+#endif
+  return bounce(next);
+}
+// print the value a program halts with, and return its exit status
+schemetype_t halt_value(const schemetype_t& value);
+// run the lambda next and the ones it returns until one returns a number,
+// then exit with it
+[[noreturn]] void trampoline(schemetype_t next);
+// mark the start of the program; with SCHEME_MTA, a restart comes back here
+// and carries on in the trampoline
+#ifdef SCHEME_PROFILE
+#define SCHEME_PROFILE_START() profile_start();
+#else
+#define SCHEME_PROFILE_START()
+#endif
+#ifdef SCHEME_MTA
+#define SCHEME_START() \
+  SCHEME_PROFILE_START() \
+  _mta_base = mta_frame(); \
+  if (setjmp(_mta_restart)) { \
+    trampoline(_mta_next); \
+  }
+#else
+#define SCHEME_START() SCHEME_PROFILE_START()
+#endif
+#endif
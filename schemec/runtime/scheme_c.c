@@ -0,0 +1,344 @@
+#include "scheme_c.h"
+static void* checked_realloc(void* mem, size_t size) {
+  mem = realloc(mem, size);
+  if (!mem) {
+    printf("error: out of memory\n");
+    exit(-1);
+  }
+  return mem;
+}
+// values ------------------------------------------------------------------------------------------
+gc_chunk* _gc_chunks = NULL;
+size_t _gc_nchunks = 0;
+size_t _gc_allocated = 0;
+size_t _gc_threshold = SCHEME_GC_NURSERY;
+static size_t _gc_chunks_capacity = 0;
+static gc_chunk _gc_to;
+static schemetype_t** _gc_roots = NULL;
+static size_t _gc_nroots = 0;
+static size_t _gc_roots_capacity = 0;
+static gc_chunk make_chunk(size_t size) {
+  gc_chunk chunk;
+  chunk.begin = (char*) checked_realloc(NULL, size);
+  chunk.top = chunk.begin;
+  chunk.end = chunk.begin + size;
+  return chunk;
+}
+static void add_chunk(gc_chunk chunk) {
+  if (_gc_nchunks == _gc_chunks_capacity) {
+    _gc_chunks_capacity = _gc_chunks_capacity ? 2 * _gc_chunks_capacity : 8;
+    _gc_chunks = (gc_chunk*) checked_realloc(_gc_chunks, _gc_chunks_capacity * sizeof(gc_chunk));
+  }
+  _gc_chunks[_gc_nchunks++] = chunk;
+}
+void gc_new_chunk(size_t size) {
+  add_chunk(make_chunk(size));
+}
+void gc_root(schemetype_t* var) {
+  if (_gc_nroots == _gc_roots_capacity) {
+    _gc_roots_capacity = _gc_roots_capacity ? 2 * _gc_roots_capacity : 64;
+    _gc_roots = (schemetype_t**) checked_realloc(_gc_roots, _gc_roots_capacity * sizeof(schemetype_t*));
+  }
+  _gc_roots[_gc_nroots++] = var;
+}
+static int gc_in_from_space(heap_object* obj) {
+  char* at = (char*) obj;
+  size_t i;
+  for (i = 0; i < _gc_nchunks; ++i) {
+    if (at >= _gc_chunks[i].begin && at < _gc_chunks[i].top) {
+      return 1;
+    }
+  }
+  return 0;
+}
+// point var at the to-space copy of what it refers to, copying it first
+// if need be
+static void gc_forward(schemetype_t* var) {
+  heap_object* obj;
+  if (!*var || *var & 1 || !gc_in_from_space(ptr_of(*var))) {
+    return;
+  }
+  obj = ptr_of(*var);
+  if (!obj->forward) {
+    memcpy(_gc_to.top, obj, obj->size);
+    obj->forward = (heap_object*) _gc_to.top;
+    _gc_to.top += obj->size;
+  }
+  *var = (schemetype_t) obj->forward | (*var & 7);
+}
+void gc_collect(schemetype_t* next) {
+  char* scan;
+  size_t i;
+  int j;
+  // nothing survives that was not allocated since the last collection
+  _gc_to = make_chunk(_gc_allocated ? _gc_allocated : 8);
+  gc_forward(next);
+  for (i = 0; i < _gc_nroots; ++i) {
+    gc_forward(_gc_roots[i]);
+  }
+  for (j = 0; j < _argc; ++j) {
+    gc_forward(&_argv[j]);
+  }
+  for (scan = _gc_to.begin; scan < _gc_to.top; ) {
+    heap_object* obj = (heap_object*) scan;
+    if (obj->type == LAM) {
+      closure* lam = (closure*) obj;
+      for (j = 0; j < lam->nholes; ++j) {
+        gc_forward(&lam->holes[j]);
+      }
+    }
+    scan += obj->size;
+  }
+  for (i = 0; i < _gc_nchunks; ++i) {
+    free(_gc_chunks[i].begin);
+  }
+  _gc_nchunks = 0;
+  add_chunk(_gc_to);
+  _gc_allocated = _gc_to.top - _gc_to.begin;
+  _gc_threshold = 2 * _gc_allocated > SCHEME_GC_NURSERY ? 2 * _gc_allocated : SCHEME_GC_NURSERY;
+}
+schemetype_t make_str(const char* chars, size_t len) {
+  string_object* str = (string_object*) gc_alloc(STR, sizeof(string_object) + len + 1);
+  str->len = len;
+  memcpy(str->chars, chars, len);
+  str->chars[len] = '\0';
+  return (schemetype_t) str | 2;
+}
+// arithmetic --------------------------------------------------------------------------------------
+// a number as the slow paths work on it: its sign, and the base 2^32 digits
+// of its magnitude, least significant first and without leading zeros
+typedef struct bigint {
+  int negative;
+  size_t ndigits;
+  const uint32_t* digits;
+  // the digits of a fixnum
+  uint32_t buf[2];
+} bigint;
+static void long_to_bigint(long num, bigint* big) {
+  uint64_t mag = num < 0 ? -(uint64_t) num : (uint64_t) num;
+  big->negative = num < 0;
+  big->ndigits = 0;
+  for (; mag; mag >>= 32) {
+    big->buf[big->ndigits++] = (uint32_t) mag;
+  }
+  big->digits = big->buf;
+}
+static void to_bigint(schemetype_t var, bigint* big) {
+  switch (type_of(var)) {
+   case NUM:
+    long_to_bigint(num_of(var), big);
+    break;
+   case BIG:
+    big->negative = big_of(var)->negative;
+    big->ndigits = big_of(var)->ndigits;
+    big->digits = big_of(var)->digits;
+    break;
+   default:
+    printf("error: arithmetic on a non-number\n");
+    exit(-1);
+  }
+}
+static schemetype_t new_bignum(int negative, const uint32_t* digits, size_t ndigits) {
+  bignum* big = (bignum*) gc_alloc(BIG, sizeof(bignum) + ndigits * sizeof(uint32_t));
+  big->negative = negative;
+  big->ndigits = ndigits;
+  memcpy(big->digits, digits, ndigits * sizeof(uint32_t));
+  return (schemetype_t) big | 4;
+}
+// the number with the given sign and digits, as a fixnum if it fits one;
+// this frees digits
+static schemetype_t from_digits(int negative, uint32_t* digits, size_t ndigits) {
+  schemetype_t num;
+  while (ndigits && !digits[ndigits - 1]) {
+    --ndigits;
+  }
+  if (ndigits <= 2) {
+    uint64_t mag = 0;
+    size_t i;
+    for (i = 0; i < ndigits; ++i) {
+      mag |= (uint64_t) digits[i] << (32 * i);
+    }
+    if (mag <= (uint64_t) LONG_MAX) {
+      free(digits);
+      return make_num(negative ? -(long) mag : (long) mag);
+    }
+    if (negative && mag == (uint64_t) LONG_MAX + 1) {
+      free(digits);
+      return make_num(LONG_MIN);
+    }
+  }
+  num = new_bignum(negative, digits, ndigits);
+  free(digits);
+  return num;
+}
+static int compare_mags(const bigint* lhs, const bigint* rhs) {
+  size_t i;
+  if (lhs->ndigits != rhs->ndigits) {
+    return lhs->ndigits < rhs->ndigits ? -1 : 1;
+  }
+  for (i = lhs->ndigits; i-- > 0; ) {
+    if (lhs->digits[i] != rhs->digits[i]) {
+      return lhs->digits[i] < rhs->digits[i] ? -1 : 1;
+    }
+  }
+  return 0;
+}
+// lhs + rhs, with rhs taken to have the sign rhs_negative
+static schemetype_t add_bigints(const bigint* lhs, const bigint* rhs, int rhs_negative) {
+  size_t size = (lhs->ndigits > rhs->ndigits ? lhs->ndigits : rhs->ndigits) + 1;
+  uint32_t* digits = (uint32_t*) checked_realloc(NULL, size * sizeof(uint32_t));
+  size_t i;
+  if (lhs->negative == rhs_negative) {
+    uint64_t carry = 0;
+    for (i = 0; i < size; ++i) {
+      carry += (uint64_t) (i < lhs->ndigits ? lhs->digits[i] : 0) + (i < rhs->ndigits ? rhs->digits[i] : 0);
+      digits[i] = (uint32_t) carry;
+      carry >>= 32;
+    }
+    return from_digits(rhs_negative, digits, size);
+  }
+  else {
+    // subtract the smaller magnitude from the bigger one, whose sign wins
+    int flip = compare_mags(lhs, rhs) < 0;
+    const bigint* big = flip ? rhs : lhs;
+    const bigint* small = flip ? lhs : rhs;
+    int64_t borrow = 0;
+    for (i = 0; i < big->ndigits; ++i) {
+      int64_t digit = (int64_t) big->digits[i] - (i < small->ndigits ? small->digits[i] : 0) - borrow;
+      borrow = digit < 0;
+      digits[i] = (uint32_t) (digit + (borrow << 32));
+    }
+    return from_digits(flip ? rhs_negative : lhs->negative, digits, big->ndigits);
+  }
+}
+schemetype_t make_big_num(long num) {
+  bigint big;
+  long_to_bigint(num, &big);
+  return new_bignum(big.negative, big.digits, big.ndigits);
+}
+schemetype_t num_add_slow(schemetype_t lhs, schemetype_t rhs) {
+  bigint a, b;
+  to_bigint(lhs, &a);
+  to_bigint(rhs, &b);
+  return add_bigints(&a, &b, b.negative);
+}
+schemetype_t num_sub_slow(schemetype_t lhs, schemetype_t rhs) {
+  bigint a, b;
+  to_bigint(lhs, &a);
+  to_bigint(rhs, &b);
+  return add_bigints(&a, &b, !b.negative);
+}
+schemetype_t num_mul_slow(schemetype_t lhs, schemetype_t rhs) {
+  bigint a, b;
+  uint32_t* digits;
+  size_t i, j;
+  to_bigint(lhs, &a);
+  to_bigint(rhs, &b);
+  digits = (uint32_t*) checked_realloc(NULL, (a.ndigits + b.ndigits + 1) * sizeof(uint32_t));
+  memset(digits, 0, (a.ndigits + b.ndigits + 1) * sizeof(uint32_t));
+  for (i = 0; i < a.ndigits; ++i) {
+    uint64_t carry = 0;
+    for (j = 0; j < b.ndigits || carry; ++j) {
+      carry += digits[i + j] + (j < b.ndigits ? (uint64_t) a.digits[i] * b.digits[j] : 0);
+      digits[i + j] = (uint32_t) carry;
+      carry >>= 32;
+    }
+  }
+  return from_digits(a.negative != b.negative, digits, a.ndigits + b.ndigits + 1);
+}
+int num_eq_slow(schemetype_t lhs, schemetype_t rhs) {
+  bigint a, b;
+  to_bigint(lhs, &a);
+  to_bigint(rhs, &b);
+  return a.negative == b.negative && !compare_mags(&a, &b);
+}
+static void print_big(const bignum* big) {
+  // divide by 10^9 until nothing is left, taking nine digits at a time
+  size_t size = big->ndigits;
+  uint32_t* mag = (uint32_t*) checked_realloc(NULL, size * sizeof(uint32_t));
+  uint32_t* parts = (uint32_t*) checked_realloc(NULL, (size * 10 / 9 + 2) * sizeof(uint32_t));
+  size_t nparts = 0;
+  memcpy(mag, big->digits, size * sizeof(uint32_t));
+  while (size) {
+    uint64_t rem = 0;
+    size_t i;
+    for (i = size; i-- > 0; ) {
+      uint64_t cur = (rem << 32) | mag[i];
+      mag[i] = (uint32_t) (cur / 1000000000);
+      rem = cur % 1000000000;
+    }
+    while (size && !mag[size - 1]) {
+      --size;
+    }
+    parts[nparts++] = (uint32_t) rem;
+  }
+  printf("%s%u", big->negative ? "-" : "", (unsigned) parts[nparts - 1]);
+  while (nparts-- > 1) {
+    printf("%09u", (unsigned) parts[nparts - 1]);
+  }
+  printf("\n");
+  free(mag);
+  free(parts);
+}
+// strings -----------------------------------------------------------------------------------------
+schemetype_t str_append(schemetype_t lhs, schemetype_t rhs) {
+  string_object* a = str_of(lhs);
+  string_object* b = str_of(rhs);
+  string_object* str = (string_object*) gc_alloc(STR, sizeof(string_object) + a->len + b->len + 1);
+  str->len = a->len + b->len;
+  memcpy(str->chars, a->chars, a->len);
+  memcpy(str->chars + a->len, b->chars, b->len + 1);
+  return (schemetype_t) str | 2;
+}
+schemetype_t str_eq(schemetype_t lhs, schemetype_t rhs) {
+  string_object* a = str_of(lhs);
+  string_object* b = str_of(rhs);
+  return a->len == b->len && !memcmp(a->chars, b->chars, a->len) ? 3 : 1;
+}
+// calls -------------------------------------------------------------------------------------------
+schemetype_t _argv[SCHEME_MAX_ARGS];
+int _argc = 0;
+void arity_error(void) {
+  printf("error: lambda called with an improper number of arguments\n");
+  exit(-1);
+}
+static schemetype_t halt_entry(closure* self) {
+  if (_argc != 1) {
+    arity_error();
+  }
+  return halt_value(_argv[0]);
+}
+// (not on the heap, so the collector leaves it be)
+closure _halt_closure = { { LAM, sizeof(closure), NULL }, halt_entry, 0 };
+// main --------------------------------------------------------------------------------------------
+schemetype_t halt_value(schemetype_t value) {
+  switch (type_of(value)) {
+   case LAM:
+    printf("you want to return a lambda?! really?!\n");
+    return make_num(-1);
+   case NUM:
+    printf("%ld\n", num_of(value));
+    return make_num(0);
+   case STR:
+    fwrite(str_of(value)->chars, 1, str_of(value)->len, stdout);
+    printf("\n");
+    return make_num(0);
+   case BIG:
+    print_big(big_of(value));
+    return make_num(0);
+   default:
+    printf("error: but our number value is %ld\n", num_of(value));
+    return make_num(-1);
+  }
+}
+void trampoline(schemetype_t next) {
+  while (type_of(next) == LAM) {
+    gc_safepoint(&next);
+    next = lam_of(next)->entry(lam_of(next));
+  }
+  if (type_of(next) != NUM) {
+    printf("error: non-number type in return value\n");
+    exit(-1);
+  }
+  exit(num_of(next));
+}
@@ -0,0 +1,236 @@
+// The runtime shared by every program gen_c compiles: a plain C99 version
+// of scheme.h, built with SCHEME_GC's representation, for compilers (cc,
+// tcc) that build it much faster than the C++ one.
+//
+// The representation of values, which is all the generated code relies on:
+//   schemetype_t                   a value, a single tagged word
+//   make_num, make_str, new_closure
+//   make_lam, lam_of, type_of
+//   num_add, num_sub, num_mul      exact arithmetic on values
+//   num_eq, num_zero, num_true
+//   str_append, str_eq
+//   gc_root                        register a global
+// Numbers (and booleans) are fixnums unless they do not fit one, in which
+// case they are bignums. Closures, strings and bignums are bump allocated,
+// and reclaimed by a copying collector that runs between two trips through
+// the trampoline, when the only live values are the roots, the lambda
+// called next and its arguments.
+//
+// A call passes its arguments in _argv and returns the lambda to call to
+// the trampoline, which calls its entry.
+#ifndef SCHEME_C_H
+#define SCHEME_C_H
+#include <limits.h>
+#include <stddef.h>
+#include <stdint.h>
+#include <stdio.h>
+#include <stdlib.h>
+#include <string.h>
+typedef enum { LAM, NUM, STR, BIG } type_t;
+// values ------------------------------------------------------------------------------------------
+// low bits: ...1 number, .000 lambda, .010 string, .100 bignum
+typedef uintptr_t schemetype_t;
+#ifndef SCHEME_GC_NURSERY
+#define SCHEME_GC_NURSERY (4L << 20)
+#endif
+// every object starts with its type and size, so the collector can walk
+// to-space; forward is its copy there, once it has been copied
+typedef struct heap_object {
+  type_t type;
+  size_t size;
+  struct heap_object* forward;
+} heap_object;
+struct closure;
+typedef schemetype_t (*entry_t)(struct closure* self);
+// a lambda and the values of the variables it captured
+typedef struct closure {
+  heap_object obj;
+  entry_t entry;
+  int nholes;
+  schemetype_t holes[];
+} closure;
+typedef struct string_object {
+  heap_object obj;
+  size_t len;
+  char chars[];
+} string_object;
+// an integer too big for a fixnum: its sign, and the base 2^32 digits of
+// its magnitude, least significant first
+typedef struct bignum {
+  heap_object obj;
+  int negative;
+  size_t ndigits;
+  uint32_t digits[];
+} bignum;
+// objects are bump allocated out of chunks; all of those allocated since
+// the last collection form from-space
+typedef struct gc_chunk {
+  char* begin;
+  char* top;
+  char* end;
+} gc_chunk;
+extern gc_chunk* _gc_chunks;
+extern size_t _gc_nchunks;
+extern size_t _gc_allocated;
+extern size_t _gc_threshold;
+static inline size_t gc_round(size_t size) {
+  return (size + 7) & ~(size_t) 7;
+}
+void gc_new_chunk(size_t size);
+static inline heap_object* gc_alloc(type_t type, size_t size) {
+  gc_chunk* chunk;
+  heap_object* obj;
+  size = gc_round(size);
+  if (!_gc_nchunks || _gc_chunks[_gc_nchunks - 1].top + size > _gc_chunks[_gc_nchunks - 1].end) {
+    gc_new_chunk(size > SCHEME_GC_NURSERY ? size : SCHEME_GC_NURSERY);
+  }
+  chunk = &_gc_chunks[_gc_nchunks - 1];
+  obj = (heap_object*) chunk->top;
+  chunk->top += size;
+  _gc_allocated += size;
+  obj->type = type;
+  obj->size = size;
+  obj->forward = NULL;
+  return obj;
+}
+void gc_root(schemetype_t* var);
+// collect if enough has been allocated; next and the arguments in _argv
+// must be the only live values outside the roots
+void gc_collect(schemetype_t* next);
+static inline void gc_safepoint(schemetype_t* next) {
+  if (_gc_allocated > _gc_threshold) {
+    gc_collect(next);
+  }
+}
+static inline type_t type_of(schemetype_t var) {
+  return var & 1 ? NUM : (var & 2 ? STR : (var & 4 ? BIG : LAM));
+}
+static inline heap_object* ptr_of(schemetype_t var) {
+  return (heap_object*) (var & ~(uintptr_t) 7);
+}
+static inline long num_of(schemetype_t var) {
+  return (long) var >> 1;
+}
+static inline closure* lam_of(schemetype_t var) {
+  return (closure*) var;
+}
+static inline string_object* str_of(schemetype_t var) {
+  return (string_object*) (var - 2);
+}
+static inline bignum* big_of(schemetype_t var) {
+  return (bignum*) (var - 4);
+}
+static inline schemetype_t make_lam(closure* lam) {
+  return (schemetype_t) lam;
+}
+// a closure of entry, whose nholes holes the caller fills in
+static inline closure* new_closure(entry_t entry, int nholes) {
+  closure* lam = (closure*) gc_alloc(LAM, sizeof(closure) + nholes * sizeof(schemetype_t));
+  lam->entry = entry;
+  lam->nholes = nholes;
+  return lam;
+}
+schemetype_t make_str(const char* chars, size_t len);
+// num as a bignum, for when it needs all 64 bits
+schemetype_t make_big_num(long num);
+// (tcc has no __builtin_*_overflow, so other compilers check by hand)
+#if defined(__GNUC__) && !defined(__TINYC__)
+#define add_overflow(lhs, rhs, out) __builtin_add_overflow(lhs, rhs, out)
+#define sub_overflow(lhs, rhs, out) __builtin_sub_overflow(lhs, rhs, out)
+#define mul_overflow(lhs, rhs, out) __builtin_mul_overflow(lhs, rhs, out)
+#else
+static inline int add_overflow(long lhs, long rhs, long* out) {
+  if (rhs > 0 ? lhs > LONG_MAX - rhs : lhs < LONG_MIN - rhs) {
+    return 1;
+  }
+  *out = lhs + rhs;
+  return 0;
+}
+static inline int sub_overflow(long lhs, long rhs, long* out) {
+  if (rhs < 0 ? lhs > LONG_MAX + rhs : lhs < LONG_MIN + rhs) {
+    return 1;
+  }
+  *out = lhs - rhs;
+  return 0;
+}
+static inline int mul_overflow(long lhs, long rhs, long* out) {
+  if (lhs > 0 ? (rhs > 0 ? lhs > LONG_MAX / rhs : rhs < LONG_MIN / lhs)
+      : (rhs > 0 ? lhs < LONG_MIN / rhs : lhs && rhs < LONG_MAX / lhs)) {
+    return 1;
+  }
+  *out = lhs * rhs;
+  return 0;
+}
+#endif
+static inline schemetype_t make_num(long num) {
+  long tagged;
+  if (add_overflow(num, num, &tagged)) {
+    return make_big_num(num);
+  }
+  return (schemetype_t) tagged | 1;
+}
+// arithmetic --------------------------------------------------------------------------------------
+// A fixnum n is the word 2n + 1, so the operations work on the words
+// themselves, and overflow exactly when the fixnum would. Anything else is
+// left to the exact, out of line *_slow.
+schemetype_t num_add_slow(schemetype_t lhs, schemetype_t rhs);
+schemetype_t num_sub_slow(schemetype_t lhs, schemetype_t rhs);
+schemetype_t num_mul_slow(schemetype_t lhs, schemetype_t rhs);
+int num_eq_slow(schemetype_t lhs, schemetype_t rhs);
+static inline int fixnums(schemetype_t lhs, schemetype_t rhs) {
+  return lhs & rhs & 1;
+}
+static inline schemetype_t num_add(schemetype_t lhs, schemetype_t rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || add_overflow((long) lhs, (long) (rhs - 1), &num)) {
+    return num_add_slow(lhs, rhs);
+  }
+  return (schemetype_t) num;
+}
+static inline schemetype_t num_sub(schemetype_t lhs, schemetype_t rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || sub_overflow((long) lhs, (long) (rhs - 1), &num)) {
+    return num_sub_slow(lhs, rhs);
+  }
+  return (schemetype_t) num;
+}
+static inline schemetype_t num_mul(schemetype_t lhs, schemetype_t rhs) {
+  long num;
+  if (!fixnums(lhs, rhs) || mul_overflow(num_of(lhs), (long) (rhs - 1), &num)) {
+    return num_mul_slow(lhs, rhs);
+  }
+  return (schemetype_t) num | 1;
+}
+// a number is a fixnum whenever it fits one, so equal fixnums are equal
+// words; the comparisons give booleans, the fixnums 0 and 1
+static inline schemetype_t num_eq(schemetype_t lhs, schemetype_t rhs) {
+  if (fixnums(lhs, rhs)) {
+    return lhs == rhs ? 3 : 1;
+  }
+  return num_eq_slow(lhs, rhs) ? 3 : 1;
+}
+static inline schemetype_t num_zero(schemetype_t num) {
+  return num == 1 ? 3 : 1;
+}
+// whether a value counts as true: anything but #f, which is the number 0
+static inline int num_true(schemetype_t val) {
+  return val != 1;
+}
+// strings -----------------------------------------------------------------------------------------
+schemetype_t str_append(schemetype_t lhs, schemetype_t rhs);
+schemetype_t str_eq(schemetype_t lhs, schemetype_t rhs);
+// calls -------------------------------------------------------------------------------------------
+// the most arguments a lambda may take
+#define SCHEME_MAX_ARGS 64
+// the arguments of the call the trampoline makes next
+extern schemetype_t _argv[SCHEME_MAX_ARGS];
+extern int _argc;
+// the continuation the program finishes with
+extern closure _halt_closure;
+void arity_error(void);
+// print the value a program halts with, and return its exit status
+schemetype_t halt_value(schemetype_t value);
+// run the lambda next and the ones it returns until one returns a number,
+// then exit with it
+void trampoline(schemetype_t next);
+#endif
@@ -46,8 +46,12 @@ def tokenize(txt):
     return tokens
 
 def parse(txt):
+    return parse_tokens(tokenize(txt))
+
+def parse_tokens(tokens):
+    """Parse the tokens of a program, as returned by tokenize."""
     stack = [[]]
-    for token in tokenize(txt):
+    for token in tokens:
         if token.val == LPAR:
             stack.append(SExp(token.pos))
         elif token.val == RPAR:
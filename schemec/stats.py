@@ -0,0 +1,144 @@
+from time import perf_counter
+import tracemalloc
+
+from schemec.ast import to_exp
+from schemec.cps import T_c
+from schemec.gencpp import gen_cpp, halt, pretty_cpp
+from schemec.opt import optimize
+from schemec.sexp import parse_tokens, tokenize
+from schemec.typs import SExp, Token, subexps
+
+__all__ = [
+    'Phase',
+    'Stats',
+    'compile_stats',
+    'count_nodes'
+    ]
+
+def count_nodes(value):
+    """The size of what a phase takes or gives: the number of tokens, of
+    S-expressions and tokens, of expressions, of lambdas (for the holes) or
+    of lines (for text), or None for anything else."""
+    if isinstance(value, str):
+        return value.count('\n') + 1
+    elif isinstance(value, Token):
+        return 1
+    elif isinstance(value, list):
+        # tokenize gives a plain list of Tokens, parse a tree of SExps
+        todo = list(value)
+        n = 1 if isinstance(value, SExp) else 0
+        while todo:
+            val = todo.pop()
+            n += 1
+            if isinstance(val, list):
+                todo.extend(val)
+        return n
+    elif isinstance(value, dict):
+        return len(value)
+    elif hasattr(value, 'children'):
+        return sum(1 for _ in subexps(value))
+    else:
+        return None
+
+class Phase:
+    """What running one phase of the compiler cost.
+
+    @type name: String
+    @param name: The function run, e.g. 'cps.T_c'
+    @type seconds: Float
+    @param seconds: The wall time it took
+    @type peak_bytes: Int
+    @param peak_bytes: The most memory it had allocated at any one time,
+        beyond what was allocated when it started, or None if memory was not
+        traced
+    @type nodes_in: Int
+    @param nodes_in: The size of its input (see count_nodes)
+    @type nodes_out: Int
+    @param nodes_out: The size of its output
+    """
+    def __init__(self, name, seconds, peak_bytes, nodes_in, nodes_out):
+        self.name = name
+        self.seconds = seconds
+        self.peak_bytes = peak_bytes
+        self.nodes_in = nodes_in
+        self.nodes_out = nodes_out
+    def as_dict(self):
+        return {
+            'name': self.name,
+            'seconds': self.seconds,
+            'peak_bytes': self.peak_bytes,
+            'nodes_in': self.nodes_in,
+            'nodes_out': self.nodes_out
+            }
+    def __repr__(self):
+        return 'Phase({0!r}, {1!r}, {2!r}, {3!r}, {4!r})'.format(
+            self.name, self.seconds, self.peak_bytes, self.nodes_in, self.nodes_out)
+
+class Stats:
+    """The Phases of a compilation, in the order they ran.
+
+    @type memory: Bool
+    @param memory: Whether to trace the memory each phase allocates, with
+        tracemalloc, which makes every phase several times slower
+    """
+    def __init__(self, memory=True):
+        self.memory = memory
+        self.phases = []
+
+    def run(self, name, func, arg, *args, **kwargs):
+        """Call func(arg, *args, **kwargs) and record what it cost as the
+        phase name, whose input is arg. Return what func returns."""
+        nodes_in = count_nodes(arg)
+        tracing = self.memory and not tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.start()
+        if self.memory:
+            start_bytes = tracemalloc.get_traced_memory()[0]
+            tracemalloc.reset_peak()
+        start = perf_counter()
+        try:
+            result = func(arg, *args, **kwargs)
+        finally:
+            seconds = perf_counter() - start
+            peak_bytes = None
+            if self.memory:
+                peak_bytes = tracemalloc.get_traced_memory()[1] - start_bytes
+            if tracing:
+                tracemalloc.stop()
+        self.phases.append(Phase(name, seconds, peak_bytes, nodes_in, count_nodes(result)))
+        return result
+
+    def total_seconds(self):
+        """The time the compilation took, the sum of that of its phases."""
+        return sum(phase.seconds for phase in self.phases)
+
+    def as_dict(self):
+        """The stats as plain data, e.g. for json.dump."""
+        return {
+            'phases': [phase.as_dict() for phase in self.phases],
+            'total_seconds': self.total_seconds()
+            }
+
+def compile_stats(source, options=None, memory=True):
+    """Compile the Scheme program source to C++ as compile_scheme does,
+    recording the cost of each phase. gen_cpp records its own steps:
+    sanitize, compute_holes, the rest of the compilation and the writing of
+    the C++.
+
+    @type source: String
+    @param source: The text of the program
+    @type options: A dict
+    @param options: The keyword arguments to optimize
+    @type memory: Bool
+    @param memory: Whether to trace the memory each phase allocates
+    @rtype: A tuple of the (pretty printed) C++ and the Stats
+    """
+    stats = Stats(memory)
+    tokens = stats.run('sexp.tokenize', tokenize, source)
+    sexp = stats.run('sexp.parse', parse_tokens, tokens)
+    tree = stats.run('ast.to_exp', to_exp, sexp)
+    exp = stats.run('cps.T_c', T_c, tree, halt)
+    exp = stats.run('opt.optimize', optimize, exp, **(options or {}))
+    code = gen_cpp(exp, standalone=False, stats=stats)
+    code = stats.run('gencpp.pretty_cpp', pretty_cpp, code)
+    return code, stats
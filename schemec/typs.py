@@ -21,19 +21,30 @@ __all__ = [
     'BeginExp',
     'SetExp',
     'SetThenExp',
+    'GenSym',
     'gensym',
+    'subexps',
     'unkpos'
     ]
 
 class GenSym:
-    n = 1
-    @classmethod
-    def __call__(cls, sym=''):
-        sym += str(cls.n)
-        cls.n += 1
+    """Make fresh variables, each GenSym numbering its own from 1."""
+    def __init__(self):
+        self.n = 1
+    def __call__(self, sym=''):
+        sym += str(self.n)
+        self.n += 1
         return VarExp(sym)
 gensym = GenSym()
 
+def subexps(exp):
+    """Iterate over exp and every expression below it, in pre-order."""
+    todo = [exp]
+    while todo:
+        exp = todo.pop()
+        yield exp
+        todo.extend(reversed(exp.children()))
+
 ################################################################################
 ## Parser types
 ################################################################################
@@ -74,6 +85,8 @@ unkpos = Pos(-1, -1)
 class AtomicExp:
     def map(self, f, skip=True):
         return f(self)
+    def children(self):
+        return []
     def toSExp(self):
         tok = Token(unkpos, repr(self))
         return tok
@@ -154,22 +167,29 @@ class LamExp(AtomicExp):
     @param argExps: The formal parameters of the lambda
     @type bodyExp: Any Scheme expression
     @param bodyExp: The body of the lambda
+    @type pos: Pos
+    @param pos: Where in the source the lambda comes from: the lambda
+        itself, or for a continuation, the expression it continues
     """
-    def __init__(self, argExps, bodyExp):
+    def __init__(self, argExps, bodyExp, pos=unkpos):
         if isinstance(argExps, AppExp):
             argExps = argExps.tolist()
         self.argExps = argExps
         self.bodyExp = bodyExp
+        self.pos = pos
         self.name = 'lambda_%d' % LamExp.n
         LamExp.n += 1
 
     def map(self, f, skip=True):
         if not skip:
             f(self)
-        lam = LamExp([v.map(f, skip) for v in self.argExps], self.bodyExp.map(f, skip))
+        lam = LamExp([v.map(f, skip) for v in self.argExps], self.bodyExp.map(f, skip), self.pos)
         lam.name = self.name
         return f(lam)
 
+    def children(self):
+        return [self.bodyExp]
+
     def __repr__(self):
         return pretty(self.toSExp())
 
@@ -195,10 +215,13 @@ class AppExp:
     @param funcExp: The function being applied
     @type argExps: A List of Scheme Expressions (not passed as a list though!)
     @param argExps: The arguments to the function
+    @type pos: Pos
+    @param pos: Where in the source the application is
     """
-    def __init__(self, funcExp, *argExps):
+    def __init__(self, funcExp, *argExps, pos=unkpos):
         self.funcExp = funcExp
         self.argExps = argExps
+        self.pos = pos
 
     def map(self, f, skip=True):
         if not skip:
@@ -206,10 +229,14 @@ class AppExp:
         return f(
             AppExp(
                 self.funcExp.map(f, skip),
-                *[exp.map(f, skip) for exp in self.argExps]
+                *[exp.map(f, skip) for exp in self.argExps],
+                pos=self.pos
                 )
             )
 
+    def children(self):
+        return self.tolist()
+
     def __repr__(self):
         return pretty(self.toSExp())
 
@@ -228,12 +255,16 @@ class AppExp:
 class IfExp:
     """An if expression.
 
-    All three parameters can be any Scheme expression.
+    The first three parameters can be any Scheme expression.
+
+    @type pos: Pos
+    @param pos: Where in the source the if expression is
     """
-    def __init__(self, condExp, thenExp, elseExp):
+    def __init__(self, condExp, thenExp, elseExp, pos=unkpos):
         self.condExp = condExp
         self.thenExp = thenExp
         self.elseExp = elseExp
+        self.pos = pos
 
     def map(self, f, skip=True):
         if not skip:
@@ -242,10 +273,14 @@ class IfExp:
             IfExp(
                 self.condExp.map(f, skip),
                 self.thenExp.map(f, skip),
-                self.elseExp.map(f, skip)
+                self.elseExp.map(f, skip),
+                self.pos
                 )
             )
 
+    def children(self):
+        return [self.condExp, self.thenExp, self.elseExp]
+
     def __repr__(self):
         return pretty(self.toSExp())
 
@@ -285,6 +320,9 @@ class LetRecExp:
                 )
             )
 
+    def children(self):
+        return [l for _, l in self.bindings] + [self.bodyExp]
+
     def __repr__(self):
         return pretty(self.toSExp())
 
@@ -317,6 +355,9 @@ class BeginExp:
             BeginExp(e.map(f, skip) for e in self.exps)
             )
 
+    def children(self):
+        return list(self.exps)
+
     def __repr__(self):
         return pretty(self.toSExp())
 
@@ -349,6 +390,9 @@ class SetExp:
                 )
             )
 
+    def children(self):
+        return [self.varExp, self.exp]
+
     def __repr__(self):
         return pretty(self.toSExp())
 
@@ -386,6 +430,9 @@ class SetThenExp:
                 )
             )
 
+    def children(self):
+        return [self.varExp, self.exp, self.thenExp]
+
     def __repr__(self):
         pretty(self.toSExp())
 
@@ -13,5 +13,8 @@ setup(name='schemec',
       ],
       package_dir={
         'schemec': 'schemec',
+      },
+      package_data={
+        'schemec': ['runtime/scheme.h', 'runtime/scheme.cpp', 'runtime/scheme_c.h', 'runtime/scheme_c.c'],
       }
      )